@@ -0,0 +1,248 @@
+"""本地模拟的 Moonshot（OpenAI 兼容）接口
+
+实现 /v1/chat/completions（含流式）和 /v1/caching，按配置的首 token 延迟和输出速度返回内容，
+可以按比例注入 429/500 错误。返回的内容按提示词类型构造：大纲请求返回能被 outline.py 解析的
+章节列表，概要请求返回概要和人物状态，其余请求返回指定长度的正文。
+
+单独启动（应用通过 NOVEL_API_BASE 指向它）：
+    python bench/mock_server.py --port 8100 --latency 0.5 --token-rate 60
+    NOVEL_API_BASE=http://127.0.0.1:8100/v1 uvicorn --app-dir src asgi:application --port 5001
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import secrets
+import threading
+import time
+
+from aiohttp import web
+
+# 模拟接口的 token 计数：约 1.5 个汉字一个 token
+CHARS_PER_TOKEN = 1.5
+# 流式响应每个分片包含的 token 数
+CHUNK_TOKENS = 8
+
+_PROSE = (
+    "夜色沉沉，城南的旧巷里只剩下一盏昏黄的路灯。林远站在门前，听见雨水顺着屋檐滴落的声音，"
+    "心里反复掂量着那封没有署名的信。信纸很薄，字迹却用力，仿佛写信的人在每一笔里都压着一段往事。"
+    "他想起三年前离开这里时，母亲站在同一个位置，什么也没说，只把一把旧钥匙塞进他的掌心。"
+    "巷口传来脚步声，苏晴撑着伞走近，伞沿的水珠落在青石板上，溅起细小的水花。"
+    "“你还是回来了。”她的声音很轻，却让林远觉得胸口一紧。"
+)
+_OUTLINE_RANGE = re.compile(r'第(\d+)章到第(\d+)章')
+
+
+def _count_tokens(text):
+    return max(1, int(len(text) / CHARS_PER_TOKEN))
+
+
+def _prose(chars):
+    repeats = chars // len(_PROSE) + 1
+    return (_PROSE * repeats)[:chars]
+
+
+def _outline(first, last):
+    lines = []
+    for chapter in range(first, last + 1):
+        lines.append(f"第{chapter}章 风起第{chapter}回")
+        for section in range(1, 5):
+            lines.append(f"  第{section}节 暗流{section}：{_prose(320)}")
+    return '\n'.join(lines)
+
+
+def make_content(messages, completion_chars, max_tokens):
+    """按提示词类型构造回复内容，长度不超过 max_tokens"""
+    prompt = messages[-1]['content'] if messages else ''
+    match = _OUTLINE_RANGE.search(prompt)
+    if match:
+        content = _outline(int(match.group(1)), int(match.group(2)))
+    elif '小说片段' in prompt:
+        content = "概要：林远回到旧城，收到匿名来信，与苏晴重逢，决定追查父亲失踪的真相。\n人物：\n林远：心事重重，决定留下调查\n苏晴：表面冷淡，暗中关心林远"
+    else:
+        content = _prose(completion_chars)
+    limit = int(max_tokens * CHARS_PER_TOKEN) if max_tokens else len(content)
+    return content[:limit], len(content) > limit
+
+
+def variant(content, index):
+    """n > 1 时第 index 个候选：把正文错开若干字，使各候选内容不同、长度相同"""
+    if not index or not content:
+        return content
+    offset = index * 37 % len(content)
+    return content[offset:] + content[:offset]
+
+
+class MockServer:
+    """可在后台线程运行的模拟服务，stats 记录收到的请求数和注入的错误数"""
+
+    def __init__(self, latency=0.3, token_rate=400, completion_chars=3500, error_rate=0.0, error_status=429, seed=None):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.completion_chars = completion_chars
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.caches = {}
+        self.stats = {
+            'requests': 0, 'streams': 0, 'errors': 0, 'cancelled': 0, 'completion_tokens': 0, 'active': 0, 'max_active': 0
+        }
+        self.loop = None
+        self.runner = None
+        self.port = None
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_post('/v1/caching', self.create_cache)
+        app.router.add_get('/v1/caching/{cache_id}', self.get_cache)
+        app.router.add_delete('/v1/caching/{cache_id}', self.delete_cache)
+        return app
+
+    def _injected_error(self):
+        if self.error_rate <= 0 or self.random.random() >= self.error_rate:
+            return None
+        self.stats['errors'] += 1
+        headers = {'Retry-After': '1'} if self.error_status == 429 else {}
+        body = {'error': {'message': 'injected error', 'type': 'rate_limit_reached_error' if self.error_status == 429 else 'server_error'}}
+        return web.json_response(body, status=self.error_status, headers=headers)
+
+    def _generation_time(self, tokens):
+        return tokens / self.token_rate if self.token_rate > 0 else 0
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.stats['requests'] += 1
+        error = self._injected_error()
+        if error is not None:
+            await asyncio.sleep(self.latency / 4)
+            return error
+
+        messages = [message for message in body.get('messages', []) if message.get('role') != 'cache']
+        content, truncated = make_content(messages, self.completion_chars, body.get('max_tokens'))
+        prompt_tokens = sum(_count_tokens(message.get('content', '')) for message in body.get('messages', []))
+        n = max(1, int(body.get('n') or 1))
+        completion_tokens = _count_tokens(content) * n
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+        finish_reason = 'length' if truncated else 'stop'
+        self.stats['completion_tokens'] += completion_tokens
+
+        self.stats['active'] += 1
+        self.stats['max_active'] = max(self.stats['max_active'], self.stats['active'])
+        try:
+            await asyncio.sleep(self.latency)
+            if body.get('stream'):
+                self.stats['streams'] += 1
+                return await self._stream(request, body['model'], content, usage, finish_reason)
+            await asyncio.sleep(self._generation_time(completion_tokens))
+            return web.json_response({
+                'id': 'chatcmpl-' + secrets.token_hex(8),
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body['model'],
+                'choices': [
+                    {'index': index, 'message': {'role': 'assistant', 'content': variant(content, index)}, 'finish_reason': finish_reason}
+                    for index in range(n)
+                ],
+                'usage': usage
+            })
+        finally:
+            self.stats['active'] -= 1
+
+    async def _stream(self, request, model, content, usage, finish_reason):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        chunk_id = 'chatcmpl-' + secrets.token_hex(8)
+        step = max(1, int(CHUNK_TOKENS * CHARS_PER_TOKEN))
+        started = time.monotonic()
+        try:
+            for offset in range(0, len(content), step):
+                piece = content[offset:offset + step]
+                # 按输出速度计算每个分片的发送时刻，避免 sleep 误差累积
+                delay = started + self._generation_time(_count_tokens(content[:offset + step])) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await response.write(self._chunk(chunk_id, model, {'content': piece}))
+            # Moonshot 在最后一个分片的 choice 中附带 usage
+            await response.write(self._chunk(chunk_id, model, {}, finish_reason, usage))
+            await response.write(b'data: [DONE]\n\n')
+            await response.write_eof()
+        except ConnectionResetError:
+            # 调用方中途断开（取消生成）
+            self.stats['cancelled'] += 1
+        return response
+
+    @staticmethod
+    def _chunk(chunk_id, model, delta, finish_reason=None, usage=None):
+        choice = {'index': 0, 'delta': delta, 'finish_reason': finish_reason}
+        if usage is not None:
+            choice['usage'] = usage
+        payload = {'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model, 'choices': [choice]}
+        return f'data: {json.dumps(payload, ensure_ascii=False)}\n\n'.encode('utf-8')
+
+    async def create_cache(self, request):
+        body = await request.json()
+        cache_id = 'cache-' + secrets.token_hex(8)
+        tokens = sum(_count_tokens(message.get('content', '')) for message in body.get('messages', []))
+        self.caches[cache_id] = {'id': cache_id, 'status': 'ready', 'tokens': tokens}
+        return web.json_response(self.caches[cache_id])
+
+    async def get_cache(self, request):
+        cache = self.caches.get(request.match_info['cache_id'])
+        if cache is None:
+            return web.json_response({'error': {'message': 'not found'}}, status=404)
+        return web.json_response(cache)
+
+    async def delete_cache(self, request):
+        self.caches.pop(request.match_info['cache_id'], None)
+        return web.json_response({'deleted': True})
+
+    def start(self, host='127.0.0.1', port=0):
+        """在后台线程中启动，返回实际监听的端口"""
+        started = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.runner = web.AppRunner(self.app())
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, host, port)
+            self.loop.run_until_complete(site.start())
+            self.port = site._server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return self.port
+
+    def stop(self):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.3, help='首 token 延迟（秒）')
+    parser.add_argument('--token-rate', type=float, default=400, help='每个请求每秒输出的 token 数，0 表示不限')
+    parser.add_argument('--completion-chars', type=int, default=3500, help='正文类回复的字数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='注入错误的请求比例')
+    parser.add_argument('--error-status', type=int, default=429, choices=(429, 500, 503), help='注入错误的状态码')
+    parser.add_argument('--seed', type=int, default=None, help='错误注入的随机种子')
+
+
+def from_arguments(args):
+    return MockServer(
+        latency=args.latency, token_rate=args.token_rate, completion_chars=args.completion_chars,
+        error_rate=args.error_rate, error_status=args.error_status, seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='模拟 Moonshot 接口')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(from_arguments(args).app(), host=args.host, port=args.port)
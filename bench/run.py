@@ -0,0 +1,300 @@
+"""离线性能测试
+
+启动本地模拟接口（bench/mock_server.py）和 ASGI 服务（uvicorn），模拟多个用户并发走完
+生成大纲、生成小节、导出的流程，输出各接口的 p50/p95/p99 延迟、吞吐和服务进程内存。
+不访问网络，也不消耗 API 额度。
+
+    python bench/run.py --scenario novel --users 50 --sections 4
+    python bench/run.py --scenario sections --users 20 --latency 1 --token-rate 60 --output bench_output.txt
+
+场景：
+    outline   每个用户按 background、part1、part2、part3 依次调用 /generate_outline_part
+    sections  生成大纲后流式生成 --sections 个小节，记录首字延迟
+    export    生成大纲和小节后反复调用 /export_novel（txt、docx、epub）
+    novel     完整流程：大纲、小节、导出
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from mock_server import add_arguments, from_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = {
+    'outline': ('outline',),
+    'sections': ('outline', 'sections'),
+    'export': ('outline', 'sections', 'export'),
+    'novel': ('outline', 'sections', 'export'),
+}
+OUTLINE_STAGES = ('background', 'part1', 'part2', 'part3')
+EXPORT_FORMATS = ('txt', 'docx', 'epub')
+# export 场景每个用户重复导出的轮数
+EXPORT_ROUNDS = 5
+
+
+def percentile(values, p):
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(p / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def read_rss(pid):
+    """返回进程当前和峰值常驻内存（MB）；无法读取 /proc 时返回 (None, None)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None, None
+    return int(fields['VmRSS'].split()[0]) / 1024, int(fields['VmHWM'].split()[0]) / 1024
+
+
+class Recorder:
+    """按操作名称记录耗时、失败次数和首字延迟"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.ttft = {}
+        self.errors = {}
+        self.chars = 0
+
+    def record(self, name, seconds, ok=True, ttft=None, chars=0):
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return
+        self.latencies.setdefault(name, []).append(seconds)
+        if ttft is not None:
+            self.ttft.setdefault(name, []).append(ttft)
+        self.chars += chars
+
+    def names(self):
+        return sorted(set(self.latencies) | set(self.errors))
+
+
+class BenchUser:
+    def __init__(self, index, base_url, session, recorder, args):
+        self.index = index
+        self.base_url = base_url
+        self.session = session
+        self.recorder = recorder
+        self.args = args
+        self.client_id = None
+        self.session_id = f'bench-{index}'
+        self.chapters = []
+
+    async def post(self, name, path, payload):
+        """调用非流式接口，返回响应数据；失败时返回 None"""
+        started = time.perf_counter()
+        try:
+            async with self.session.post(self.base_url + path, json=dict(payload, client_id=self.client_id)) as response:
+                data = await response.json()
+        except Exception:
+            self.recorder.record(name, time.perf_counter() - started, ok=False)
+            return None
+        ok = response.status == 200 and data.get('status') == 'success'
+        self.recorder.record(name, time.perf_counter() - started, ok=ok)
+        return data if ok else None
+
+    async def stream(self, name, path, payload):
+        """调用 SSE 接口，记录首字延迟，返回 done 事件的数据"""
+        started = time.perf_counter()
+        first = None
+        done = None
+        try:
+            async with self.session.post(self.base_url + path, json=dict(payload, client_id=self.client_id)) as response:
+                event = None
+                async for raw in response.content:
+                    line = raw.decode('utf-8').rstrip('\n')
+                    if line.startswith('event: '):
+                        event = line[len('event: '):]
+                    elif line.startswith('data: '):
+                        if event == 'delta' and first is None:
+                            first = time.perf_counter() - started
+                        elif event == 'done':
+                            done = json.loads(line[len('data: '):])
+                        elif event == 'error':
+                            break
+        except Exception:
+            done = None
+        chars = len(done['section']['content']) if done else 0
+        self.recorder.record(name, time.perf_counter() - started, ok=done is not None, ttft=first, chars=chars)
+        return done
+
+    async def run(self, phases):
+        data = await self.post('set_api_key', '/set_api_key', {'api_key': f'bench-key-{self.index}'})
+        if data is None:
+            return
+        self.client_id = data['client_id']
+        title = f'基准测试小说{self.index}'
+        if 'outline' in phases:
+            for stage in OUTLINE_STAGES:
+                data = await self.post('generate_outline_part', '/generate_outline_part', {
+                    'title': title, 'genre': '都市情感', 'session_id': self.session_id, 'stage': stage
+                })
+                if data is None:
+                    return
+            data = await self.post('get_outline', '/get_outline', {'session_id': self.session_id})
+            if data is None:
+                return
+            self.chapters = data['data']['chapters']
+        if 'sections' in phases:
+            sections = [
+                (chapter['number'], section['number'])
+                for chapter in self.chapters for section in chapter['sections']
+            ]
+            if self.args.sections:
+                sections = sections[:self.args.sections]
+            for chapter_number, section_number in sections:
+                await self.stream('generate_section', '/generate_section', {
+                    'session_id': self.session_id, 'chapter_number': chapter_number,
+                    'section_number': section_number, 'stream': True
+                })
+        if 'export' in phases:
+            rounds = EXPORT_ROUNDS if self.args.scenario == 'export' else 1
+            for _ in range(rounds):
+                for format in EXPORT_FORMATS:
+                    await self.post(f'export_novel[{format}]', '/export_novel', {'session_id': self.session_id, 'format': format})
+
+
+async def wait_ready(base_url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError('服务进程启动失败')
+            try:
+                async with session.get(base_url + '/cache_stats') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError('等待服务启动超时')
+
+
+async def sample_memory(pid, samples, stop):
+    while not stop.is_set():
+        rss, _ = read_rss(pid)
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_bench(args, base_url, pid):
+    recorder = Recorder()
+    phases = SCENARIOS[args.scenario]
+    samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_memory(pid, samples, stop))
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        started = time.perf_counter()
+        users = [BenchUser(index, base_url, session, recorder, args) for index in range(args.users)]
+        await asyncio.gather(*(user.run(phases) for user in users))
+        elapsed = time.perf_counter() - started
+    stop.set()
+    await sampler
+    return recorder, elapsed, samples
+
+
+def format_seconds(value):
+    return '-' if value is None else f'{value:.3f}'
+
+
+def report(args, recorder, elapsed, samples, peak_rss, mock):
+    lines = [
+        f'场景：{args.scenario}  用户数：{args.users}  每用户小节数：{args.sections or "全部"}',
+        f'模拟接口：首 token 延迟 {args.latency}s，输出 {args.token_rate} token/s，正文 {args.completion_chars} 字，'
+        f'错误比例 {args.error_rate}（{args.error_status}）',
+        '',
+        f'{"接口":<24}{"成功":>6}{"失败":>6}{"p50":>9}{"p95":>9}{"p99":>9}{"max":>9}{"TTFT p50":>10}{"TTFT p95":>10}',
+    ]
+    succeeded = 0
+    for name in recorder.names():
+        values = recorder.latencies.get(name, [])
+        ttft = recorder.ttft.get(name, [])
+        succeeded += len(values)
+        lines.append(
+            f'{name:<24}{len(values):>6}{recorder.errors.get(name, 0):>6}'
+            f'{format_seconds(percentile(values, 50)):>9}{format_seconds(percentile(values, 95)):>9}'
+            f'{format_seconds(percentile(values, 99)):>9}{format_seconds(max(values) if values else None):>9}'
+            f'{format_seconds(percentile(ttft, 50)):>10}{format_seconds(percentile(ttft, 95)):>10}'
+        )
+    lines += [
+        '',
+        f'总耗时：{elapsed:.2f}s  吞吐：{succeeded / elapsed:.2f} 请求/s  正文输出：{recorder.chars / elapsed:.0f} 字/s',
+        f'上游请求：{mock.stats["requests"]}（流式 {mock.stats["streams"]}，注入错误 {mock.stats["errors"]}，'
+        f'中途断开 {mock.stats["cancelled"]}，最大并发 {mock.stats["max_active"]}）',
+    ]
+    if samples:
+        lines.append(f'服务进程内存：峰值 {peak_rss:.1f} MB，结束时 {samples[-1]:.1f} MB')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线性能测试')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='novel')
+    parser.add_argument('--users', type=int, default=50, help='并发用户数')
+    parser.add_argument('--sections', type=int, default=4, help='每个用户生成的小节数，0 表示大纲中的全部小节')
+    parser.add_argument('--storage', choices=('sqlite', 'memory'), default='sqlite')
+    parser.add_argument('--timeout', type=float, default=300, help='单个请求读取超时（秒）')
+    parser.add_argument('--output', help='同时把报告写入该文件')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    mock = from_arguments(args)
+    mock_port = mock.start()
+    port = free_port()
+    workdir = tempfile.TemporaryDirectory()
+    env = dict(
+        os.environ,
+        NOVEL_API_BASE=f'http://127.0.0.1:{mock_port}/v1',
+        NOVEL_STORAGE=args.storage,
+        NOVEL_DB_PATH=os.path.join(workdir.name, 'bench.db'),
+        NOVEL_CACHE_DIR='',
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', '--app-dir', os.path.join(ROOT, 'src'), 'asgi:application',
+         '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+        env=env, cwd=workdir.name
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        asyncio.run(wait_ready(base_url, process))
+        recorder, elapsed, samples = asyncio.run(run_bench(args, base_url, process.pid))
+        _, peak_rss = read_rss(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+        mock.stop()
+        workdir.cleanup()
+
+    text = report(args, recorder, elapsed, samples, peak_rss, mock)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,162 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
 import openai
 import os
+import asyncio
+import json
+import base64
 from datetime import datetime
+import threading
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from batch import BatchRunner
+from storage import MemoryStorage, create_storage
+from llm_cache import CACHE_MODES, ResponseCache, create_cache
+from clients import API_BASE, HTTPClientPool, WriterRegistry, capture_response
+from tokens import estimate_messages_tokens, estimate_tokens, plan_completion, tokens_for_chars
+from exporters import DOCX_MIMETYPE, EPUB_MIMETYPE, iter_docx, iter_epub
+from ratelimit import UpstreamLimiter, is_quota_exhausted, retry_after
+from singleflight import SingleFlight
+from prompts import BUILTIN_TEMPLATES, PromptRegistry, create_registry
+from context_cache import ContextCache, ContextExpired, create_context_cache
+from sections import VersionConflict
+from prefetch import Prefetcher, is_enabled as prefetch_enabled
+from jobs import JobCancelled, JobRegistry
+from ranking import rank
+import consistency
+import metrics
+from outline import chapter_heading, find_section, iter_outline_sections, merge_chapters, outline_slice, outline_text, parse_outline
 
 app = Flask(__name__)
 
+# 大纲生成的各个阶段，按章节顺序排列
+# depends_on: 必须先完成的阶段；互不依赖的阶段可以并发生成
+# max_chars: 按提示词中的篇幅要求估算的输出字数上限，用来确定 max_tokens
+OUTLINE_STAGES = {
+    'background': {
+        # 背景至少 500 字，主要人物每人至少 200 字，另有转折点和结构规划
+        'depends_on': (),
+        'next_stage': 'part1',
+        'template': 'outline.background',
+        'max_chars': 3000
+    },
+    'part1': {
+        # 生成第1-6章，每章4-5节，每节300-500字
+        'depends_on': ('background',),
+        'next_stage': 'part2',
+        'template': 'outline.part1',
+        'max_chars': 6 * 5 * 500
+    },
+    'part2': {
+        # 生成第7-12章
+        'depends_on': ('background',),
+        'next_stage': 'part3',
+        'template': 'outline.part2',
+        'max_chars': 6 * 5 * 500
+    },
+    'part3': {
+        # 生成第13-15章
+        'depends_on': ('background',),
+        'next_stage': 'complete',
+        'template': 'outline.part3',
+        'max_chars': 3 * 5 * 500
+    },
+}
+
+def plan_outline_stages(stages=OUTLINE_STAGES):
+    """按依赖关系把大纲阶段分批，同一批内的阶段互不依赖，可以并发执行"""
+    waves = []
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        wave = [name for name in remaining if all(dep in done for dep in stages[name]['depends_on'])]
+        if not wave:
+            raise ValueError(f"大纲阶段存在循环依赖：{remaining}")
+        waves.append(wave)
+        done.update(wave)
+        remaining = [name for name in remaining if name not in done]
+    return waves
+
+# 每节的记忆整理（概要和人物状态）在后台线程中进行，不拖慢生成接口
+memory_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='story-memory')
+
+# 输出长度按提示词中的字数要求估算：小节 3000-4000 字，/generate_content 4000-6000 字
+SECTION_MAX_TOKENS = tokens_for_chars(4000)
+CONTENT_MAX_TOKENS = tokens_for_chars(6000)
+
+# 低于最少字数或被长度截断时自动续写，续写时只带上已生成内容的末尾
+SECTION_MIN_CHARS = 3000
+CONTENT_MIN_CHARS = 4000
+MAX_CONTINUATIONS = 3
+CONTINUATION_TAIL_CHARS = 1500
+
+# 请求中 "candidates": N 时一次生成 N 个候选并在本地排序，N 的上限（Moonshot 的 n 最大为 5）
+MAX_CANDIDATES = int(os.environ.get('NOVEL_MAX_CANDIDATES', 5))
+
+# 注入小节提示词的前情提要最多占用的 token 数
+MEMORY_TOKEN_BUDGET = 1200
+# 最近若干节保留逐节概要，更早的内容只保留章节概要
+RECENT_SECTIONS = 6
+
+def positive_int(value, field):
+    """把请求中的章节号、小节号转换为整数，不是正整数时抛出 ValueError"""
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} 应为正整数")
+    if number < 1:
+        raise ValueError(f"{field} 应为正整数")
+    return number
+
+def parse_section_memory(text):
+    """解析记忆整理的输出，返回 (概要, {人物: 状态})"""
+    summary_lines = []
+    characters = {}
+    in_characters = False
+    for line in text.splitlines():
+        line = line.strip().lstrip('-*').strip()
+        if not line:
+            continue
+        if line.startswith('人物：') or line.startswith('人物:'):
+            in_characters = True
+            continue
+        if line.startswith('概要：') or line.startswith('概要:'):
+            line = line[3:].strip()
+        if in_characters:
+            name, sep, state = line.replace(':', '：').partition('：')
+            if sep and name.strip():
+                characters[name.strip()] = state.strip()
+        elif line:
+            summary_lines.append(line)
+    return ''.join(summary_lines), characters
+
 class NovelWriter:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, storage=None, cache=None, limiter=None, prompts=None, context_cache=None):
         self.api_key = api_key
-        self.current_progress = {}  # 用于存储生成进度
-        self.chapters = {}  # 用于存储章节和小节内容
-        self.story_context = {}  # 用于存储故事上下文信息
+        # 进度、章节和故事上下文都保存在存储后端中
+        self.storage = storage if storage is not None else MemoryStorage()
+        self.cache = cache  # 可选的接口响应缓存，按请求选择是否使用
+        # 上游配额按 API Key 计算，每个 writer 持有自己的限流器
+        self.limiter = limiter if limiter is not None else UpstreamLimiter()
+        # 相同的请求同时到达时（连点、前端重试）只调用一次上游
+        self.inflight = SingleFlight()
+        self.prompts = prompts if prompts is not None else PromptRegistry(BUILTIN_TEMPLATES)
+        # 同一部小说各小节共用的背景和大纲前缀可以登记为上游上下文缓存
+        self.context_cache = context_cache if context_cache is not None else ContextCache()
+        # 用户阅读当前小节时在后台预生成下一节
+        self.prefetcher = Prefetcher(self)
+        # 进行中的生成任务，可以通过 /cancel_job 取消
+        self.jobs = JobRegistry()
+        # 避免并发的首次创建互相覆盖故事上下文
+        self.context_lock = threading.Lock()
         if not self.api_key:
             raise ValueError("API key is required")
-        
-        openai.api_key = self.api_key
-        openai.api_base = "https://api.moonshot.cn/v1"
     
     def initialize_story_context(self, session_id, title, genre, background):
         """初始化故事上下文"""
-        self.story_context[session_id] = {
+        self.storage.save_story_context(session_id, {
             'title': title,
             'genre': genre,
             'background': background,
@@ -29,183 +164,970 @@ class NovelWriter:
             'plot_lines': [],  # 存储主要情节线索
             'chapter_summaries': {},  # 存储每章概要
             'total_chapters': 0  # 当前总章节数
-        }
+        })
+
+    def ensure_story_context(self, session_id, title=None, genre=None, background=None):
+        """故事上下文不存在时创建，已存在时用给出的非空字段更新（与保存的大纲保持一致）"""
+        fields = {key: value for key, value in (('title', title), ('genre', genre), ('background', background)) if value}
+        with self.context_lock:
+            if self.storage.update_story_context(session_id, lambda context: context.update(fields)) is None:
+                self.initialize_story_context(session_id, title, genre, background)
     
-    def analyze_story_structure(self, session_id):
+    def analyze_story_structure(self, session_id, cache=None):
         """分析故事结构，规划章节分布"""
-        context = self.story_context.get(session_id, {})
+        context = self.storage.get_story_context(session_id) or {}
         genre = context.get('genre', '')
         background = context.get('background', '')
 
-        structure_prompt = f"""请分析这个{genre}小说的故事结构并规划章节分布。
-
-背景信息：
-{background}
-
-要求：
-1. 总章节数不超过30章
-2. 按照"引子-铺垫-发展-高潮-结局"五个阶段规划
-3. 明确每个阶段的章节数量
-4. 为每个阶段设定明确的情节目标
-5. 规划主要人物的成长弧线
-6. 设计故事的主要转折点
-7. 安排伏笔和线索的埋设点
-
-请按以下格式输出：
-- 总体结构：
-- 各阶段章节分布：
-- 主要情节线索：
-- 人物成长规划：
-- 重要转折点：
-- 伏笔安排："""
-
-        completion = openai.ChatCompletion.create(
-            model="moonshot-v1-8k",
-            messages=[
-                {"role": "system", "content": "你是一个专业的小说策划，专注于故事结构设计和情节规划。"},
-                {"role": "user", "content": structure_prompt}
-            ],
-            temperature=0.7,
-            max_tokens=2000
-        )
+        analysis = self.complete(
+            self.prompts.render('structure.analyze', genre=genre, background=background),
+            max_tokens=2000, cache=cache
+        )['content']
         
         # 保存分析结果到上下文
-        analysis = completion.choices[0].message.content
-        self.story_context[session_id]['structure_analysis'] = analysis
+        self.storage.update_story_context(session_id, lambda context: context.update(structure_analysis=analysis))
         return analysis
 
-    def generate_section(self, title, genre, chapter_title, section_number, background, outline):
-        """生成小节内容，加入更多上下文信息"""
-        section_prompt = f"""请为{genre}小说《{title}》的{chapter_title}生成第{section_number}节的详细内容。
-
-背景信息：
-{background}
-
-章节大纲：
-{outline}
-
-要求：
-1. 字数在3000-4000字之间
-2. 场景描写要具体细腻，调动多种感官
-3. 人物对话要体现性格特点和情感变化
-4. 注重环境氛围的营造
-5. 细节描写要为情节服务
-6. 保持人物性格的一致性和成长性
-7. 注意伏笔的埋设和呼应
-8. 确保与其他小节的情节连贯
-9. 运用恰当的写作手法
-10. 节奏把控要合理，重要场景要细致
-11. 通过细节体现人物性格
-12. 适当加入象征性的意象
-
-格式要求：
-1. 分段要合理，段落长度适中
-2. 重要对话和场景要单独成段
-3. 适当使用空行区分场景转换"""
-
-        completion = openai.ChatCompletion.create(
-            model="moonshot-v1-8k",
-            messages=[
-                {"role": "system", "content": "你是一个专业的小说写手，专注于创作精彩的章节内容。"},
-                {"role": "user", "content": section_prompt}
-            ],
-            temperature=0.7,
-            max_tokens=3000
+    def _outline_messages(self, title, genre, stage):
+        """构造大纲某一阶段的提示词"""
+        return self.prompts.render(OUTLINE_STAGES[stage]['template'], title=title, genre=genre)
+
+    def generate_outline_stage(self, title, genre, stage, cache=None):
+        """生成大纲的某一个阶段，max_tokens 按该阶段要求的篇幅确定（超出 8k 模型时自动换用更大的模型）"""
+        max_tokens = tokens_for_chars(OUTLINE_STAGES[stage]['max_chars'])
+        return self.complete(self._outline_messages(title, genre, stage), max_tokens=max_tokens, cache=cache)['content']
+
+    async def agenerate_outline_stage(self, title, genre, stage, cache=None):
+        """generate_outline_stage 的异步版本"""
+        max_tokens = tokens_for_chars(OUTLINE_STAGES[stage]['max_chars'])
+        result = await self.acomplete(self._outline_messages(title, genre, stage), max_tokens=max_tokens, cache=cache)
+        return result['content']
+
+    def generate_full_outline(self, title, genre, cache=None):
+        """按依赖分批生成全部大纲阶段，每批内部并发执行
+        返回 {阶段名: 内容}
+        """
+        results = {}
+        for wave in plan_outline_stages():
+            if len(wave) == 1:
+                results[wave[0]] = self.generate_outline_stage(title, genre, wave[0], cache)
+                continue
+            with ThreadPoolExecutor(max_workers=len(wave)) as executor:
+                futures = {stage: executor.submit(self.generate_outline_stage, title, genre, stage, cache) for stage in wave}
+                for stage, future in futures.items():
+                    results[stage] = future.result()
+        return results
+
+    async def agenerate_full_outline(self, title, genre, cache=None):
+        """generate_full_outline 的异步版本，每批内部用 asyncio.gather 并发"""
+        results = {}
+        for wave in plan_outline_stages():
+            contents = await asyncio.gather(*[self.agenerate_outline_stage(title, genre, stage, cache) for stage in wave])
+            results.update(zip(wave, contents))
+        return results
+
+    def _section_parts(self, title, genre, chapter_title, section_number, background, outline, memory, session_id):
+        """返回 (同一部小说各小节相同的前缀消息, 本节的任务消息)"""
+        outline_block = ''
+        stored = self.get_outline(session_id) if session_id and self.context_cache.enabled else None
+        if stored and stored['chapters']:
+            # 完整大纲只在前缀会被缓存时放入，否则每节都要重复付出这部分输入
+            outline_block = f"\n\n完整大纲：\n{outline_text(stored['chapters'])}"
+        context = self.prompts.render(
+            'section.context', title=title, genre=genre, background=background, outline_block=outline_block
+        )
+        task = self.prompts.render(
+            'section.task',
+            genre=genre,
+            chapter_title=chapter_title,
+            section_number=section_number,
+            outline=outline,
+            memory_block=f"前情提要：\n{memory}\n\n" if memory else ''
         )
-        return completion.choices[0].message.content
+        return context, task
 
-    def update_story_progress(self, session_id, chapter_number, content):
-        """更新故事进度，分析新内容对整体的影响"""
-        if session_id not in self.story_context:
-            return
-        
-        # 更新章节概要
-        self.story_context[session_id]['chapter_summaries'][chapter_number] = {
-            'content': content,
-            'timestamp': datetime.now()
+    def _section_messages(self, title, genre, chapter_title, section_number, background, outline, memory='', session_id=None):
+        """构造小节生成的提示词，开启上下文缓存时前缀替换为缓存引用"""
+        context, task = self._section_parts(title, genre, chapter_title, section_number, background, outline, memory, session_id)
+        return (self.context_cache.reference(self.api_key, session_id, context) or context) + task
+
+    async def _asection_messages(self, title, genre, chapter_title, section_number, background, outline, memory='', session_id=None):
+        # _section_parts 会读取存储中的大纲，放到线程中执行
+        context, task = await asyncio.to_thread(
+            self._section_parts, title, genre, chapter_title, section_number, background, outline, memory, session_id
+        )
+        return (await self.context_cache.areference(self.api_key, session_id, context) or context) + task
+
+    def generate_section(self, title, genre, chapter_title, section_number, background, outline, memory='', session_id=None,
+                         fresh=False):
+        """生成小节内容，加入更多上下文信息
+        fresh: 为 True 时不合并到进行中的相同请求上（重新生成，见 SingleFlight）
+        """
+        return self.complete_long(
+            self._section_messages(title, genre, chapter_title, section_number, background, outline, memory, session_id),
+            min_chars=SECTION_MIN_CHARS,
+            max_tokens=SECTION_MAX_TOKENS,
+            fresh=fresh
+        )['content']
+
+    async def agenerate_section(self, title, genre, chapter_title, section_number, background, outline, memory='', session_id=None,
+                                fresh=False):
+        """generate_section 的异步版本"""
+        result = await self.acomplete_long(
+            await self._asection_messages(title, genre, chapter_title, section_number, background, outline, memory, session_id),
+            min_chars=SECTION_MIN_CHARS,
+            max_tokens=SECTION_MAX_TOKENS,
+            fresh=fresh
+        )
+        return result['content']
+
+    def stream_section(self, title, genre, chapter_title, section_number, background, outline, memory='', session_id=None,
+                       fresh=False):
+        """流式生成小节内容，逐段产出增量文本"""
+        return self.stream_long(
+            self._section_messages(title, genre, chapter_title, section_number, background, outline, memory, session_id),
+            min_chars=SECTION_MIN_CHARS,
+            max_tokens=SECTION_MAX_TOKENS,
+            fresh=fresh
+        )
+
+    async def astream_section(self, title, genre, chapter_title, section_number, background, outline, memory='', session_id=None,
+                              fresh=False):
+        """stream_section 的异步版本"""
+        messages = await self._asection_messages(title, genre, chapter_title, section_number, background, outline, memory, session_id)
+        async for event in self.astream_long(messages, min_chars=SECTION_MIN_CHARS, max_tokens=SECTION_MAX_TOKENS, fresh=fresh):
+            yield event
+
+    def _content_messages(self, title, genre, chapter_title, section_title, outline):
+        """构造 /generate_content 的提示词"""
+        return self.prompts.render(
+            'content.write',
+            title=title,
+            genre=genre,
+            chapter_title=chapter_title,
+            section_title=section_title,
+            outline=outline
+        )
+
+    def _background_revision_messages(self, title, genre, current_content, suggestion):
+        """构造按建议修改背景设定的提示词"""
+        return self.prompts.render(
+            'background.revise',
+            title=title,
+            genre=genre,
+            current_content=current_content,
+            suggestion=suggestion
+        )
+
+    def _cache_key(self, cache, model, messages, temperature, max_tokens):
+        """根据缓存模式计算缓存键，不使用缓存时返回 None"""
+        if cache and cache not in CACHE_MODES:
+            raise ValueError(f"未知的缓存模式：{cache}")
+        if not cache or self.cache is None:
+            return None
+        return self.cache.make_key(model, messages, temperature, max_tokens)
+
+    @staticmethod
+    def _completion_result(completion):
+        choice = completion.choices[0]
+        usage = completion.get('usage')
+        result = {
+            'content': choice.message.content,
+            'finish_reason': choice.get('finish_reason'),
+            'usage': usage.to_dict_recursive() if usage else None
         }
-        
-        # 更新总章节数
-        self.story_context[session_id]['total_chapters'] = max(
-            self.story_context[session_id]['total_chapters'],
-            chapter_number
+        if len(completion.choices) > 1:
+            # n > 1 时按序号附带全部候选，usage 为所有候选的合计
+            result['choices'] = [
+                {'content': item.message.content, 'finish_reason': item.get('finish_reason')}
+                for item in sorted(completion.choices, key=lambda item: item.get('index', 0))
+            ]
+        return result
+
+    @staticmethod
+    def _stream_chunk(chunk):
+        """解析一个流式分片，返回 (增量文本, usage, finish_reason)"""
+        if not chunk.get('choices'):
+            return None, None, None
+        choice = chunk['choices'][0]
+        # Moonshot 在最后一个分片的 choice 中附带 usage
+        usage = choice.get('usage') or chunk.get('usage')
+        return choice.get('delta', {}).get('content'), usage, choice.get('finish_reason')
+
+    def _create(self, **kwargs):
+        """调用 ChatCompletion.create 并记录耗时、用量和错误，流式调用返回包装后的分片迭代器"""
+        call = metrics.UpstreamCall(kwargs['model'], 'stream' if kwargs.get('stream') else 'complete')
+        try:
+            with capture_response() as captured:
+                response = openai.ChatCompletion.create(api_key=self.api_key, api_base=API_BASE, **kwargs)
+        except Exception as e:
+            call.finish(error=e)
+            raise
+        if kwargs.get('stream'):
+            return self._tracked_stream(call, response, captured[-1] if captured else None)
+        call.finish(usage=response.get('usage'))
+        return response
+
+    async def _acreate(self, **kwargs):
+        """_create 的异步版本"""
+        call = metrics.UpstreamCall(kwargs['model'], 'stream' if kwargs.get('stream') else 'complete')
+        try:
+            with capture_response() as captured:
+                response = await openai.ChatCompletion.acreate(api_key=self.api_key, api_base=API_BASE, **kwargs)
+        except Exception as e:
+            call.finish(error=e)
+            raise
+        if kwargs.get('stream'):
+            return self._atracked_stream(call, response, captured[-1] if captured else None)
+        call.finish(usage=response.get('usage'))
+        return response
+
+    def _tracked_stream(self, call, response, http_response=None):
+        """逐个转发上游分片，记录首 token 时间，流结束时记录总耗时和用量
+        http_response: 底层 HTTP 响应，未读完就被关闭（客户端断开、任务取消）时关闭它以断开上游
+        """
+        usage = None
+        completed = False
+        try:
+            for chunk in response:
+                delta, chunk_usage, _ = self._stream_chunk(chunk)
+                if delta:
+                    call.first_token()
+                usage = chunk_usage or usage
+                yield chunk
+            completed = True
+        except Exception as e:
+            call.finish(error=e)
+            raise
+        finally:
+            # 读到一半被关闭（客户端断开）时记为 cancelled
+            if completed:
+                call.finish(usage=usage)
+            else:
+                call.finish(error='cancelled')
+                if http_response is not None:
+                    http_response.close()
+
+    async def _atracked_stream(self, call, response, http_response=None):
+        usage = None
+        completed = False
+        try:
+            async for chunk in response:
+                delta, chunk_usage, _ = self._stream_chunk(chunk)
+                if delta:
+                    call.first_token()
+                usage = chunk_usage or usage
+                yield chunk
+            completed = True
+        except Exception as e:
+            call.finish(error=e)
+            raise
+        finally:
+            if completed:
+                call.finish(usage=usage)
+            else:
+                call.finish(error='cancelled')
+                if http_response is not None:
+                    http_response.close()
+
+    def complete(self, messages, model=None, temperature=0.7, max_tokens=2000, cache=None, n=1, fresh=False):
+        """调用接口并返回 {'content', 'finish_reason', 'usage'}
+        n: 大于 1 时一次请求生成 n 个候选，结果另含 'choices'，content 为第一个候选
+        model: 不指定时按提示词长度自动选择 8k/32k/128k 模型，max_tokens 会被压缩到上下文窗口以内
+        cache: None 不使用缓存；'prefer' 优先读缓存；'bypass' 跳过读取但刷新缓存
+        fresh: 为 True 时不合并到进行中的相同请求上，另行调用上游（重新生成时使用）
+        messages 可以以上下文缓存引用开头，模型选择和限流按展开后的完整提示词计算
+        """
+        upstream, full = self.context_cache.resolve(messages)
+        model, max_tokens = plan_completion(full, max_tokens, model)
+        # 多候选的结果本来就是为了得到不同的版本，不读写响应缓存
+        key = self._cache_key(cache, model, messages, temperature, max_tokens) if n == 1 else None
+        if key is not None and cache == 'prefer':
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        def request():
+            # 提示词只计费一次，输出按 n 份计
+            cost = estimate_messages_tokens(full) + max_tokens * n
+            completion = self.limiter.call(lambda: self._create(
+                model=model,
+                messages=upstream,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **({'n': n} if n > 1 else {})
+            ), cost)
+            result = self._completion_result(completion)
+            self.limiter.settle(cost, result['usage'])
+            if key is not None:
+                self.cache.set(key, result)
+            return result
+
+        fingerprint = ResponseCache.make_key(model, messages, temperature, max_tokens, n)
+        return self.inflight.do(fingerprint, request, fresh)
+
+    async def acomplete(self, messages, model=None, temperature=0.7, max_tokens=2000, cache=None, n=1, fresh=False):
+        """complete 的异步版本，通过 aiohttp 发起请求，不占用线程"""
+        upstream, full = self.context_cache.resolve(messages)
+        model, max_tokens = plan_completion(full, max_tokens, model)
+        # 多候选的结果本来就是为了得到不同的版本，不读写响应缓存
+        key = self._cache_key(cache, model, messages, temperature, max_tokens) if n == 1 else None
+        if key is not None and cache == 'prefer':
+            # 响应缓存会读写磁盘，放到线程中执行，不阻塞事件循环
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                return cached
+
+        async def request():
+            # 提示词只计费一次，输出按 n 份计
+            cost = estimate_messages_tokens(full) + max_tokens * n
+            completion = await self.limiter.acall(lambda: self._acreate(
+                model=model,
+                messages=upstream,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **({'n': n} if n > 1 else {})
+            ), cost)
+            result = self._completion_result(completion)
+            self.limiter.settle(cost, result['usage'])
+            if key is not None:
+                await asyncio.to_thread(self.cache.set, key, result)
+            return result
+
+        fingerprint = ResponseCache.make_key(model, messages, temperature, max_tokens, n)
+        return await self.inflight.ado(fingerprint, request, fresh)
+
+    def stream_chat(self, messages, model=None, temperature=0.7, max_tokens=2000, fresh=False):
+        """以 stream=True 调用接口，返回事件生成器
+        依次产出 ('delta', 文本片段)，结束时产出 ('done', {'usage': ..., 'finish_reason': ...})
+        相同请求同时进行时共享同一条上游流；上下文缓存引用和提示词长度在调用时即检查，不等到开始迭代
+        """
+        upstream, full = self.context_cache.resolve(messages)
+        model, max_tokens = plan_completion(full, max_tokens, model)
+        cost = estimate_messages_tokens(full) + max_tokens
+        fingerprint = ResponseCache.make_key(model, messages, temperature, max_tokens)
+        return self.inflight.stream(
+            fingerprint, lambda: self._stream_upstream(upstream, model, temperature, max_tokens, cost), fresh
         )
 
+    def _stream_upstream(self, messages, model, temperature, max_tokens, cost):
+        response = self.limiter.stream(lambda: self._create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True
+        ), cost)
+        usage = None
+        finish_reason = None
+        for chunk in response:
+            delta, chunk_usage, chunk_finish = self._stream_chunk(chunk)
+            if delta:
+                yield 'delta', delta
+            usage = chunk_usage or usage
+            finish_reason = chunk_finish or finish_reason
+        self.limiter.settle(cost, usage)
+        yield 'done', {'usage': usage, 'finish_reason': finish_reason}
+
+    def astream_chat(self, messages, model=None, temperature=0.7, max_tokens=2000, fresh=False):
+        """stream_chat 的异步版本，返回异步生成器"""
+        upstream, full = self.context_cache.resolve(messages)
+        model, max_tokens = plan_completion(full, max_tokens, model)
+        cost = estimate_messages_tokens(full) + max_tokens
+        fingerprint = ResponseCache.make_key(model, messages, temperature, max_tokens)
+        return self.inflight.astream(
+            fingerprint, lambda: self._astream_upstream(upstream, model, temperature, max_tokens, cost), fresh
+        )
+
+    async def _astream_upstream(self, messages, model, temperature, max_tokens, cost):
+        response = self.limiter.astream(lambda: self._acreate(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True
+        ), cost)
+        usage = None
+        finish_reason = None
+        async for chunk in response:
+            delta, chunk_usage, chunk_finish = self._stream_chunk(chunk)
+            if delta:
+                yield 'delta', delta
+            usage = chunk_usage or usage
+            finish_reason = chunk_finish or finish_reason
+        self.limiter.settle(cost, usage)
+        yield 'done', {'usage': usage, 'finish_reason': finish_reason}
+
+    @staticmethod
+    def _needs_continuation(text, finish_reason, min_chars):
+        """输出被长度截断或字数不足时需要续写"""
+        return finish_reason == 'length' or len(text) < min_chars
+
+    def _continuation_messages(self, messages, text):
+        """续写请求：保留原始要求，只附带已生成内容的末尾一段"""
+        return messages + [{"role": "assistant", "content": text[-CONTINUATION_TAIL_CHARS:]}] + self.prompts.render('section.continue')
+
+    def _round(self, send, messages, full, text):
+        """发起长文本生成的一轮，返回 (send 的结果, 之后各轮使用的消息)
+        full 为生成开始时展开引用后的完整消息：生成期间上下文缓存失效（背景或大纲被修改）时，
+        本轮及之后的续写改用它，不再因引用失效而中断
+        """
+        try:
+            return send(self._continuation_messages(messages, text) if text else messages), messages
+        except ContextExpired:
+            if messages is full:
+                raise
+            return send(self._continuation_messages(full, text) if text else full), full
+
+    async def _around(self, send, messages, full, text):
+        """_round 的异步版本，send 返回协程"""
+        try:
+            return await send(self._continuation_messages(messages, text) if text else messages), messages
+        except ContextExpired:
+            if messages is full:
+                raise
+            return await send(self._continuation_messages(full, text) if text else full), full
+
+    @staticmethod
+    def _add_usage(total, usage):
+        if not usage:
+            return total
+        total = dict(total or {})
+        for key in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+            total[key] = total.get(key, 0) + usage.get(key, 0)
+        return total
+
+    def complete_long(self, messages, min_chars, max_tokens, max_rounds=MAX_CONTINUATIONS + 1, text='', fresh=False,
+                      full=None):
+        """生成长文本：单次输出被截断或不足 min_chars 字时自动续写并拼接
+        text: 已生成的开头，给出时直接从续写开始
+        full: messages 展开上下文缓存引用后的完整消息，不给出时在开始时展开一次
+        返回 {'content', 'finish_reason', 'usage', 'rounds'}
+        """
+        full = full or self.context_cache.expand(messages)
+        usage = None
+        finish_reason = None
+        for rounds in range(1, max_rounds + 1):
+            result, messages = self._round(
+                lambda request: self.complete(request, max_tokens=max_tokens, fresh=fresh), messages, full, text
+            )
+            text += result['content']
+            usage = self._add_usage(usage, result['usage'])
+            finish_reason = result['finish_reason']
+            if not result['content'] or not self._needs_continuation(text, finish_reason, min_chars):
+                break
+        return {'content': text, 'finish_reason': finish_reason, 'usage': usage, 'rounds': rounds}
+
+    async def acomplete_long(self, messages, min_chars, max_tokens, max_rounds=MAX_CONTINUATIONS + 1, text='', fresh=False,
+                             full=None):
+        """complete_long 的异步版本"""
+        full = full or self.context_cache.expand(messages)
+        usage = None
+        finish_reason = None
+        for rounds in range(1, max_rounds + 1):
+            result, messages = await self._around(
+                lambda request: self.acomplete(request, max_tokens=max_tokens, fresh=fresh), messages, full, text
+            )
+            text += result['content']
+            usage = self._add_usage(usage, result['usage'])
+            finish_reason = result['finish_reason']
+            if not result['content'] or not self._needs_continuation(text, finish_reason, min_chars):
+                break
+        return {'content': text, 'finish_reason': finish_reason, 'usage': usage, 'rounds': rounds}
+
+    def _pending_candidates(self, result, min_chars):
+        """返回 (各候选正文, 需要续写的候选序号)，min_chars 为 0 时不续写"""
+        choices = result.get('choices') or [{'content': result['content'], 'finish_reason': result['finish_reason']}]
+        contents = [choice['content'] or '' for choice in choices]
+        if not min_chars:
+            return contents, []
+        pending = [
+            index for index, choice in enumerate(choices)
+            if contents[index] and self._needs_continuation(contents[index], choice['finish_reason'], min_chars)
+        ]
+        return contents, pending
+
+    def complete_candidates(self, messages, n, min_chars=0, max_tokens=2000, temperature=0.7):
+        """一次请求（参数 n）生成 n 个候选，被截断或不足 min_chars 字的候选并发续写（续写提示词针对小节正文）
+        返回 {'candidates': [正文, ...], 'usage'}，候选按上游返回的顺序排列
+        """
+        full = self.context_cache.expand(messages)
+        result = self.complete(messages, temperature=temperature, max_tokens=max_tokens, n=n)
+        contents, pending = self._pending_candidates(result, min_chars)
+        usage = result['usage']
+        if pending:
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                futures = {
+                    index: executor.submit(
+                        self.complete_long, messages, min_chars, max_tokens, MAX_CONTINUATIONS, contents[index], full=full
+                    )
+                    for index in pending
+                }
+                for index, future in futures.items():
+                    continued = future.result()
+                    contents[index] = continued['content']
+                    usage = self._add_usage(usage, continued['usage'])
+        return {'candidates': contents, 'usage': usage}
+
+    async def acomplete_candidates(self, messages, n, min_chars=0, max_tokens=2000, temperature=0.7):
+        """complete_candidates 的异步版本，续写用 asyncio.gather 并发"""
+        full = self.context_cache.expand(messages)
+        result = await self.acomplete(messages, temperature=temperature, max_tokens=max_tokens, n=n)
+        contents, pending = self._pending_candidates(result, min_chars)
+        usage = result['usage']
+        continued = await asyncio.gather(*[
+            self.acomplete_long(messages, min_chars, max_tokens, MAX_CONTINUATIONS, contents[index], full=full)
+            for index in pending
+        ])
+        for index, item in zip(pending, continued):
+            contents[index] = item['content']
+            usage = self._add_usage(usage, item['usage'])
+        return {'candidates': contents, 'usage': usage}
+
+    def stream_long(self, messages, min_chars, max_tokens, max_rounds=MAX_CONTINUATIONS + 1, fresh=False):
+        """流式生成长文本，续写的内容接在同一个流中
+        结束时产出 ('done', {'usage', 'finish_reason', 'rounds'})
+        """
+        full = self.context_cache.expand(messages)
+        text = ''
+        usage = None
+        for rounds in range(1, max_rounds + 1):
+            events, messages = self._round(
+                lambda request: self.stream_chat(request, max_tokens=max_tokens, fresh=fresh), messages, full, text
+            )
+            produced = 0
+            for kind, payload in events:
+                if kind == 'delta':
+                    text += payload
+                    produced += len(payload)
+                    yield kind, payload
+                else:
+                    usage = self._add_usage(usage, payload['usage'])
+                    finish_reason = payload['finish_reason']
+            if not produced or not self._needs_continuation(text, finish_reason, min_chars):
+                break
+        yield 'done', {'usage': usage, 'finish_reason': finish_reason, 'rounds': rounds}
+
+    async def astream_long(self, messages, min_chars, max_tokens, max_rounds=MAX_CONTINUATIONS + 1, fresh=False):
+        """stream_long 的异步版本"""
+        full = self.context_cache.expand(messages)
+        text = ''
+        usage = None
+        for rounds in range(1, max_rounds + 1):
+            events, messages = self._round(
+                lambda request: self.astream_chat(request, max_tokens=max_tokens, fresh=fresh), messages, full, text
+            )
+            produced = 0
+            async for kind, payload in events:
+                if kind == 'delta':
+                    text += payload
+                    produced += len(payload)
+                    yield kind, payload
+                else:
+                    usage = self._add_usage(usage, payload['usage'])
+                    finish_reason = payload['finish_reason']
+            if not produced or not self._needs_continuation(text, finish_reason, min_chars):
+                break
+        yield 'done', {'usage': usage, 'finish_reason': finish_reason, 'rounds': rounds}
+
+    def summarize_section(self, content):
+        """把一节正文压缩成简短概要，并提取出场人物的当前状态"""
+        result = self.complete(self.prompts.render('section.summarize', content=content), temperature=0.3, max_tokens=500)
+        return parse_section_memory(result['content'])
+
+    def update_story_progress(self, session_id, chapter_number, content, section_number=1):
+        """更新故事进度：把新完成的小节压缩为概要，并更新人物状态"""
+        if self.storage.get_story_context(session_id) is None:
+            # 没有保存大纲、也没有调用 /initialize_story 的会话，在首次整理时创建
+            outline = self.get_outline(session_id) or {}
+            self.ensure_story_context(session_id, outline.get('title'), outline.get('genre'), outline.get('background'))
+
+        try:
+            summary, characters = self.summarize_section(content)
+        except Exception:
+            # 整理失败时退化为截取开头，保证后续小节仍有前情可用
+            summary, characters = content[:200], {}
+
+        def update(context):
+            # 更新章节概要（经过存储序列化后键为字符串，这里统一使用字符串）
+            chapter = context['chapter_summaries'].setdefault(str(chapter_number), {'sections': {}})
+            chapter['sections'][str(section_number)] = summary
+            chapter['content'] = ''.join(chapter['sections'][key] for key in sorted(chapter['sections'], key=int))
+            chapter['timestamp'] = datetime.now()
+
+            for name, state in characters.items():
+                context['characters'][name] = {
+                    'state': state,
+                    'last_seen': [chapter_number, section_number]
+                }
+            
+            # 更新总章节数
+            context['total_chapters'] = max(context['total_chapters'], chapter_number)
+
+        self.storage.update_story_context(session_id, update)
+
+    def story_memory(self, session_id, chapter_number, section_number, outline='', budget=MEMORY_TOKEN_BUDGET):
+        """为即将生成的小节组装前情提要，总长度控制在 budget 个 token 以内
+
+        最近的小节使用逐节概要，更早的章节使用章节概要，人物状态放在最前面，从近到远填充直到预算用完。
+        outline: 本节大纲，给出时从一致性索引中取出大纲提到的人物、地点的既有描写和相关伏笔，放在人物状态之后。
+        """
+        context = self.storage.get_story_context(session_id) or {}
+        current = (int(chapter_number), int(section_number))
+        facts = consistency.relevant_facts(self.storage.get_consistency_index(session_id), outline, current)
+        if not context and not facts:
+            return ''
+
+        earlier = []
+        for chapter_key, chapter in context.get('chapter_summaries', {}).items():
+            for section_key, summary in chapter.get('sections', {}).items():
+                position = (int(chapter_key), int(section_key))
+                if position < current:
+                    earlier.append((position, summary))
+        earlier.sort()
+
+        lines = []
+        recent = earlier[-RECENT_SECTIONS:]
+        for (chapter, section), summary in reversed(recent):
+            lines.append(f"第{chapter}章第{section}节：{summary}")
+        recent_chapters = {chapter for (chapter, _), _ in recent}
+        older_chapters = sorted({chapter for (chapter, _), _ in earlier} - recent_chapters, reverse=True)
+        for chapter in older_chapters:
+            lines.append(f"第{chapter}章：{context['chapter_summaries'][str(chapter)]['content']}")
+
+        character_lines = [f"{name}：{info['state']}" for name, info in context.get('characters', {}).items()]
+
+        used = 0
+        kept_characters = []
+        for line in character_lines:
+            if used + estimate_tokens(line) > budget // 3:
+                break
+            kept_characters.append(line)
+            used += estimate_tokens(line)
+        kept_facts = []
+        for line in facts:
+            if used + estimate_tokens(line) > 2 * budget // 3:
+                break
+            kept_facts.append(line)
+            used += estimate_tokens(line)
+        kept_plot = []
+        for line in lines:
+            if used + estimate_tokens(line) > budget:
+                break
+            kept_plot.append(line)
+            used += estimate_tokens(line)
+
+        parts = []
+        if kept_characters:
+            parts.append("人物现状：\n" + '\n'.join(kept_characters))
+        if kept_facts:
+            parts.append("相关设定：\n" + '\n'.join(kept_facts))
+        if kept_plot:
+            parts.append("此前情节：\n" + '\n'.join(reversed(kept_plot)))
+        return '\n'.join(parts)
+
+    def index_section(self, session_id, chapter_number, section_number, content):
+        """把一节正文的人物、地点、伏笔记入一致性索引（本地提取，不调用接口），返回更新后的索引
+        故事上下文存在时，其中的 plot_lines 同步为尚无下文的伏笔
+        """
+        index = self.storage.get_consistency_index(session_id) or {}
+        context = self.storage.get_story_context(session_id) or {}
+        vocabulary = dict(index.get('terms', {}))
+        vocabulary.update({name: 'character' for name in context.get('characters', {})})
+        extracted = consistency.extract(content, vocabulary)
+        index = self.storage.update_consistency_index(
+            session_id, lambda index: consistency.apply_section(index, chapter_number, section_number, extracted)
+        )
+        if context:
+            clues = consistency.open_clues(index)
+            self.storage.update_story_context(session_id, lambda context: context.update(plot_lines=clues))
+        return index
+
+    def consistency_index(self, session_id):
+        """返回会话的一致性索引；此前保存的小节尚未建立索引时按已保存的正文重建"""
+        index = self.storage.get_consistency_index(session_id)
+        if index is not None:
+            return index
+        index = consistency.empty_index()
+        for chapter_number, section_number, section in self.storage.iter_sections(session_id):
+            index = self.index_section(session_id, chapter_number, section_number, section['content'])
+        return index
+
+    def consistency_report(self, session_id):
+        """扫描一致性索引生成报告，不调用接口"""
+        outline = self.get_outline(session_id) or {}
+        return consistency.report(self.consistency_index(session_id), outline.get('chapters'))
+
     def get_story_status(self, session_id):
         """获取当前故事的状态信息"""
-        if session_id not in self.story_context:
+        context = self.storage.get_story_context(session_id)
+        if context is None:
             return None
         
-        context = self.story_context[session_id]
         return {
             'total_chapters': context['total_chapters'],
-            'completed_sections': len(context['chapter_summaries']),
+            'completed_sections': sum(len(chapter.get('sections', {})) for chapter in context['chapter_summaries'].values()),
             'structure_analysis': context.get('structure_analysis', ''),
             'plot_lines': context['plot_lines']
         }
     
     def get_progress(self, session_id):
-        return self.current_progress.get(session_id, {})
+        return self.storage.get_progress(session_id)
     
-    def set_progress(self, session_id, stage, content):
-        if session_id not in self.current_progress:
-            self.current_progress[session_id] = {
-                'stage': stage,
-                'content': content,
-                'timestamp': datetime.now()
-            }
-        else:
-            self.current_progress[session_id].update({
-                'stage': stage,
-                'content': content,
-                'timestamp': datetime.now()
-            })
+    def set_progress(self, session_id, stage, content, **extra):
+        self.storage.update_progress(session_id, {
+            'stage': stage,
+            'content': content,
+            'timestamp': datetime.now(),
+            **extra
+        })
+
+    def set_batch_progress(self, session_id, batch):
+        """记录批量任务状态，不改变大纲生成的 stage 和 content"""
+        self.storage.update_progress(session_id, {'batch': batch})
     
     def get_chapter_sections(self, session_id, chapter_number):
-        return self.chapters.get(session_id, {}).get(chapter_number, [])
-    
-    def save_section(self, session_id, chapter_number, section_number, title, content):
-        if session_id not in self.chapters:
-            self.chapters[session_id] = {}
-        if chapter_number not in self.chapters[session_id]:
-            self.chapters[session_id][chapter_number] = []
-        
-        # 确保小节列表有足够的空间
-        while len(self.chapters[session_id][chapter_number]) < section_number:
-            self.chapters[session_id][chapter_number].append(None)
-        
-        self.chapters[session_id][chapter_number][section_number - 1] = {
-            'title': title,
-            'content': content
+        return self.storage.get_chapter_sections(session_id, chapter_number)
+
+    def get_outline(self, session_id):
+        return self.storage.get_outline(session_id)
+
+    def save_outline(self, session_id, text='', merge=False, **fields):
+        """解析大纲文本并按 session_id 保存为章节树
+        merge: 为 True 时与已保存的章节合并（分阶段生成时使用），否则整体替换章节
+        fields: 可同时保存 title、genre、background，未提供的沿用已保存的值
+        """
+        outline = self.storage.get_outline(session_id) or {'chapters': []}
+        chapters = parse_outline(text) if text else []
+        outline['chapters'] = merge_chapters(outline['chapters'], chapters) if merge else chapters
+        outline.update({key: value for key, value in fields.items() if value})
+        self.storage.save_outline(session_id, outline)
+        # 生成或保存大纲即开始记录故事记忆，之后各节的概要和人物状态写入其中
+        self.ensure_story_context(session_id, outline.get('title'), outline.get('genre'), outline.get('background'))
+        self.context_cache.invalidate(self.api_key, session_id)
+        self.prefetcher.discard(session_id)
+        return outline
+
+    def replace_background(self, session_id, background):
+        """用修改后的背景替换会话中保存的背景，旧背景的上下文缓存随之失效"""
+        # save_outline 同时更新故事上下文中的背景
+        self.save_outline(session_id, merge=True, background=background)
+        if self.get_progress(session_id).get('stage') == 'complete':
+            self.set_progress(session_id, 'complete', background)
+
+    def fill_section_request(self, data):
+        """用已保存的大纲补全小节生成请求中省略的字段
+
+        只需提供 session_id、chapter_number、section_number，标题、类型、章节名、背景
+        以及只与本节相关的大纲片段都从服务端取得。请求中显式给出的字段优先。
+        chapter_number、section_number 转换为整数，不是正整数时抛出 ValueError。
+        """
+        filled = dict(data)
+        for field in ('chapter_number', 'section_number'):
+            if data.get(field) not in (None, ''):
+                filled[field] = positive_int(data[field], field)
+        session_id = filled.get('session_id')
+        outline = self.get_outline(session_id) if session_id else None
+        if not outline or not filled.get('chapter_number') or not filled.get('section_number'):
+            return filled
+
+        chapter, section = find_section(outline['chapters'], filled['chapter_number'], filled['section_number'])
+        defaults = {
+            'title': outline.get('title'),
+            'genre': outline.get('genre'),
+            'background': outline.get('background') or self.get_progress(session_id).get('content'),
         }
+        if section is not None:
+            defaults['chapter_title'] = chapter_heading(chapter)
+            defaults['outline'] = outline_slice(outline['chapters'], filled['chapter_number'], filled['section_number'])
+        for key, value in defaults.items():
+            if not filled.get(key):
+                filled[key] = value
+        return filled
     
-    def export_novel(self, session_id, format='txt'):
-        """导出小说全文
-        format: 'txt' 或 'docx'
+    def save_section(self, session_id, chapter_number, section_number, title, content, prefetch=False):
+        """保存小节并返回版本号
+        prefetch: 为 True 时在本节整理进故事记忆后开始预生成大纲中的下一节
+        """
+        version = self.storage.save_section(session_id, chapter_number, section_number, title, content)
+        self.index_section(session_id, chapter_number, section_number, content)
+        # 已有的预生成基于旧的前情，不再可用
+        self.prefetcher.discard(session_id)
+        # 在后台把这一节整理进故事记忆，供后续小节使用
+        future = memory_executor.submit(self.update_story_progress, session_id, chapter_number, content, section_number)
+        if prefetch:
+            future.add_done_callback(lambda _: self.prefetcher.schedule(session_id, chapter_number, section_number))
+        return version
+
+    def edit_section(self, session_id, chapter_number, section_number, edits, base_version=None, title=None):
+        """以编辑列表修改已保存的小节，只传输和保存改动的部分，返回 {'version', 'length'}"""
+        result = self.storage.edit_section(session_id, chapter_number, section_number, edits, base_version, title)
+        section = self.get_section(session_id, chapter_number, section_number)
+        if section is not None:
+            self.index_section(session_id, chapter_number, section_number, section['content'])
+        return result
+
+    def get_section(self, session_id, chapter_number, section_number, version=None):
+        return self.storage.get_section(session_id, chapter_number, section_number, version)
+
+    def section_history(self, session_id, chapter_number, section_number):
+        return self.storage.section_history(session_id, chapter_number, section_number)
+    
+    def iter_export(self, session_id, format='txt'):
+        """逐块产出导出内容，内存占用与全书长度无关
+        format: 'txt' 产出字符串；'docx' / 'epub' 产出字节
         """
-        content = []
         background = self.get_progress(session_id).get('content', '')
-        content.append("# 小说背景\n")
-        content.append(background)
-        content.append("\n\n# 正文\n")
-        
-        for chapter_num in sorted(self.chapters.get(session_id, {}).keys()):
-            sections = self.chapters[session_id][chapter_num]
-            for section_num, section in enumerate(sections, 1):
-                if section:
-                    content.append(f"\n## 第{chapter_num}章 第{section_num}节 {section['title']}\n")
-                    content.append(section['content'])
+        sections = self.storage.iter_sections(session_id)
+        if format in ('docx', 'epub'):
+            context = self.storage.get_story_context(session_id) or {}
+            title = context.get('title') or session_id
+            exporter = iter_docx if format == 'docx' else iter_epub
+            yield from exporter(title, background, sections)
+            return
+        if format != 'txt':
+            raise ValueError(f"不支持的导出格式：{format}")
+
+        # 各段之间以换行分隔，与原先 '\n'.join 的结果一致
+        yield "# 小说背景\n"
+        yield "\n" + background
+        yield "\n\n\n# 正文\n"
         
+        for chapter_num, section_num, section in sections:
+            yield f"\n\n## 第{chapter_num}章 第{section_num}节 {section['title']}\n"
+            yield "\n" + section['content']
+
+    def export_novel(self, session_id, format='txt'):
+        """导出小说全文
+        format: 'txt' 返回字符串；'docx' 或 'epub' 返回文件字节
+        """
         if format == 'txt':
-            return '\n'.join(content)
-        elif format == 'docx':
-            # TODO: 实现docx格式导出
-            raise NotImplementedError("DOCX format not implemented yet")
+            return ''.join(self.iter_export(session_id))
+        if format in ('docx', 'epub'):
+            return b''.join(self.iter_export(session_id, format))
         
         return None
 
-# 创建全局的写手实例
-writer = None
+def sse_event(event, data):
+    """格式化一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_response(events):
+    """把事件生成器包装为 text/event-stream 响应"""
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def candidate_count(data):
+    """请求的候选数，缺省为 1，超出范围时抛出 ValueError"""
+    try:
+        count = int(data.get('candidates') or 1)
+    except (TypeError, ValueError):
+        raise ValueError("candidates 应为整数")
+    if not 1 <= count <= MAX_CANDIDATES:
+        raise ValueError(f"candidates 应在 1 到 {MAX_CANDIDATES} 之间")
+    return count
+
+def candidates_payload(result, reference, target_chars):
+    """多候选接口的返回：content 为得分最高的候选，candidates 为排序后的全部候选"""
+    ranked = rank(result['candidates'], reference, target_chars)
+    return {"status": "success", "content": ranked[0]['content'], "candidates": ranked, "usage": result['usage']}
+
+# 上游限流且重试后仍失败时，建议客户端等待的默认秒数
+DEFAULT_RETRY_AFTER = 10
+
+def error_payload(e):
+    """把异常整理为接口返回的错误信息，上游限流时附带 code 和 retry_after"""
+    if isinstance(e, openai.error.RateLimitError):
+        if is_quota_exhausted(e):
+            return {"status": "error", "code": "quota_exceeded", "message": "API 额度已用完，请检查账户余额"}
+        return {
+            "status": "error",
+            "code": "rate_limited",
+            "message": "上游接口请求过于频繁，请稍后重试",
+            "retry_after": max(1, int(retry_after(e) or DEFAULT_RETRY_AFTER))
+        }
+    if isinstance(e, VersionConflict):
+        return {"status": "error", "code": "version_conflict", "message": str(e), "current_version": e.current_version}
+    if isinstance(e, JobCancelled):
+        return {"status": "error", "code": "cancelled", "message": str(e), "reason": e.reason}
+    return {"status": "error", "message": str(e)}
+
+def error_response(e):
+    """非流式接口的错误响应，上游限流时返回 429 和 Retry-After"""
+    payload = error_payload(e)
+    if payload.get('code') == 'rate_limited':
+        return jsonify(payload), 429, {'Retry-After': str(payload['retry_after'])}
+    if payload.get('code') == 'quota_exceeded':
+        return jsonify(payload), 429
+    if payload.get('code') == 'version_conflict':
+        return jsonify(payload), 409
+    return jsonify(payload)
+
+# 所有写手共享存储、缓存、提示词模板和上游连接池，按 API Key 隔离
+storage = create_storage()
+response_cache = create_cache()
+http_pool = HTTPClientPool()
+http_pool.install()
+prompt_registry = create_registry()
+context_cache = create_context_cache(http_pool)
+writers = WriterRegistry(lambda api_key: NovelWriter(
+    api_key, storage, response_cache, prompts=prompt_registry, context_cache=context_cache
+), storage)
+batch_runner = BatchRunner()
+
+# 缓存和合并的计数已由各组件维护，抓取时读取
+metrics.REGISTRY.register(metrics.Callback(
+    'novel_response_cache_lookups_total', '响应缓存查询次数', 'counter',
+    lambda: [({'result': name}, response_cache.stats()[name]) for name in ('memory_hits', 'disk_hits', 'misses')]
+))
+metrics.REGISTRY.register(metrics.Callback(
+    'novel_context_cache_references_total', '以上下文缓存引用代替完整前缀的请求数', 'counter',
+    lambda: context_cache.stats()['references']
+))
+metrics.REGISTRY.register(metrics.Callback(
+    'novel_context_cache_tokens_total', '以上下文缓存引用代替的输入 token 数', 'counter',
+    lambda: context_cache.stats()['cached_tokens']
+))
+metrics.REGISTRY.register(metrics.Callback(
+    'novel_storage_sessions', '存储中的会话数（内存存储只计内存中的会话）', 'gauge',
+    lambda: storage.stats()['sessions']
+))
+metrics.REGISTRY.register(metrics.Callback(
+    'novel_storage_bytes', '存储占用的字节数（内存存储为估算的内存占用，SQLite 为数据库文件大小）', 'gauge',
+    lambda: storage.stats()['bytes']
+))
+metrics.REGISTRY.register(metrics.Callback(
+    'novel_coalesced_requests_total', '被合并到在途请求上的重复请求数', 'counter',
+    lambda: sum(writer.inflight.coalesced for writer in list(writers.writers.values()))
+))
+metrics.REGISTRY.register(metrics.Callback(
+    'novel_jobs_running', '进行中的可取消生成任务数', 'gauge',
+    lambda: sum(len(writer.jobs.running()) for writer in list(writers.writers.values()))
+))
+
+@app.before_request
+def start_request_timer():
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.request_timer = metrics.RequestTimer(rule, request.method)
+
+@app.after_request
+def finish_request_timer(response):
+    timer = g.pop('request_timer', None)
+    if timer is not None:
+        # 流式响应在连接关闭时才算结束
+        response.call_on_close(lambda: timer.finish(response.status_code))
+    job = g.pop('job', None)
+    if job is not None:
+        response.headers['X-Job-Id'] = job.job_id
+        response.call_on_close(job.finish)
+    return response
+
+def get_writer(data):
+    """根据请求中的 client_id 找到对应的写手"""
+    return writers.get(data.get('client_id'))
 
 @app.route('/')
 def index():
@@ -213,20 +1135,20 @@ def index():
 
 @app.route('/set_api_key', methods=['POST'])
 def set_api_key():
-    global writer
     api_key = request.json.get('api_key')
     try:
-        writer = NovelWriter(api_key)
-        return jsonify({"status": "success"})
+        client_id = writers.register(api_key)
+        return jsonify({"status": "success", "client_id": client_id})
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return error_response(e)
 
 @app.route('/generate_outline_part', methods=['POST'])
 def generate_outline_part():
+    data = request.json
+    writer = get_writer(data)
     if not writer:
         return jsonify({"status": "error", "message": "请先设置 API Key"})
     
-    data = request.json
     title = data.get('title')
     genre = data.get('genre', '')
     session_id = data.get('session_id')
@@ -235,123 +1157,59 @@ def generate_outline_part():
     if not all([title, session_id]):
         return jsonify({"status": "error", "message": "缺少必要的参数"})
 
+    if stage not in OUTLINE_STAGES:
+        return jsonify({"status": "error", "message": f"未知的大纲阶段：{stage}"})
+
     try:
-        # 根据不同阶段生成内容
+        content = writer.generate_outline_stage(title, genre, stage, data.get('cache'))
         if stage == 'background':
-            # 生成背景和人物设定
-            background_prompt = f"""请为{genre}小说《{title}》创作背景设定和人物介绍。
-要求：
-1. 详细的故事背景设定（至少500字）
-2. 主要人物介绍（包括性格特点和人物关系，每个主要人物至少200字）
-3. 列出3个重要的故事转折点，并说明这些转折点分别发生在第几章
-4. 【重要】故事结构按照"序章-发展-高潮-结局"四个阶段展开，每个阶段3-4章
-格式：
-- 故事背景：
-- 主要人物：
-- 重要转折点：
-- 故事结构规划："""
-
-            completion = openai.ChatCompletion.create(
-                model="moonshot-v1-8k",
-                messages=[
-                    {"role": "system", "content": "你是一个专业的小说策划，专注于创作背景设定和人物塑造。"},
-                    {"role": "user", "content": background_prompt}
-                ],
-                temperature=0.7,
-                max_tokens=2000
-            )
-            content = completion.choices[0].message.content
-            return jsonify({"status": "success", "content": content, "next_stage": "part1"})
-
-        elif stage == 'part1':
-            # 生成第1-6章
-            outline_first_prompt = f"""请为{genre}小说《{title}》创作第1章到第6章的详细大纲。这是小说的序章和发展阶段。
-要求：
-1. 必须生成1-6章的内容，每章4-5节
-2. 每节提供300-500字的详细内容概要
-3. 按照以下格式输出：
-第1章 序章名
-  第1节 节标题：（详细概要）
-  第2节 节标题：（详细概要）
-  ...（确保每章至少4节）
-第2章 章节名
-  ...（以此类推直到第6章）"""
-
-            completion = openai.ChatCompletion.create(
-                model="moonshot-v1-8k",
-                messages=[
-                    {"role": "system", "content": "你是一个专业的小说策划，专注于创作详细的章节大纲。"},
-                    {"role": "user", "content": outline_first_prompt}
-                ],
-                temperature=0.7,
-                max_tokens=2000
-            )
-            content = completion.choices[0].message.content
-            return jsonify({"status": "success", "content": content, "next_stage": "part2"})
-
-        elif stage == 'part2':
-            # 生成第7-12章
-            outline_second_prompt = f"""请为{genre}小说《{title}》创作第7章到第12章的详细大纲。这是小说的高潮和高潮延续阶段。
-要求：
-1. 必须生成7-12章的内容，每章4-5节
-2. 每节提供300-500字的详细内容概要
-3. 确保情节连贯
-4. 按照以下格式输出：
-第7章 章节名
-  第1节 节标题：（详细概要）
-  第2节 节标题：（详细概要）
-  ...（确保每章至少4节）
-第8章 章节名
-  ...（以此类推直到第12章）"""
-
-            completion = openai.ChatCompletion.create(
-                model="moonshot-v1-8k",
-                messages=[
-                    {"role": "system", "content": "你是一个专业的小说策划，专注于创作详细的章节大纲。"},
-                    {"role": "user", "content": outline_second_prompt}
-                ],
-                temperature=0.7,
-                max_tokens=2000
-            )
-            content = completion.choices[0].message.content
-            return jsonify({"status": "success", "content": content, "next_stage": "part3"})
-
-        elif stage == 'part3':
-            # 生成第13-15章
-            outline_third_prompt = f"""请为{genre}小说《{title}》创作第13章到第15章的详细大纲。这是小说的结局阶段。
-要求：
-1. 必须生成13-15章的内容，每章4-5节
-2. 每节提供300-500字的详细内容概要
-3. 确保完整的故事闭环，所有伏笔和情节都得到合理的解决
-4. 按照以下格式输出：
-第13章 章节名
-  第1节 节标题：（详细概要）
-  第2节 节标题：（详细概要）
-  ...（确保每章至少4节）
-第14章 章节名
-  ...（以此类推直到第15章）"""
-
-            completion = openai.ChatCompletion.create(
-                model="moonshot-v1-8k",
-                messages=[
-                    {"role": "system", "content": "你是一个专业的小说策划，专注于创作详细的章节大纲。"},
-                    {"role": "user", "content": outline_third_prompt}
-                ],
-                temperature=0.7,
-                max_tokens=2000
-            )
-            content = completion.choices[0].message.content
-            return jsonify({"status": "success", "content": content, "next_stage": "complete"})
+            writer.save_outline(session_id, merge=True, title=title, genre=genre, background=content)
+        else:
+            writer.save_outline(session_id, content, merge=True, title=title, genre=genre)
+        return jsonify({"status": "success", "content": content, "next_stage": OUTLINE_STAGES[stage]['next_stage']})
 
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return error_response(e)
+
+@app.route('/generate_outline', methods=['POST'])
+def generate_outline():
+    """一次性生成完整大纲：背景完成后并发生成第1-6、7-12、13-15章"""
+    data = request.json
+    writer = get_writer(data)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    title = data.get('title')
+    genre = data.get('genre', '')
+    session_id = data.get('session_id')
+
+    if not all([title, session_id]):
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+
+    try:
+        results = writer.generate_full_outline(title, genre, data.get('cache'))
+        background = results['background']
+        parts = [results[stage] for stage in OUTLINE_STAGES if stage != 'background']
+        writer.set_progress(session_id, 'complete', background)
+        outline = writer.save_outline(session_id, '\n'.join(parts), title=title, genre=genre, background=background)
+        return jsonify({
+            "status": "success",
+            "content": '\n\n'.join([background] + parts),
+            "background": background,
+            "outline": '\n\n'.join(parts),
+            "chapters": outline['chapters'],
+            "next_stage": "complete"
+        })
+    except Exception as e:
+        return error_response(e)
 
 @app.route('/generate_content', methods=['POST'])
 def generate_content():
+    data = request.json
+    writer = get_writer(data)
     if not writer:
         return jsonify({"status": "error", "message": "请先设置 API Key"})
     
-    data = request.json
     title = data.get('title')
     chapter_title = data.get('chapter_title')
     section_title = data.get('section_title')
@@ -361,54 +1219,60 @@ def generate_content():
     if not all([title, chapter_title, section_title, outline]):
         return jsonify({"status": "error", "message": "缺少必要的参数"})
     
+    job = g.job = writer.jobs.start('content', job_id=data.get('job_id'))
     try:
-        system_prompt = f"""你是一个专业的{genre}小说写手。请根据提供的信息，创作一节精彩的小说内容。
-要求：
-1. 字数在4000-6000字之间，重要情节可以突破这个限制
-2. 情节要符合大纲设定，注重细节描写
-3. 要有细腻的人物刻画和情感描写
-4. 注意与其他章节的连贯性
-5. 根据{genre}小说的特点，融入相应的元素和细节
-6. 分段落呈现，使用优美的中文写作
-7. 重要场景要放慢节奏，增加细节描写
-8. 对话要自然，符合人物身份和性格
-9. 注重环境和氛围的营造
-10. 适当运用各种写作手法，如白描、细描、心理描写等"""
-
-        content_prompt = f"""请根据以下信息创作小说内容：
-小说名：《{title}》
-类型：{genre}
-章节名：{chapter_title}
-小节名：{section_title}
-故事大纲：{outline}
-
-要求：
-1. 创作长度至少4000字，重要情节可以更长
-2. 场景细节要丰富
-3. 人物对话要生动
-4. 确保与整体故事情节连贯"""
-
-        completion = openai.ChatCompletion.create(
-            model="moonshot-v1-8k",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": content_prompt}
-            ],
-            temperature=0.7,
-            max_tokens=8000
-        )
-        content = completion.choices[0].message.content
+        messages = writer._content_messages(title, genre, chapter_title, section_title, outline)
+        candidates = candidate_count(data)
+
+        if candidates > 1:
+            # 一次请求生成多个候选，按字数、大纲关键词覆盖率和重复率排序后一并返回（不支持流式）
+            result = writer.complete_candidates(messages, candidates, CONTENT_MIN_CHARS, CONTENT_MAX_TOKENS)
+            job.check()
+            return jsonify(candidates_payload(
+                result, '\n'.join([chapter_title, section_title, outline]), CONTENT_MIN_CHARS
+            ))
+
+        if data.get('stream'):
+            def events():
+                parts = []
+                yield sse_event('job', {"job_id": job.job_id})
+                try:
+                    for kind, payload in job.guard(writer.stream_long(messages, CONTENT_MIN_CHARS, CONTENT_MAX_TOKENS)):
+                        if kind == 'delta':
+                            parts.append(payload)
+                            yield sse_event('delta', {"content": payload})
+                        else:
+                            yield sse_event('done', {
+                                "status": "success",
+                                "content": ''.join(parts),
+                                "usage": payload['usage'],
+                                "finish_reason": payload['finish_reason'],
+                                "rounds": payload['rounds']
+                            })
+                except Exception as e:
+                    yield sse_event('error', error_payload(e))
+            return sse_response(events())
+
+        # 以流式读取上游，任务被取消时可以中途断开
+        content, _ = job.collect(writer.stream_long(messages, CONTENT_MIN_CHARS, CONTENT_MAX_TOKENS))
         return jsonify({"status": "success", "content": content})
     
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return error_response(e)
 
 @app.route('/generate_section', methods=['POST'])
 def generate_section():
+    data = request.json
+    writer = get_writer(data)
     if not writer:
         return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    # 已保存大纲时只需传 session_id、chapter_number、section_number
+    try:
+        data = writer.fill_section_request(data)
+    except Exception as e:
+        return error_response(e)
     
-    data = request.json
     title = data.get('title')
     genre = data.get('genre')
     chapter_title = data.get('chapter_title')
@@ -421,22 +1285,295 @@ def generate_section():
     if not all([title, genre, chapter_title, chapter_number, section_number, session_id, background, outline]):
         return jsonify({"status": "error", "message": "缺少必要的参数"})
     
+    # 同一小节的新请求取代仍在进行的旧请求（重新生成）
+    job = g.job = writer.jobs.start(
+        'section', session_id, (str(chapter_number), str(section_number)), data.get('job_id')
+    )
+    # 后台已预生成（或正在预生成）这一节且输入一致时直接使用
+    speculation = writer.prefetcher.take(session_id, chapter_number, section_number, data)
+    prefetch = prefetch_enabled(data)
+
+    def section_events():
+        if speculation is not None:
+            return speculation.follow()
+        memory = writer.story_memory(session_id, chapter_number, section_number, outline)
+        # 取代了进行中的旧请求时，不合并到旧请求的上游调用上，确保重新生成
+        return writer.stream_section(
+            title, genre, chapter_title, section_number, background, outline, memory, session_id, fresh=job.superseded
+        )
+
+    if data.get('stream'):
+        def events():
+            parts = []
+            yield sse_event('job', {"job_id": job.job_id})
+            try:
+                for kind, payload in job.guard(section_events()):
+                    if kind == 'delta':
+                        parts.append(payload)
+                        yield sse_event('delta', {"content": payload})
+                        continue
+                    content = ''.join(parts)
+                    version = writer.save_section(
+                        session_id, chapter_number, section_number, chapter_title, content, prefetch=prefetch
+                    )
+                    yield sse_event('done', {
+                        "status": "success",
+                        "usage": payload['usage'],
+                        "finish_reason": payload['finish_reason'],
+                        "rounds": payload['rounds'],
+                        "prefetched": speculation is not None,
+                        "section": {
+                            "chapter_number": chapter_number,
+                            "section_number": section_number,
+                            "title": chapter_title,
+                            "content": content,
+                            "version": version
+                        }
+                    })
+            except Exception as e:
+                yield sse_event('error', error_payload(e))
+        return sse_response(events())
+
     try:
-        content = writer.generate_section(title, genre, chapter_title, section_number, background, outline)
-        writer.save_section(session_id, chapter_number, section_number, chapter_title, content)
+        # 以流式读取上游，任务被取消时可以中途断开
+        content, _ = job.collect(section_events())
+        version = writer.save_section(session_id, chapter_number, section_number, chapter_title, content, prefetch=prefetch)
         return jsonify({
             "status": "success",
-            "content": content
+            "content": content,
+            "version": version,
+            "prefetched": speculation is not None
         })
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return error_response(e)
+
+@app.route('/edit_section', methods=['POST'])
+def edit_section():
+    """提交对已保存小节的修改：edits 为 [{"start", "end", "text"}]，偏移量基于 base_version 对应的正文"""
+    data = request.json
+    writer = get_writer(data)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    session_id = data.get('session_id')
+    chapter_number = data.get('chapter_number')
+    section_number = data.get('section_number')
+    edits = data.get('edits')
+
+    if not all([session_id, chapter_number, section_number, edits]):
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+
+    base_version = data.get('base_version')
+    if base_version not in (None, ''):
+        try:
+            base_version = int(base_version)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "base_version 应为整数"})
+    else:
+        base_version = None
+
+    try:
+        result = writer.edit_section(
+            session_id, chapter_number, section_number, edits, base_version, data.get('title')
+        )
+        return jsonify({"status": "success", **result})
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/get_section', methods=['POST'])
+def get_section():
+    """读取小节的当前版本或指定的历史版本（version），history 为真时同时返回版本列表"""
+    data = request.json
+    writer = get_writer(data)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    session_id = data.get('session_id')
+    chapter_number = data.get('chapter_number')
+    section_number = data.get('section_number')
+
+    if not all([session_id, chapter_number, section_number]):
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+
+    version = data.get('version')
+    if version not in (None, ''):
+        try:
+            version = int(version)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "version 应为整数"})
+    else:
+        version = None
+
+    try:
+        section = writer.get_section(session_id, chapter_number, section_number, version)
+        if section is None:
+            return jsonify({"status": "error", "message": "未找到小节"})
+        if data.get('history'):
+            section['history'] = writer.section_history(session_id, chapter_number, section_number)
+        return jsonify({"status": "success", "data": section})
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/save_outline', methods=['POST'])
+def save_outline():
+    """保存（用户修改后的）大纲文本，解析为章节树"""
+    data = request.json
+    writer = get_writer(data)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    session_id = data.get('session_id')
+    text = data.get('outline')
+
+    if not all([session_id, text]):
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+
+    try:
+        outline = writer.save_outline(
+            session_id, text,
+            title=data.get('title'), genre=data.get('genre'), background=data.get('background')
+        )
+        return jsonify({"status": "success", "data": outline})
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/get_outline', methods=['POST'])
+def get_outline():
+    data = request.json
+    writer = get_writer(data)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    session_id = data.get('session_id')
+    if not session_id:
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+
+    outline = writer.get_outline(session_id)
+    if not outline:
+        return jsonify({"status": "error", "message": "未找到大纲"})
+    return jsonify({"status": "success", "data": outline})
+
+@app.route('/batch_generate', methods=['POST'])
+def batch_generate():
+    """提交整本书的小节批量生成任务"""
+    data = request.json
+    writer = get_writer(data)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    title = data.get('title')
+    genre = data.get('genre')
+    session_id = data.get('session_id')
+    background = data.get('background')
+    sections = data.get('sections')
+    concurrency = data.get('concurrency')
+
+    # 未提交小节列表时使用已保存的大纲
+    outline = writer.get_outline(session_id) if session_id else None
+    if outline:
+        title = title or outline.get('title')
+        genre = genre or outline.get('genre')
+        background = background or outline.get('background')
+        if not sections:
+            sections = [{
+                'chapter_number': chapter['number'],
+                'chapter_title': chapter_heading(chapter),
+                'section_number': section['number'],
+                'outline': outline_slice(outline['chapters'], chapter['number'], section['number'])
+            } for chapter, section in iter_outline_sections(outline['chapters'])]
+
+    if not all([title, genre, session_id, background, sections]):
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+
+    required = ('chapter_number', 'chapter_title', 'section_number', 'outline')
+    if not isinstance(sections, list) or not all(
+        isinstance(section, dict) and all(section.get(key) for key in required) for section in sections
+    ):
+        return jsonify({"status": "error", "message": "小节信息不完整"})
+
+    try:
+        # 与 /generate_section 相同的校验，批量任务中按整数比较和保存
+        sections = [
+            dict(section, **{field: positive_int(section[field], field) for field in ('chapter_number', 'section_number')})
+            for section in sections
+        ]
+        book = {'title': title, 'genre': genre, 'background': background}
+        job = batch_runner.submit(writer, session_id, book, sections, concurrency)
+        return jsonify({"status": "success", "job_id": job.job_id, "data": job.to_dict()})
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/batch_status', methods=['POST'])
+def batch_status():
+    """查询会话最近一次批量任务的状态，同时传入 job_id 时查询指定的任务（包括已被取代的任务）"""
+    data = request.json
+    writer = get_writer(data)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    session_id = data.get('session_id')
+    job_id = data.get('job_id')
+
+    if not session_id:
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+
+    if job_id:
+        job = batch_runner.get(job_id)
+        if job is None or job.session_id != session_id:
+            return jsonify({"status": "error", "message": "未找到批量任务"})
+        with job.lock:
+            return jsonify({"status": "success", "data": job.to_dict()})
+
+    progress = writer.get_progress(session_id)
+    if 'batch' not in progress:
+        return jsonify({"status": "error", "message": "未找到批量任务"})
+    return jsonify({"status": "success", "data": progress['batch']})
+
+@app.route('/cancel_job', methods=['POST'])
+def cancel_job():
+    """取消进行中的生成：指定 job_id 取消单个任务（包括批量任务），只指定 session_id 时取消该会话的全部任务"""
+    data = request.json
+    writer = get_writer(data)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    job_id = data.get('job_id')
+    session_id = data.get('session_id')
+
+    if not (job_id or session_id):
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+
+    cancelled = writer.jobs.cancel(job_id=job_id, session_id=session_id)
+    if job_id and not cancelled:
+        return jsonify({"status": "error", "message": "任务不存在或已结束"})
+    return jsonify({"status": "success", "data": [job.to_dict() for job in cancelled]})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({"status": "success", "data": dict(response_cache.stats(), context=context_cache.stats())})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式的运行指标"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/storage_stats', methods=['GET'])
+def storage_stats():
+    """会话存储的会话数和占用字节数；内存存储另含过期、换出次数和占用最多的会话"""
+    return jsonify({"status": "success", "data": storage.stats()})
+
+@app.route('/prompt_stats', methods=['GET'])
+def prompt_stats():
+    """各提示词模板的版本、模板自身 token 数及渲染后的平均/最大 token 数"""
+    return jsonify({"status": "success", "data": prompt_registry.stats()})
 
 @app.route('/export_novel', methods=['POST'])
 def export_novel():
+    data = request.json
+    writer = get_writer(data)
     if not writer:
         return jsonify({"status": "error", "message": "请先设置 API Key"})
     
-    data = request.json
     session_id = data.get('session_id')
     format = data.get('format', 'txt')
     
@@ -445,6 +1582,13 @@ def export_novel():
     
     try:
         content = writer.export_novel(session_id, format)
+        if isinstance(content, bytes):
+            # DOCX / EPUB 为二进制文件，以 base64 放入 JSON；大文件请使用 /download_novel
+            return jsonify({
+                "status": "success",
+                "content": base64.b64encode(content).decode('ascii'),
+                "encoding": "base64"
+            })
         if content:
             return jsonify({
                 "status": "success",
@@ -452,17 +1596,43 @@ def export_novel():
             })
         else:
             return jsonify({"status": "error", "message": "导出失败"})
-    except NotImplementedError as e:
-        return jsonify({"status": "error", "message": str(e)})
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return error_response(e)
+
+EXPORT_MIMETYPES = {
+    'txt': 'text/plain',
+    'docx': DOCX_MIMETYPE,
+    'epub': EPUB_MIMETYPE,
+}
+
+@app.route('/download_novel', methods=['GET'])
+def download_novel():
+    """以 text/plain 附件的形式分块下载全文，不经过 JSON"""
+    writer = get_writer(request.args)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    session_id = request.args.get('session_id')
+    format = request.args.get('format', 'txt')
+    if not session_id:
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+    if format not in EXPORT_MIMETYPES:
+        return jsonify({"status": "error", "message": f"不支持的导出格式：{format}"})
+
+    filename = quote(request.args.get('filename') or f"{session_id}.{format}")
+    return Response(
+        stream_with_context(writer.iter_export(session_id, format)),
+        mimetype=EXPORT_MIMETYPES[format],
+        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{filename}"}
+    )
 
 @app.route('/initialize_story', methods=['POST'])
 def initialize_story():
+    data = request.json
+    writer = get_writer(data)
     if not writer:
         return jsonify({"status": "error", "message": "请先设置 API Key"})
     
-    data = request.json
     title = data.get('title')
     genre = data.get('genre')
     background = data.get('background')
@@ -473,20 +1643,38 @@ def initialize_story():
     
     try:
         writer.initialize_story_context(session_id, title, genre, background)
-        analysis = writer.analyze_story_structure(session_id)
+        analysis = writer.analyze_story_structure(session_id, data.get('cache'))
         return jsonify({
             "status": "success",
             "analysis": analysis
         })
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return error_response(e)
+
+@app.route('/consistency_report', methods=['POST'])
+def consistency_report():
+    """扫描一致性索引，报告人物、地点、伏笔的前后一致性问题，不调用接口"""
+    data = request.json
+    writer = get_writer(data)
+    if not writer:
+        return jsonify({"status": "error", "message": "请先设置 API Key"})
+
+    session_id = data.get('session_id')
+    if not session_id:
+        return jsonify({"status": "error", "message": "缺少必要的参数"})
+
+    try:
+        return jsonify({"status": "success", "data": writer.consistency_report(session_id)})
+    except Exception as e:
+        return error_response(e)
 
 @app.route('/get_story_status', methods=['POST'])
 def get_story_status():
+    data = request.json
+    writer = get_writer(data)
     if not writer:
         return jsonify({"status": "error", "message": "请先设置 API Key"})
     
-    data = request.json
     session_id = data.get('session_id')
     
     if not session_id:
@@ -502,14 +1690,15 @@ def get_story_status():
         else:
             return jsonify({"status": "error", "message": "未找到故事信息"})
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return error_response(e)
 
 @app.route('/regenerate_background', methods=['POST'])
 def regenerate_background():
+    data = request.json
+    writer = get_writer(data)
     if not writer:
         return jsonify({"status": "error", "message": "请先设置 API Key"})
     
-    data = request.json
     title = data.get('title')
     genre = data.get('genre')
     suggestion = data.get('suggestion')
@@ -519,38 +1708,23 @@ def regenerate_background():
         return jsonify({"status": "error", "message": "缺少必要的参数"})
     
     try:
-        prompt = f"""请根据以下建议修改这个{genre}小说《{title}》的背景设定：
-
-当前背景：
-{current_content}
-
-修改建议：
-{suggestion}
-
-要求：
-1. 保持原有设定的核心要素
-2. 根据修改建议进行优化和扩充
-3. 确保修改后的内容更加丰富和完整
-4. 保持文风的一致性
-5. 注意细节的连贯性"""
-
-        completion = openai.ChatCompletion.create(
-            model="moonshot-v1-8k",
-            messages=[
-                {"role": "system", "content": "你是一个专业的小说策划，专注于创作背景设定。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=2000
-        )
-        
-        content = completion.choices[0].message.content
-        return jsonify({
-            "status": "success",
-            "content": content
-        })
+        messages = writer._background_revision_messages(title, genre, current_content, suggestion)
+        candidates = candidate_count(data)
+        if candidates > 1:
+            # 修改后的背景应与原背景篇幅相当，并体现修改意见
+            payload = candidates_payload(
+                writer.complete_candidates(messages, candidates, max_tokens=2000),
+                '\n'.join([suggestion, current_content]), len(current_content)
+            )
+            content = payload['content']
+        else:
+            content = writer.complete(messages, max_tokens=2000, cache=data.get('cache'))['content']
+            payload = {"status": "success", "content": content}
+        if data.get('session_id'):
+            writer.replace_background(data['session_id'], content)
+        return jsonify(payload)
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return error_response(e)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
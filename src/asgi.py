@@ -0,0 +1,437 @@
+"""ASGI 入口：耗时的生成接口以协程方式处理，其余接口交给 Flask
+
+启动方式：
+    uvicorn --app-dir src asgi:application --host 0.0.0.0 --port 5001
+
+生成接口通过 openai 的 acreate（aiohttp）访问 Moonshot，等待上游时不占用线程，
+单个进程即可同时挂起数百个生成请求。存储读写、上下文缓存失效等同步操作通过 asyncio.to_thread
+放到线程池中执行，一次较慢的写入不会阻塞其他连接。
+"""
+import asyncio
+import contextvars
+import json
+
+import openai
+from asgiref.wsgi import WsgiToAsgi
+
+import app as novel_app
+import jobs
+import metrics
+from app import OUTLINE_STAGES
+
+
+def _missing(*values):
+    return not all(values)
+
+
+def _closing(wsgi_app):
+    """WsgiToAsgi 不调用响应的 close()，由这里在响应发送完毕后补上，
+    Flask 的 call_on_close 回调（接口耗时统计等）才会执行"""
+    def app(environ, start_response):
+        result = wsgi_app(environ, start_response)
+        try:
+            yield from result
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+    return app
+
+
+class NovelASGI:
+    def __init__(self, flask_app):
+        self.wsgi = WsgiToAsgi(_closing(flask_app))
+        self.routes = {
+            '/generate_outline_part': self.generate_outline_part,
+            '/generate_outline': self.generate_outline,
+            '/generate_content': self.generate_content,
+            '/generate_section': self.generate_section,
+            '/regenerate_background': self.regenerate_background,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        handler = self.routes.get(scope.get('path'))
+        if scope['type'] != 'http' or scope['method'] != 'POST' or handler is None:
+            # uvicorn 在上一个响应的 send 中开始处理同一连接上的下一个请求，新请求会继承 WsgiToAsgi
+            # 留在上下文中的、已经结束的线程执行器，因此在空白上下文中运行 Flask
+            await contextvars.Context().run(asyncio.ensure_future, self.wsgi(scope, receive, send))
+            return
+
+        # Flask 接口的耗时由 Flask 的请求钩子记录，这里只记录协程接口
+        timer = metrics.RequestTimer(scope['path'], scope['method'])
+        status = 500
+        sent = False
+
+        async def tracked_send(message):
+            nonlocal status, sent
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif not message.get('more_body'):
+                sent = True
+            await send(message)
+
+        try:
+            try:
+                data = json.loads(await self.read_body(receive) or b'{}')
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                await self.send_json(tracked_send, {"status": "error", "message": "请求体应为 JSON 对象"})
+                return
+            # 所有请求复用同一个 aiohttp 连接池
+            openai.aiosession.set(novel_app.http_pool.aiohttp_session())
+            # 本进程未见过的 client_id 需要查询存储
+            writer = await asyncio.to_thread(novel_app.get_writer, data)
+            if not writer:
+                await self.send_json(tracked_send, {"status": "error", "message": "请先设置 API Key"})
+                return
+            if await self.run_until_disconnect(handler(writer, data, tracked_send), receive, lambda: sent):
+                # 客户端在响应完成前断开，处理协程及其上游请求已被取消
+                status = 499
+                jobs.JOBS_CANCELLED.inc(reason='disconnected')
+        finally:
+            timer.finish(status)
+
+    @staticmethod
+    async def run_until_disconnect(handler, receive, sent):
+        """运行接口协程，同时监听 http.disconnect；客户端在响应发送完毕前断开时取消协程并返回 True
+
+        请求体已读完，之后 receive() 只会在连接断开或响应发送完毕时返回。
+        """
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        task = asyncio.ensure_future(handler)
+        watcher = asyncio.ensure_future(disconnected())
+        try:
+            done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if task in done or sent():
+                await task
+                return False
+            task.cancel()
+            await asyncio.wait({task})
+            return True
+        finally:
+            watcher.cancel()
+            task.cancel()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await novel_app.http_pool.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                return body
+
+    @staticmethod
+    async def send_json(send, payload, status=200, headers=()):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json; charset=utf-8'),
+                (b'content-length', str(len(body)).encode()),
+                *headers
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_error(self, send, e):
+        """与 Flask 接口的 error_response 一致：上游限流时返回 429"""
+        payload = novel_app.error_payload(e)
+        if payload.get('code') == 'rate_limited':
+            await self.send_json(send, payload, 429, [(b'retry-after', str(payload['retry_after']).encode())])
+        elif payload.get('code') == 'quota_exceeded':
+            await self.send_json(send, payload, 429)
+        elif payload.get('code') == 'version_conflict':
+            await self.send_json(send, payload, 409)
+        else:
+            await self.send_json(send, payload)
+
+    @staticmethod
+    def with_job_header(send, job):
+        """在响应头中加上 X-Job-Id"""
+        async def job_send(message):
+            if message['type'] == 'http.response.start':
+                message = dict(message, headers=[*message['headers'], (b'x-job-id', job.job_id.encode())])
+            await send(message)
+        return job_send
+
+    @staticmethod
+    async def send_events(send, events):
+        """把异步事件生成器写成 text/event-stream 响应"""
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no')
+            ]
+        })
+        async for chunk in events:
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def generate_outline_part(self, writer, data, send):
+        title = data.get('title')
+        genre = data.get('genre', '')
+        stage = data.get('stage', 'background')
+
+        if _missing(title, data.get('session_id')):
+            await self.send_json(send, {"status": "error", "message": "缺少必要的参数"})
+            return
+        if stage not in OUTLINE_STAGES:
+            await self.send_json(send, {"status": "error", "message": f"未知的大纲阶段：{stage}"})
+            return
+
+        try:
+            content = await writer.agenerate_outline_stage(title, genre, stage, data.get('cache'))
+            session_id = data['session_id']
+            # 存储读写和上下文缓存的失效（moonshot 模式下是同步 HTTP 请求）放到线程中，不阻塞事件循环
+            if stage == 'background':
+                await asyncio.to_thread(
+                    writer.save_outline, session_id, merge=True, title=title, genre=genre, background=content
+                )
+            else:
+                await asyncio.to_thread(writer.save_outline, session_id, content, merge=True, title=title, genre=genre)
+            await self.send_json(send, {"status": "success", "content": content, "next_stage": OUTLINE_STAGES[stage]['next_stage']})
+        except Exception as e:
+            await self.send_error(send, e)
+
+    async def generate_outline(self, writer, data, send):
+        title = data.get('title')
+        genre = data.get('genre', '')
+        session_id = data.get('session_id')
+
+        if _missing(title, session_id):
+            await self.send_json(send, {"status": "error", "message": "缺少必要的参数"})
+            return
+
+        try:
+            results = await writer.agenerate_full_outline(title, genre, data.get('cache'))
+            background = results['background']
+            parts = [results[stage] for stage in OUTLINE_STAGES if stage != 'background']
+            await asyncio.to_thread(writer.set_progress, session_id, 'complete', background)
+            outline = await asyncio.to_thread(
+                writer.save_outline, session_id, '\n'.join(parts), title=title, genre=genre, background=background
+            )
+            await self.send_json(send, {
+                "status": "success",
+                "content": '\n\n'.join([background] + parts),
+                "background": background,
+                "outline": '\n\n'.join(parts),
+                "chapters": outline['chapters'],
+                "next_stage": "complete"
+            })
+        except Exception as e:
+            await self.send_error(send, e)
+
+    async def generate_content(self, writer, data, send):
+        title = data.get('title')
+        chapter_title = data.get('chapter_title')
+        section_title = data.get('section_title')
+        outline = data.get('outline')
+        genre = data.get('genre', '')
+
+        if _missing(title, chapter_title, section_title, outline):
+            await self.send_json(send, {"status": "error", "message": "缺少必要的参数"})
+            return
+
+        messages = writer._content_messages(title, genre, chapter_title, section_title, outline)
+
+        job = writer.jobs.start('content', job_id=data.get('job_id'))
+        send = self.with_job_header(send, job)
+
+        try:
+            candidates = novel_app.candidate_count(data)
+        except ValueError as e:
+            with job:
+                await self.send_error(send, e)
+            return
+        if candidates > 1:
+            with job:
+                try:
+                    result = await job.arun(writer.acomplete_candidates(
+                        messages, candidates, novel_app.CONTENT_MIN_CHARS, novel_app.CONTENT_MAX_TOKENS
+                    ))
+                    await self.send_json(send, novel_app.candidates_payload(
+                        result, '\n'.join([chapter_title, section_title, outline]), novel_app.CONTENT_MIN_CHARS
+                    ))
+                except Exception as e:
+                    await self.send_error(send, e)
+            return
+
+        if data.get('stream'):
+            async def events():
+                parts = []
+                yield novel_app.sse_event('job', {"job_id": job.job_id})
+                try:
+                    async for kind, payload in job.aguard(
+                        writer.astream_long(messages, novel_app.CONTENT_MIN_CHARS, novel_app.CONTENT_MAX_TOKENS)
+                    ):
+                        if kind == 'delta':
+                            parts.append(payload)
+                            yield novel_app.sse_event('delta', {"content": payload})
+                        else:
+                            yield novel_app.sse_event('done', {
+                                "status": "success",
+                                "content": ''.join(parts),
+                                "usage": payload['usage'],
+                                "finish_reason": payload['finish_reason'],
+                                "rounds": payload['rounds']
+                            })
+                except Exception as e:
+                    yield novel_app.sse_event('error', novel_app.error_payload(e))
+            with job:
+                await self.send_events(send, events())
+            return
+
+        with job:
+            try:
+                result = await job.arun(
+                    writer.acomplete_long(messages, novel_app.CONTENT_MIN_CHARS, novel_app.CONTENT_MAX_TOKENS)
+                )
+                await self.send_json(send, {"status": "success", "content": result['content']})
+            except Exception as e:
+                await self.send_error(send, e)
+
+    async def generate_section(self, writer, data, send):
+        # 已保存大纲时只需传 session_id、chapter_number、section_number
+        try:
+            data = await asyncio.to_thread(writer.fill_section_request, data)
+        except Exception as e:
+            await self.send_error(send, e)
+            return
+        title = data.get('title')
+        genre = data.get('genre')
+        chapter_title = data.get('chapter_title')
+        chapter_number = data.get('chapter_number')
+        section_number = data.get('section_number')
+        session_id = data.get('session_id')
+        background = data.get('background')
+        outline = data.get('outline')
+
+        if _missing(title, genre, chapter_title, chapter_number, section_number, session_id, background, outline):
+            await self.send_json(send, {"status": "error", "message": "缺少必要的参数"})
+            return
+
+        # 同一小节的新请求取代仍在进行的旧请求（重新生成）
+        job = writer.jobs.start('section', session_id, (str(chapter_number), str(section_number)), data.get('job_id'))
+        send = self.with_job_header(send, job)
+        # 后台已预生成（或正在预生成）这一节且输入一致时直接使用
+        speculation = writer.prefetcher.take(session_id, chapter_number, section_number, data)
+        prefetch = novel_app.prefetch_enabled(data)
+
+        if data.get('stream'):
+            async def events():
+                parts = []
+                yield novel_app.sse_event('job', {"job_id": job.job_id})
+                try:
+                    if speculation is not None:
+                        source = speculation.afollow()
+                    else:
+                        memory = await asyncio.to_thread(
+                            writer.story_memory, session_id, chapter_number, section_number, outline
+                        )
+                        source = writer.astream_section(
+                            title, genre, chapter_title, section_number, background, outline, memory, session_id,
+                            fresh=job.superseded
+                        )
+                    async for kind, payload in job.aguard(source):
+                        if kind == 'delta':
+                            parts.append(payload)
+                            yield novel_app.sse_event('delta', {"content": payload})
+                            continue
+                        content = ''.join(parts)
+                        version = await asyncio.to_thread(
+                            writer.save_section, session_id, chapter_number, section_number, chapter_title, content,
+                            prefetch=prefetch
+                        )
+                        yield novel_app.sse_event('done', {
+                            "status": "success",
+                            "usage": payload['usage'],
+                            "finish_reason": payload['finish_reason'],
+                            "rounds": payload['rounds'],
+                            "prefetched": speculation is not None,
+                            "section": {
+                                "chapter_number": chapter_number,
+                                "section_number": section_number,
+                                "title": chapter_title,
+                                "content": content,
+                                "version": version
+                            }
+                        })
+                except Exception as e:
+                    yield novel_app.sse_event('error', novel_app.error_payload(e))
+            with job:
+                await self.send_events(send, events())
+            return
+
+        with job:
+            try:
+                if speculation is not None:
+                    content = await job.arun(speculation.await_content())
+                else:
+                    memory = await asyncio.to_thread(
+                        writer.story_memory, session_id, chapter_number, section_number, outline
+                    )
+                    content = await job.arun(writer.agenerate_section(
+                        title, genre, chapter_title, section_number, background, outline, memory, session_id,
+                        fresh=job.superseded
+                    ))
+                version = await asyncio.to_thread(
+                    writer.save_section, session_id, chapter_number, section_number, chapter_title, content,
+                    prefetch=prefetch
+                )
+                await self.send_json(send, {
+                    "status": "success", "content": content, "version": version, "prefetched": speculation is not None
+                })
+            except Exception as e:
+                await self.send_error(send, e)
+
+    async def regenerate_background(self, writer, data, send):
+        title = data.get('title')
+        genre = data.get('genre')
+        suggestion = data.get('suggestion')
+        current_content = data.get('current_content')
+
+        if _missing(title, genre, suggestion, current_content):
+            await self.send_json(send, {"status": "error", "message": "缺少必要的参数"})
+            return
+
+        try:
+            messages = writer._background_revision_messages(title, genre, current_content, suggestion)
+            candidates = novel_app.candidate_count(data)
+            if candidates > 1:
+                payload = novel_app.candidates_payload(
+                    await writer.acomplete_candidates(messages, candidates, max_tokens=2000),
+                    '\n'.join([suggestion, current_content]), len(current_content)
+                )
+            else:
+                result = await writer.acomplete(messages, max_tokens=2000, cache=data.get('cache'))
+                payload = {"status": "success", "content": result['content']}
+            if data.get('session_id'):
+                await asyncio.to_thread(writer.replace_background, data['session_id'], payload['content'])
+            await self.send_json(send, payload)
+        except Exception as e:
+            await self.send_error(send, e)
+
+
+application = NovelASGI(novel_app.app)
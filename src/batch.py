@@ -0,0 +1,145 @@
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from jobs import JobCancelled
+
+# 单个批量任务允许的最大并发数，可通过环境变量调整
+MAX_CONCURRENCY = int(os.environ.get('NOVEL_BATCH_MAX_CONCURRENCY', 4))
+# 保留供查询的已结束任务数，超出后先丢弃最早结束的
+MAX_FINISHED_JOBS = int(os.environ.get('NOVEL_BATCH_MAX_FINISHED_JOBS', 100))
+
+
+class BatchJob:
+    """一次批量生成任务，记录每个小节的完成情况"""
+
+    def __init__(self, session_id, sections, concurrency):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.sections = sections
+        self.concurrency = concurrency
+        self.status = 'pending'
+        self.completed = 0
+        self.skipped = 0
+        self.cancelled = 0
+        self.failed = []
+        self.control = None  # 对应的可取消任务（jobs.Job），取消后未开始的小节不再生成
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'total': len(self.sections),
+            'completed': self.completed,
+            'skipped': self.skipped,
+            'cancelled': self.cancelled,
+            'failed': list(self.failed),
+            'concurrency': self.concurrency,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+
+class BatchRunner:
+    """批量生成小节：受并发上限约束的线程池逐节调用 generate_section 并保存结果
+
+    已经保存过的小节会被跳过，因此同一大纲重复提交即可从中断处继续。
+    任务状态通过 writer.set_batch_progress 写入会话进度的 batch 字段，供 /batch_status 查询。
+    任务登记在 writer.jobs 中，可以通过 /cancel_job 取消；同一会话提交新的批量任务会取代旧任务。
+    已结束的任务按结束顺序最多保留 max_finished 个，可以按 job_id 查询。
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_finished=MAX_FINISHED_JOBS):
+        self.max_concurrency = max_concurrency
+        self.max_finished = max_finished
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, writer, session_id, book, sections, concurrency=None):
+        """提交批量任务，立即返回 BatchJob，生成在后台线程中进行
+
+        book: {'title', 'genre', 'background'}
+        sections: [{'chapter_number', 'chapter_title', 'section_number', 'outline'}, ...]
+        """
+        concurrency = max(1, min(concurrency or self.max_concurrency, self.max_concurrency))
+        job = BatchJob(session_id, sections, concurrency)
+        job.control = writer.jobs.start('batch', session_id, job_id=job.job_id)
+        with self.lock:
+            self.jobs[job.job_id] = job
+        thread = threading.Thread(target=self._run, args=(writer, job, book), daemon=True)
+        thread.start()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _retire(self, job):
+        """任务结束：移到末尾，并丢弃超出 max_finished 的最早结束的任务"""
+        with self.lock:
+            self.jobs.move_to_end(job.job_id)
+            finished = [job_id for job_id, other in self.jobs.items() if other.finished_at is not None]
+            for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self.jobs[job_id]
+
+    def _run(self, writer, job, book):
+        job.status = 'running'
+        job.started_at = datetime.now()
+        self._report(writer, job)
+        with job.control, ThreadPoolExecutor(max_workers=job.concurrency) as executor:
+            for section in job.sections:
+                executor.submit(self._generate_one, writer, job, book, section)
+        if job.control.cancelled:
+            job.status = 'cancelled'
+        else:
+            job.status = 'failed' if job.failed else 'completed'
+        job.finished_at = datetime.now()
+        self._report(writer, job)
+        self._retire(job)
+
+    def _generate_one(self, writer, job, book, section):
+        chapter_number = section['chapter_number']
+        section_number = section['section_number']
+        if job.control.cancelled:
+            with job.lock:
+                job.cancelled += 1
+            self._report(writer, job)
+            return
+
+        try:
+            existing = writer.get_chapter_sections(job.session_id, chapter_number)
+            if len(existing) >= section_number and existing[section_number - 1]:
+                with job.lock:
+                    job.skipped += 1
+                self._report(writer, job)
+                return
+            memory = writer.story_memory(job.session_id, chapter_number, section_number, section['outline'])
+            # 以流式读取上游，任务取消时正在生成的小节也能中途断开
+            content, _ = job.control.collect(writer.stream_section(
+                book['title'], book['genre'], section['chapter_title'], section_number,
+                book['background'], section['outline'], memory, job.session_id, fresh=job.control.superseded
+            ))
+            writer.save_section(job.session_id, chapter_number, section_number, section['chapter_title'], content)
+            with job.lock:
+                job.completed += 1
+        except JobCancelled:
+            with job.lock:
+                job.cancelled += 1
+        except Exception as e:
+            with job.lock:
+                job.failed.append({
+                    'chapter_number': chapter_number,
+                    'section_number': section_number,
+                    'message': str(e)
+                })
+        self._report(writer, job)
+
+    def _report(self, writer, job):
+        with job.lock:
+            writer.set_batch_progress(job.session_id, job.to_dict())
@@ -0,0 +1,181 @@
+import contextlib
+import contextvars
+import hashlib
+import os
+import secrets
+import threading
+import time
+
+import aiohttp
+import openai.api_requestor
+import requests
+
+# 可指向其他 OpenAI 兼容服务，例如 bench/mock_server.py 启动的本地模拟服务
+API_BASE = os.environ.get('NOVEL_API_BASE', "https://api.moonshot.cn/v1")
+
+# 连接池大小、空闲回收时间均可通过环境变量调整
+POOL_SIZE = int(os.environ.get('NOVEL_HTTP_POOL_SIZE', 64))
+IDLE_TIMEOUT = int(os.environ.get('NOVEL_HTTP_IDLE_TIMEOUT', 300))
+CLIENT_IDLE_TIMEOUT = int(os.environ.get('NOVEL_CLIENT_IDLE_TIMEOUT', 3600))
+# client_id 的最近使用时间至多每隔这么多秒写回一次存储
+CLIENT_TOUCH_INTERVAL = 60
+
+# capture_response 块内收到的上游 HTTP 响应
+_captured = contextvars.ContextVar('novel_captured_responses', default=None)
+
+
+@contextlib.contextmanager
+def capture_response():
+    """记录块内发起的上游请求的 HTTP 响应（requests.Response 或 aiohttp.ClientResponse）
+
+    openai 的流式结果只是分片迭代器，中途停止读取时不会关闭底层连接；调用方拿到响应对象后
+    可以主动 close()，上游随即断开，连接也不再占用连接池。
+    """
+    captured = []
+    token = _captured.set(captured)
+    try:
+        yield captured
+    finally:
+        _captured.reset(token)
+
+
+def _remember(response):
+    captured = _captured.get()
+    if captured is not None:
+        captured.append(response)
+
+
+class HTTPClientPool:
+    """所有租户共享的上游连接池
+
+    同步调用共用一个 requests.Session（keep-alive，TLS 连接复用，连接数受 pool_size 限制），
+    异步调用共用一个 aiohttp.ClientSession。空闲超过 idle_timeout 的连接会被关闭。
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=openai.api_requestor.MAX_CONNECTION_RETRIES
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.hooks['response'].append(lambda response, *args, **kwargs: _remember(response))
+        self.async_session = None
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def sync_session(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_used > self.idle_timeout:
+                # 关闭空闲连接，下次请求时会重新建立
+                self.session.close()
+            self.last_used = now
+        return self.session
+
+    def aiohttp_session(self):
+        """返回共享的 aiohttp 会话，必须在事件循环中调用"""
+        if self.async_session is None or self.async_session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_request_end.append(self._request_end)
+            self.async_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.idle_timeout
+            ), trace_configs=[trace])
+        return self.async_session
+
+    @staticmethod
+    async def _request_end(session, context, params):
+        _remember(params.response)
+
+    async def aclose(self):
+        if self.async_session is not None:
+            await self.async_session.close()
+
+    def install(self):
+        """让 openai 的同步请求使用本连接池
+
+        openai 0.27 为每个线程调用一次 _make_session 创建独立会话，这里改为返回共享会话。
+        """
+        openai.api_requestor._make_session = self.sync_session
+
+
+class WriterRegistry:
+    """按 API Key 隔离的 NovelWriter 注册表
+
+    每个 API Key 对应一个 NovelWriter；set_api_key 为调用方签发 client_id，后续请求凭 client_id
+    找到自己的 writer，互不覆盖。长时间未使用的 client_id 和 writer 会被回收。
+
+    client_id 到 API Key 的登记保存在 storage 中（SQLite 存储时多个 worker 共享），本进程没见过的
+    client_id 从存储中查出 API Key 后重建 writer，因此请求落到任一 worker 上都能找到调用方。
+    """
+
+    def __init__(self, factory, storage, idle_timeout=CLIENT_IDLE_TIMEOUT):
+        self.factory = factory
+        self.storage = storage
+        self.idle_timeout = idle_timeout
+        self.writers = {}  # API Key 指纹 -> NovelWriter
+        self.clients = {}  # client_id -> [API Key 指纹, 最近使用时间, 最近写回存储的时间]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(api_key):
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    def register(self, api_key):
+        """创建（或复用）API Key 对应的 writer，返回新的 client_id"""
+        if not api_key:
+            raise ValueError("API key is required")
+        client_id = secrets.token_urlsafe(16)
+        now = time.time()
+        self.storage.expire_clients(now - self.idle_timeout)
+        self.storage.save_client(client_id, api_key, now)
+        self._remember(client_id, api_key, now)
+        return client_id
+
+    def get(self, client_id=None):
+        """按 client_id 返回 writer；未提供、未知或已过期时返回 None，不会落到其他用户的 Key 上"""
+        if not client_id:
+            return None
+        now = time.time()
+        with self.lock:
+            self._evict_idle(now)
+            client = self.clients.get(client_id)
+            if client is not None:
+                client[1] = now
+                writer = self.writers[client[0]]
+                if now - client[2] < CLIENT_TOUCH_INTERVAL:
+                    return writer
+                client[2] = now
+        if client is not None:
+            self.storage.save_client(client_id, writer.api_key, now)
+            return writer
+
+        # 由其他 worker 签发，或本进程已回收
+        record = self.storage.get_client(client_id)
+        if record is None or record[1] < now - self.idle_timeout:
+            return None
+        self.storage.save_client(client_id, record[0], now)
+        return self._remember(client_id, record[0], now)
+
+    def _remember(self, client_id, api_key, now):
+        key = self.fingerprint(api_key)
+        with self.lock:
+            self._evict_idle(now)
+            if key not in self.writers:
+                self.writers[key] = self.factory(api_key)
+            self.clients[client_id] = [key, now, now]
+            return self.writers[key]
+
+    def _evict_idle(self, now):
+        deadline = now - self.idle_timeout
+        for client_id in [cid for cid, (_, last_used, _) in self.clients.items() if last_used < deadline]:
+            del self.clients[client_id]
+        in_use = {client[0] for client in self.clients.values()}
+        for key in [key for key in self.writers if key not in in_use]:
+            del self.writers[key]
@@ -0,0 +1,277 @@
+"""全书一致性索引
+
+每保存或修改一节，就在本地从正文中提取人物、地点和专有名词，记入按会话保存的倒排索引（不调用模型）：
+
+    terms     {词: 类别}，类别为 character（人物）、place（地点）或 term（其他专有名词）
+    postings  {词: {位置: 出现次数}}，位置写作 "章-节"
+    sections  {位置: {'terms': {词: 提及该词的一句话}, 'clues': [{'text', 'terms'}]}}
+
+提取只用几条启发式规则：常见姓氏开头、后接"说、问、笑"等动作的二三字词记为人物；"在、到、从"等之后以城、镇、
+山、街等结尾的词记为地点；书名号、直角引号中的短语记为专有名词；已收录的词和故事记忆中的人物在之后各节中
+直接按字面计数。含"秘密、真相、下落"等字眼且提到地点或专有名词的句子记为伏笔线索。
+
+生成小节时按本节大纲查询索引，只把大纲提到的人物、地点的既有描写和相关伏笔注入提示词；/consistency_report
+只扫描索引，检查长期缺席后重新出现的人物、写法相近的人名、大纲提到但正文未写到的人物和地点，以及没有下文的伏笔。
+"""
+import re
+
+from ranking import STOP_CHARS
+
+KINDS = {'character': '人物', 'place': '地点', 'term': '专有名词'}
+
+SURNAMES = (
+    '王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘于蒋蔡余杜叶程苏魏吕丁任沈姚卢'
+    '姜崔钟谭陆汪范金石廖贾夏韦付方白邹孟熊秦邱江尹薛闫段雷侯龙史陶黎贺顾毛郝龚邵万钱严覃武戴莫孔向汤柳楚萧慕'
+)
+# 人名之前可以出现的字（其余汉字之后的姓氏多半是词的一部分，如"望江楼"中的"江"）
+NAME_LEADS = '着和与跟对向被把让给叫见是了'
+# 人名之后常见的动作，用来确认前面的词是人名
+NAME_CUES = '说道问笑答喊叫哭叹想看望盯点摇站坐走跑转抬低轻冷皱沉愣怔握推拉递'
+# 以姓氏开头、后面也常接动作的普通词
+NAME_EXCLUDED = frozenset(('周围', '许多', '高兴', '方向', '白天', '万一', '向前', '向后', '何时', '常常', '江湖', '金色', '白色', '田野'))
+# 地点名之前常见的字
+PLACE_LEADS = '在到从往去回进出离向于至过入的'
+PLACE_SUFFIXES = '城镇村寨庄山峰岭河江湖海岛湾街巷桥府宫殿寺庙观楼阁院谷关州县国'
+# 伏笔线索的提示词
+CLUE_CUES = ('秘密', '真相', '谜', '伏笔', '来历', '下落', '预感', '不为人知', '没有人知道', '总有一天', '后来才', '匿名', '神秘', '隐情')
+
+# 注入提示词和报告中摘录的句子最多保留的字数
+SNIPPET_CHARS = 60
+# 人物在这么多个已写小节中都未出现后重新出现，报告为长期缺席
+ABSENCE_SECTIONS = 10
+
+_NAME = re.compile(
+    f'(?:(?<![\\u4e00-\\u9fff])|(?<=[{NAME_LEADS}]))[{SURNAMES}][\\u4e00-\\u9fff]{{1,2}}?(?=[{NAME_CUES}])'
+)
+_PLACE = re.compile(
+    f'(?:(?<![\\u4e00-\\u9fff])|(?<=[{PLACE_LEADS}]))([\\u4e00-\\u9fff]{{1,3}}[{PLACE_SUFFIXES}])'
+)
+_QUOTED = re.compile(r'[《「『]([^》」』\n]{2,10})[》」』]')
+_SENTENCE = re.compile(r'[^。！？!?\n]+[。！？!?]?')
+
+
+def position_key(chapter_number, section_number):
+    return f"{int(chapter_number)}-{int(section_number)}"
+
+
+def parse_position(key):
+    chapter, _, section = key.partition('-')
+    return int(chapter), int(section)
+
+
+def describe_position(key):
+    chapter, section = parse_position(key)
+    return f"第{chapter}章第{section}节"
+
+
+def empty_index():
+    return {'terms': {}, 'postings': {}, 'sections': {}}
+
+
+def _snippet(sentence, term):
+    """截取句中包含 term 的一段，不超过 SNIPPET_CHARS 字"""
+    sentence = sentence.strip()
+    if len(sentence) <= SNIPPET_CHARS:
+        return sentence
+    start = max(0, sentence.find(term) - SNIPPET_CHARS // 3)
+    return sentence[start:start + SNIPPET_CHARS] + '…'
+
+
+def _candidates(text):
+    """按规则从正文中找出新的人物、地点和专有名词，返回 {词: 类别}"""
+    found = {}
+    for match in _QUOTED.finditer(text):
+        found[match.group(1).strip()] = 'term'
+    for match in _PLACE.finditer(text):
+        term = match.group(1)
+        if not any(char in STOP_CHARS or char in PLACE_LEADS for char in term[:-1]):
+            found[term] = 'place'
+    for match in _NAME.finditer(text):
+        name = match.group(0)
+        if name not in NAME_EXCLUDED and not any(char in STOP_CHARS for char in name[1:]):
+            found[name] = 'character'
+    return found
+
+
+def extract(text, vocabulary=None):
+    """提取一节正文中的词条和伏笔线索，vocabulary 为已知的 {词: 类别}（已收录的词、故事记忆中的人物）
+    返回 {'terms': {词: [类别, 次数, 摘录]}, 'clues': [{'text', 'terms'}]}
+    """
+    kinds = dict(_candidates(text))
+    for term, kind in (vocabulary or {}).items():
+        kinds.setdefault(term, kind)
+    sentences = _SENTENCE.findall(text)
+    terms = {}
+    for term, kind in kinds.items():
+        count = text.count(term)
+        if not count:
+            continue
+        sentence = next((sentence for sentence in sentences if term in sentence), '')
+        terms[term] = [kind, count, _snippet(sentence, term)]
+
+    clues = []
+    for sentence in dict.fromkeys(sentences):
+        if not any(cue in sentence for cue in CLUE_CUES):
+            continue
+        mentioned = [term for term, (kind, _, _) in terms.items() if kind != 'character' and term in sentence]
+        if mentioned:
+            clues.append({'text': _snippet(sentence, mentioned[0]), 'terms': mentioned})
+    return {'terms': terms, 'clues': clues}
+
+
+def remove_section(index, key):
+    entry = index['sections'].pop(key, None)
+    if entry is None:
+        return
+    for term in entry['terms']:
+        postings = index['postings'].get(term, {})
+        postings.pop(key, None)
+        if not postings:
+            index['postings'].pop(term, None)
+            index['terms'].pop(term, None)
+
+
+def apply_section(index, chapter_number, section_number, extracted):
+    """用 extract 的结果替换索引中一节的词条，重新保存或修改过的小节先移除旧的记录"""
+    for part, value in empty_index().items():
+        index.setdefault(part, value)
+    key = position_key(chapter_number, section_number)
+    remove_section(index, key)
+    for term, (kind, count, _) in extracted['terms'].items():
+        # 人物的判断优先于其他类别
+        if index['terms'].get(term) != 'character':
+            index['terms'][term] = kind
+        index['postings'].setdefault(term, {})[key] = count
+    index['sections'][key] = {
+        'terms': {term: snippet for term, (_, _, snippet) in extracted['terms'].items()},
+        'clues': extracted['clues']
+    }
+    return index
+
+
+def _positions(index, term, before=None):
+    positions = sorted(index['postings'].get(term, {}), key=parse_position)
+    if before is not None:
+        positions = [key for key in positions if parse_position(key) < before]
+    return positions
+
+
+def _last_seen(index, before=None):
+    """每个词最后出现的位置，before 及之后的小节不计"""
+    last = {}
+    for term, postings in index['postings'].items():
+        positions = [parse_position(key) for key in postings]
+        if before is not None:
+            positions = [position for position in positions if position < before]
+        if positions:
+            last[term] = max(positions)
+    return last
+
+
+def open_clues(index, before=None):
+    """其中的地点、专有名词在之后的小节都没有再出现的伏笔线索，before 及之后的小节不计"""
+    if not index or not index.get('sections'):
+        return []
+    last = _last_seen(index, before)
+    clues = []
+    for key in sorted(index['sections'], key=parse_position):
+        position = parse_position(key)
+        if before is not None and position >= before:
+            continue
+        for clue in index['sections'][key]['clues']:
+            if not any(last.get(term, position) > position for term in clue['terms']):
+                clues.append({'position': key, 'text': clue['text'], 'terms': clue['terms']})
+    return clues
+
+
+def relevant_facts(index, text, before):
+    """本节大纲（text）提到的人物、地点在 before 之前的既有描写，以及与之相关、尚无下文的伏笔
+    返回按人物、地点、专有名词排序的若干行
+    """
+    if not index or not text:
+        return []
+    order = list(KINDS)
+    matched = []
+    for term, kind in index['terms'].items():
+        if term not in text:
+            continue
+        positions = _positions(index, term, before)
+        if positions:
+            matched.append((order.index(kind), -len(positions), term, kind, positions))
+    matched.sort()
+
+    lines = []
+    for _, _, term, kind, positions in matched:
+        first, last = positions[0], positions[-1]
+        seen = f"{describe_position(first)}首次出现" + (f"，最近见于{describe_position(last)}" if last != first else '')
+        lines.append(f"{term}（{KINDS[kind]}，{seen}）：{index['sections'][last]['terms'][term]}")
+    for clue in open_clues(index, before):
+        if any(term in text for term in clue['terms']):
+            lines.append(f"伏笔（{describe_position(clue['position'])}）：{clue['text']}")
+    return lines
+
+
+def _similar(a, b):
+    """同姓、等长且只差一个字的两个名字"""
+    return len(a) == len(b) and a[0] == b[0] and sum(x != y for x, y in zip(a, b)) == 1
+
+
+def report(index, chapters=None):
+    """扫描索引生成一致性报告，chapters 为保存的大纲章节树（用于检查大纲提到但正文未写到的词）"""
+    index = index or empty_index()
+    written = sorted(index['sections'], key=parse_position)
+    order = {key: number for number, key in enumerate(written)}
+
+    entities = {}
+    for term, kind in index['terms'].items():
+        if kind == 'term':
+            continue
+        positions = _positions(index, term)
+        entities.setdefault(kind, []).append({
+            'name': term,
+            'first': positions[0],
+            'last': positions[-1],
+            'sections': len(positions),
+            'mentions': sum(index['postings'][term].values())
+        })
+    for items in entities.values():
+        items.sort(key=lambda item: (-item['sections'], parse_position(item['first'])))
+
+    absences = []
+    for item in entities.get('character', []):
+        positions = _positions(index, item['name'])
+        for previous, current in zip(positions, positions[1:]):
+            missing = order[current] - order[previous] - 1
+            if missing >= ABSENCE_SECTIONS:
+                absences.append({'name': item['name'], 'last_seen': previous, 'reappears': current, 'missing_sections': missing})
+
+    names = [item['name'] for item in entities.get('character', [])]
+    similar = [
+        {'names': [a, b], 'positions': [_positions(index, a)[0], _positions(index, b)[0]]}
+        for i, a in enumerate(names) for b in names[i + 1:] if _similar(a, b)
+    ]
+
+    outline_gaps = []
+    for chapter in chapters or []:
+        for section in chapter.get('sections', []):
+            key = position_key(chapter['number'], section['number'])
+            if key not in index['sections']:
+                continue
+            planned = f"{section.get('title', '')}{section.get('summary', '')}"
+            missing = [
+                term for term, kind in index['terms'].items()
+                if kind != 'term' and term in planned and term not in index['sections'][key]['terms']
+            ]
+            if missing:
+                outline_gaps.append({'position': key, 'missing': missing})
+
+    return {
+        'sections_indexed': len(written),
+        'characters': entities.get('character', []),
+        'places': entities.get('place', []),
+        'terms': sorted(term for term, kind in index['terms'].items() if kind == 'term'),
+        'absences': absences,
+        'similar_names': similar,
+        'outline_gaps': outline_gaps,
+        'open_clues': open_clues(index)
+    }
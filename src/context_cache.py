@@ -0,0 +1,311 @@
+"""上下文缓存
+
+同一部小说的所有小节请求都以相同的 system、背景和完整大纲开头。开启上下文缓存后，这段前缀按
+session_id 在上游登记一次，之后的请求只携带一条 role=cache 的引用消息，上游不再重复处理这部分输入。
+前缀内容变化（重新生成背景、修改大纲）时旧缓存失效，下次请求重新登记。
+
+NOVEL_CONTEXT_CACHE 选择实现：
+    off（默认）：不使用
+    moonshot：Moonshot 的 Context Caching 接口（创建和存续时长单独计费）
+    local：本地替身，发出请求前把引用展开回原始消息，用于测试和统计可节省的 token
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+
+from clients import API_BASE
+from singleflight import SingleFlight
+from tokens import estimate_messages_tokens
+
+CONTEXT_CACHE_TTL = int(os.environ.get('NOVEL_CONTEXT_CACHE_TTL', 3600))
+# 前缀太短时不值得缓存
+MIN_CONTEXT_TOKENS = int(os.environ.get('NOVEL_CONTEXT_CACHE_MIN_TOKENS', 1000))
+# 登记失败后多少秒内不再为该会话尝试
+RETRY_INTERVAL = 300
+# 缓存按模型系列创建，8k/32k/128k 模型都可以引用
+CACHE_MODEL = 'moonshot-v1'
+# 新建的缓存处于 pending 状态时轮询等待 ready 的次数和间隔
+READY_POLLS = 20
+READY_POLL_INTERVAL = 0.5
+
+
+def _digest(messages):
+    payload = json.dumps(messages, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ContextExpired(ValueError):
+    """引用的上下文缓存已失效（背景或大纲被修改后旧缓存被丢弃）"""
+
+
+def _owner(api_key, session_id):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest(), session_id
+
+
+class ContextCache:
+    """按 (API Key, session_id) 管理上下文缓存；本类即 off 模式，不创建任何缓存"""
+
+    mode = 'off'
+
+    def __init__(self, ttl=CONTEXT_CACHE_TTL, min_tokens=MIN_CONTEXT_TOKENS):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.entries = {}  # (Key 指纹, session_id) -> {'id', 'digest', 'messages', 'tokens', 'expires'}
+        self.by_id = {}  # 缓存 id -> 被缓存的消息，用于展开引用
+        self.retry_after = {}  # (Key 指纹, session_id) -> 下次允许登记的时间
+        self.lock = threading.Lock()
+        # 同一会话的多个小节同时开始时（批量生成）只登记一次
+        self.registering = SingleFlight()
+        self.created = 0
+        self.references = 0
+        self.cached_tokens = 0  # 以引用代替原始前缀的 token 总数
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def reference(self, api_key, session_id, messages):
+        """返回代替 messages 的引用消息列表；不使用缓存或登记失败时返回 None"""
+        owner, stale = self._prepare(api_key, session_id, messages)
+        if stale is not None:
+            self._delete_quietly(api_key, stale)
+        if owner is None:
+            return None
+        entry = self._reuse(owner, messages)
+        if entry is None:
+            try:
+                entry = self.registering.do(owner, lambda: self._register(owner, messages, self._create(api_key, messages)))
+            except Exception:
+                self._failed(owner)
+                return None
+        return self._reference_messages(entry)
+
+    async def areference(self, api_key, session_id, messages):
+        """reference 的异步版本"""
+        owner, stale = self._prepare(api_key, session_id, messages)
+        if stale is not None:
+            await self._adelete_quietly(api_key, stale)
+        if owner is None:
+            return None
+        entry = self._reuse(owner, messages)
+        if entry is None:
+            async def register():
+                return self._register(owner, messages, await self._acreate(api_key, messages))
+
+            try:
+                entry = await self.registering.ado(owner, register)
+            except Exception:
+                self._failed(owner)
+                return None
+        return self._reference_messages(entry)
+
+    def invalidate(self, api_key, session_id):
+        """丢弃会话的缓存，背景或大纲改变时调用"""
+        with self.lock:
+            entry = self.entries.pop(_owner(api_key, session_id), None)
+            if entry is not None:
+                self.by_id.pop(entry['id'], None)
+        if entry is not None:
+            self._delete_quietly(api_key, entry)
+
+    def resolve(self, messages):
+        """返回 (发给上游的消息, 展开引用后的完整消息)，后者用于估算 token 和选择模型"""
+        return messages, self.expand(messages)
+
+    def expand(self, messages):
+        if not messages or messages[0]['role'] != 'cache':
+            return messages
+        cache_id = messages[0]['content'].split(';')[0].partition('=')[2]
+        with self.lock:
+            cached = self.by_id.get(cache_id)
+        if cached is None:
+            raise ContextExpired(f"上下文缓存 {cache_id} 已失效")
+        return cached + messages[1:]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'mode': self.mode,
+                'entries': len(self.entries),
+                'created': self.created,
+                'references': self.references,
+                'cached_tokens': self.cached_tokens
+            }
+
+    def _prepare(self, api_key, session_id, messages):
+        """返回 (需要缓存时的所有者键, 内容已变化需删除的旧缓存)"""
+        if not self.enabled or not session_id or estimate_messages_tokens(messages) < self.min_tokens:
+            return None, None
+        owner = _owner(api_key, session_id)
+        digest = _digest(messages)
+        with self.lock:
+            if self.retry_after.get(owner, 0) > time.monotonic():
+                return None, None
+            entry = self.entries.get(owner)
+            if entry is not None and entry['digest'] != digest:
+                del self.entries[owner]
+                self.by_id.pop(entry['id'], None)
+                return owner, entry
+        return owner, None
+
+    def _reuse(self, owner, messages):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(owner)
+            if entry is not None and entry['digest'] == _digest(messages) and entry['expires'] > now:
+                entry['expires'] = now + self.ttl
+                return entry
+        return None
+
+    def _register(self, owner, messages, created):
+        cache_id, tokens = created
+        entry = {
+            'id': cache_id,
+            'digest': _digest(messages),
+            'messages': messages,
+            'tokens': tokens or estimate_messages_tokens(messages),
+            'expires': time.monotonic() + self.ttl
+        }
+        with self.lock:
+            self._prune(time.monotonic())
+            previous = self.entries.get(owner)
+            if previous is not None:
+                self.by_id.pop(previous['id'], None)
+            self.entries[owner] = entry
+            self.by_id[cache_id] = messages
+            self.created += 1
+        return entry
+
+    def _prune(self, now):
+        """丢弃已过期的缓存记录（上游按 ttl 自行回收）和已到期的重试限制，避免闲置会话的前缀常驻内存"""
+        for owner, entry in list(self.entries.items()):
+            if entry['expires'] <= now:
+                del self.entries[owner]
+                self.by_id.pop(entry['id'], None)
+        for owner, until in list(self.retry_after.items()):
+            if until <= now:
+                del self.retry_after[owner]
+
+    def _failed(self, owner):
+        with self.lock:
+            self.retry_after[owner] = time.monotonic() + RETRY_INTERVAL
+
+    def _reference_messages(self, entry):
+        with self.lock:
+            self.references += 1
+            self.cached_tokens += entry['tokens']
+        # reset_ttl 让缓存在每次引用后重新计时
+        return [{"role": "cache", "content": f"cache_id={entry['id']};reset_ttl={self.ttl}"}]
+
+    def _delete_quietly(self, api_key, entry):
+        try:
+            self._delete(api_key, entry['id'])
+        except Exception:
+            pass  # 删除失败时等待上游按 ttl 过期
+
+    async def _adelete_quietly(self, api_key, entry):
+        try:
+            await self._adelete(api_key, entry['id'])
+        except Exception:
+            pass
+
+    def _create(self, api_key, messages):
+        """在上游登记缓存，返回 (缓存 id, token 数)"""
+        raise NotImplementedError
+
+    async def _acreate(self, api_key, messages):
+        raise NotImplementedError
+
+    def _delete(self, api_key, cache_id):
+        pass
+
+    async def _adelete(self, api_key, cache_id):
+        pass
+
+
+class LocalContextCache(ContextCache):
+    """本地替身：只在进程内记录被缓存的前缀，发出请求前展开引用"""
+
+    mode = 'local'
+
+    def resolve(self, messages):
+        full = self.expand(messages)
+        return full, full
+
+    def _create(self, api_key, messages):
+        return 'local-' + _digest(messages)[:24], None
+
+    async def _acreate(self, api_key, messages):
+        return self._create(api_key, messages)
+
+
+class MoonshotContextCache(ContextCache):
+    """Moonshot Context Caching：POST /caching 创建，请求中以 role=cache 的消息引用"""
+
+    mode = 'moonshot'
+
+    def __init__(self, session_factory, aiohttp_factory, **kwargs):
+        super().__init__(**kwargs)
+        self.session_factory = session_factory
+        self.aiohttp_factory = aiohttp_factory
+
+    @staticmethod
+    def _headers(api_key):
+        return {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'}
+
+    def _body(self, messages):
+        return {'model': CACHE_MODEL, 'messages': messages, 'ttl': self.ttl}
+
+    def _create(self, api_key, messages):
+        session = self.session_factory()
+        response = session.post(f'{API_BASE}/caching', headers=self._headers(api_key), json=self._body(messages), timeout=60)
+        response.raise_for_status()
+        cache = response.json()
+        for _ in range(READY_POLLS):
+            if cache.get('status') != 'pending':
+                break
+            time.sleep(READY_POLL_INTERVAL)
+            response = session.get(f"{API_BASE}/caching/{cache['id']}", headers=self._headers(api_key), timeout=30)
+            response.raise_for_status()
+            cache = response.json()
+        if cache.get('status') not in (None, 'ready'):
+            raise RuntimeError(f"上下文缓存创建失败：{cache.get('status')}")
+        return cache['id'], cache.get('tokens')
+
+    async def _acreate(self, api_key, messages):
+        session = self.aiohttp_factory()
+        async with session.post(f'{API_BASE}/caching', headers=self._headers(api_key), json=self._body(messages)) as response:
+            response.raise_for_status()
+            cache = await response.json()
+        for _ in range(READY_POLLS):
+            if cache.get('status') != 'pending':
+                break
+            await asyncio.sleep(READY_POLL_INTERVAL)
+            async with session.get(f"{API_BASE}/caching/{cache['id']}", headers=self._headers(api_key)) as response:
+                response.raise_for_status()
+                cache = await response.json()
+        if cache.get('status') not in (None, 'ready'):
+            raise RuntimeError(f"上下文缓存创建失败：{cache.get('status')}")
+        return cache['id'], cache.get('tokens')
+
+    def _delete(self, api_key, cache_id):
+        self.session_factory().delete(f'{API_BASE}/caching/{cache_id}', headers=self._headers(api_key), timeout=30)
+
+    async def _adelete(self, api_key, cache_id):
+        async with self.aiohttp_factory().delete(f'{API_BASE}/caching/{cache_id}', headers=self._headers(api_key)):
+            pass
+
+
+def create_context_cache(http_pool):
+    """根据 NOVEL_CONTEXT_CACHE（off/local/moonshot）创建上下文缓存"""
+    kind = os.environ.get('NOVEL_CONTEXT_CACHE', 'off')
+    if kind == 'off':
+        return ContextCache()
+    if kind == 'local':
+        return LocalContextCache()
+    if kind == 'moonshot':
+        return MoonshotContextCache(http_pool.sync_session, http_pool.aiohttp_session)
+    raise ValueError(f"未知的上下文缓存类型：{kind}")
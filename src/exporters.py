@@ -0,0 +1,195 @@
+"""DOCX / EPUB 导出
+
+两种格式都是 zip 容器。这里把 zip 写入一个只追加的缓冲区，每写完一节就把已压缩的字节交给调用方，
+不在内存中构建完整文档，可以直接作为分块 HTTP 响应输出。
+"""
+import uuid
+import zipfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+EPUB_MIMETYPE = 'application/epub+zip'
+
+
+class _ZipStream:
+    """zipfile 的输出目标：不可 seek，写入的数据暂存到 drain() 被取走为止"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _paragraphs(text):
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            yield escape(line)
+
+
+def _section_heading(chapter_num, section_num, title):
+    return f"第{chapter_num}章 第{section_num}节 {title}"
+
+
+_DOCX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>
+</Types>"""
+
+_DOCX_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+_DOCX_DOCUMENT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+_DOCX_STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+<w:docDefaults><w:rPrDefault><w:rPr><w:rFonts w:eastAsia="Microsoft YaHei"/><w:sz w:val="24"/></w:rPr></w:rPrDefault></w:docDefaults>
+<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/><w:pPr><w:spacing w:after="120" w:line="360" w:lineRule="auto"/><w:ind w:firstLineChars="200"/></w:pPr></w:style>
+<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/><w:pPr><w:jc w:val="center"/><w:ind w:firstLineChars="0"/></w:pPr><w:rPr><w:b/><w:sz w:val="44"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:basedOn w:val="Normal"/><w:pPr><w:keepNext/><w:spacing w:before="360"/><w:ind w:firstLineChars="0"/><w:outlineLvl w:val="0"/></w:pPr><w:rPr><w:b/><w:sz w:val="32"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading2"><w:name w:val="heading 2"/><w:basedOn w:val="Normal"/><w:pPr><w:keepNext/><w:spacing w:before="240"/><w:ind w:firstLineChars="0"/><w:outlineLvl w:val="1"/></w:pPr><w:rPr><w:b/><w:sz w:val="28"/></w:rPr></w:style>
+</w:styles>"""
+
+
+def _docx_paragraph(text, style=None):
+    style_xml = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ''
+    return f'<w:p>{style_xml}<w:r><w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+
+
+def iter_docx(title, background, sections):
+    """逐块产出 DOCX 文件的字节
+
+    sections: 按顺序产出 (chapter_number, section_number, {'title', 'content'}) 的可迭代对象
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', _DOCX_CONTENT_TYPES)
+        zf.writestr('_rels/.rels', _DOCX_RELS)
+        zf.writestr('word/_rels/document.xml.rels', _DOCX_DOCUMENT_RELS)
+        zf.writestr('word/styles.xml', _DOCX_STYLES)
+
+        with zf.open('word/document.xml', 'w') as doc:
+            def write(xml):
+                doc.write(xml.encode('utf-8'))
+
+            write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                  '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+            write(_docx_paragraph(escape(title), 'Title'))
+            write(_docx_paragraph('小说背景', 'Heading1'))
+            for paragraph in _paragraphs(background):
+                write(_docx_paragraph(paragraph))
+            write(_docx_paragraph('正文', 'Heading1'))
+            yield stream.drain()
+
+            for chapter_num, section_num, section in sections:
+                write(_docx_paragraph(escape(_section_heading(chapter_num, section_num, section['title'])), 'Heading2'))
+                for paragraph in _paragraphs(section['content']):
+                    write(_docx_paragraph(paragraph))
+                yield stream.drain()
+
+            write('<w:sectPr><w:pgSz w:w="11906" w:h="16838"/>'
+                  '<w:pgMar w:top="1440" w:right="1800" w:bottom="1440" w:left="1800"/></w:sectPr>'
+                  '</w:body></w:document>')
+    yield stream.drain()
+
+
+_EPUB_CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+
+def _xhtml(title, body):
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="zh">
+<head><meta charset="UTF-8"/><title>{title}</title></head>
+<body>
+{body}
+</body>
+</html>"""
+
+
+def iter_epub(title, background, sections):
+    """逐块产出 EPUB 3 文件的字节，每章一个 XHTML 文件，目录和清单在最后写入"""
+    stream = _ZipStream()
+    title = escape(title)
+    chapters = []  # [(文件名, 标题)]
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zf:
+        # mimetype 必须是第一个文件且不压缩
+        zf.writestr(zipfile.ZipInfo('mimetype'), EPUB_MIMETYPE, compress_type=zipfile.ZIP_STORED)
+        zf.writestr('META-INF/container.xml', _EPUB_CONTAINER)
+
+        body = ''.join(f'<p>{paragraph}</p>\n' for paragraph in _paragraphs(background))
+        zf.writestr('OEBPS/background.xhtml', _xhtml('小说背景', f'<h1>小说背景</h1>\n{body}'))
+        chapters.append(('background.xhtml', '小说背景'))
+        yield stream.drain()
+
+        chapter_file = None
+        current_chapter = None
+        for chapter_num, section_num, section in sections:
+            if chapter_num != current_chapter:
+                if chapter_file is not None:
+                    chapter_file.write(b'</body>\n</html>')
+                    chapter_file.close()
+                current_chapter = chapter_num
+                name = f'chapter{chapter_num}.xhtml'
+                chapters.append((name, f'第{chapter_num}章'))
+                chapter_file = zf.open(f'OEBPS/{name}', 'w')
+                head = _xhtml(f'第{chapter_num}章', '')
+                chapter_file.write(head[:head.rindex('</body>')].encode('utf-8'))
+                chapter_file.write(f'<h1>第{chapter_num}章</h1>\n'.encode('utf-8'))
+
+            heading = escape(_section_heading(chapter_num, section_num, section['title']))
+            chapter_file.write(f'<h2>{heading}</h2>\n'.encode('utf-8'))
+            for paragraph in _paragraphs(section['content']):
+                chapter_file.write(f'<p>{paragraph}</p>\n'.encode('utf-8'))
+            yield stream.drain()
+
+        if chapter_file is not None:
+            chapter_file.write(b'</body>\n</html>')
+            chapter_file.close()
+
+        nav_items = ''.join(f'<li><a href="{name}">{label}</a></li>\n' for name, label in chapters)
+        zf.writestr('OEBPS/nav.xhtml', _xhtml('目录', f'<nav epub:type="toc" id="toc"><h1>目录</h1>\n<ol>\n{nav_items}</ol></nav>'))
+
+        manifest = ''.join(
+            f'<item id="item{index}" href="{name}" media-type="application/xhtml+xml"/>\n'
+            for index, (name, _) in enumerate(chapters)
+        )
+        spine = ''.join(f'<itemref idref="item{index}"/>\n' for index in range(len(chapters)))
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        zf.writestr('OEBPS/content.opf', f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id" xml:lang="zh">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="book-id">urn:uuid:{uuid.uuid4()}</dc:identifier>
+<dc:title>{title}</dc:title>
+<dc:language>zh</dc:language>
+<meta property="dcterms:modified">{modified}</meta>
+</metadata>
+<manifest>
+<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+{manifest}</manifest>
+<spine>
+{spine}</spine>
+</package>""")
+    yield stream.drain()
@@ -0,0 +1,233 @@
+"""可取消的生成任务
+
+/generate_content、/generate_section 和批量生成在开始时登记为一个 Job，job_id 通过响应头 X-Job-Id
+（流式响应还有第一个 job 事件）返回；调用方也可以在请求中自带 job_id，以便在非流式请求返回前取消。
+任务在以下情况被取消：
+
+    requested     POST /cancel_job 指定 job_id，或只指定 session_id 取消该会话的全部任务
+    superseded    同一会话、同一目标（同一小节、同一批量任务）的新请求到达，即"重新生成"
+    disconnected  客户端断开连接
+
+同步接口在下一个分片到达时停止读取，异步接口立即取消等待中的协程，随后关闭上游流、断开连接。
+与其他请求合并的上游调用（SingleFlight）在所有订阅者都离开后才中止。
+"""
+import asyncio
+import re
+import threading
+import uuid
+from datetime import datetime
+
+import metrics
+
+# 调用方自带的 job_id 会出现在响应头中，只接受这些字符
+JOB_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+REASONS = {
+    'requested': "生成已取消",
+    'superseded': "已有新的生成请求，本次生成已取消",
+    'disconnected': "客户端已断开连接",
+}
+
+JOBS_CANCELLED = metrics.REGISTRY.register(metrics.Counter(
+    'novel_jobs_cancelled_total', '被取消的生成任务数（requested 主动取消、superseded 被新请求取代、disconnected 客户端断开）',
+    ('reason',)))
+
+
+class JobCancelled(Exception):
+    def __init__(self, reason):
+        super().__init__(REASONS.get(reason, REASONS['requested']))
+        self.reason = reason
+
+
+class Job:
+    """一个进行中的生成任务，cancel 可以在任意线程调用"""
+
+    def __init__(self, registry, kind, session_id=None, target=(), job_id=None):
+        self.registry = registry
+        self.job_id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.session_id = session_id
+        self.target = tuple(target)
+        self.reason = None  # 取消原因，未取消时为 None
+        self.superseded = False  # 是否取代了进行中的旧任务（重新生成）
+        self.started_at = datetime.now()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def cancel(self, reason='requested'):
+        """取消任务，已取消时返回 False"""
+        with self.lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            callbacks, self.callbacks = self.callbacks, []
+        JOBS_CANCELLED.inc(reason=reason)
+        for callback in callbacks:
+            callback()
+        return True
+
+    def on_cancel(self, callback):
+        with self.lock:
+            if self.reason is None:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def check(self):
+        if self.reason is not None:
+            raise JobCancelled(self.reason)
+
+    def finish(self):
+        """任务结束（响应发送完毕或连接关闭）后从登记表中移除"""
+        with self.lock:
+            self.callbacks = []
+        self.registry.finish(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.finish()
+
+    def guard(self, events):
+        """转发事件流，任务被取消时抛出 JobCancelled；生成器被关闭（客户端断开）时关闭上游流"""
+        try:
+            for event in events:
+                self.check()
+                yield event
+        except GeneratorExit:
+            if self.reason is None:
+                JOBS_CANCELLED.inc(reason='disconnected')
+            raise
+        finally:
+            events.close()
+
+    def collect(self, events):
+        """读完事件流，返回 (完整正文, done 事件的内容)；非流式接口也以流式读取上游，才能中途取消"""
+        parts = []
+        done = None
+        for kind, payload in self.guard(events):
+            if kind == 'delta':
+                parts.append(payload)
+            else:
+                done = payload
+        return ''.join(parts), done
+
+    def _on_cancel_threadsafe(self, loop, callback):
+        """取消可能发生在其他线程（/cancel_job 由 Flask 处理），回调转到事件循环中执行"""
+        def schedule():
+            try:
+                loop.call_soon_threadsafe(callback)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+        self.on_cancel(schedule)
+
+    async def aguard(self, events):
+        """guard 的异步版本：取消时若正在等待下一个事件，立即中断等待（不为每个事件单独建任务）"""
+        task = asyncio.current_task()
+        state = {'waiting': False, 'interrupted': False}
+
+        def interrupt():
+            if state['waiting'] and not state['interrupted']:
+                state['interrupted'] = True
+                task.cancel()
+
+        self._on_cancel_threadsafe(asyncio.get_running_loop(), interrupt)
+        try:
+            while True:
+                self.check()
+                state['waiting'] = True
+                try:
+                    event = await events.__anext__()
+                except StopAsyncIteration:
+                    return
+                except asyncio.CancelledError:
+                    if not state['interrupted']:
+                        raise
+                    # 由本任务的取消引起，转为 JobCancelled，协程继续运行以返回错误
+                    if hasattr(task, 'uncancel'):
+                        task.uncancel()
+                    raise JobCancelled(self.reason) from None
+                finally:
+                    state['waiting'] = False
+                yield event
+        finally:
+            await events.aclose()
+
+    async def arun(self, awaitable):
+        """等待协程完成并返回结果，任务被取消时取消该协程并抛出 JobCancelled"""
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(awaitable)
+        waiter = loop.create_future()
+        self._on_cancel_threadsafe(loop, lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                raise JobCancelled(self.reason)
+            return task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.wait({task})
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'session_id': self.session_id,
+            'target': list(self.target),
+            'status': 'cancelled' if self.cancelled else 'running',
+            'reason': self.reason,
+            'started_at': self.started_at.isoformat()
+        }
+
+
+class JobRegistry:
+    """一个写手（API Key）进行中的任务，按 job_id 保存"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def start(self, kind, session_id=None, target=(), job_id=None):
+        """登记新任务并取消同一会话、同一目标上仍在进行的旧任务；job_id 不合法时另行生成"""
+        if job_id is not None and not JOB_ID_PATTERN.fullmatch(str(job_id)):
+            job_id = None
+        job = Job(self, kind, session_id, target, job_id)
+        with self.lock:
+            superseded = [
+                other for other in self.jobs.values()
+                if session_id and (other.kind, other.session_id, other.target) == (kind, session_id, job.target)
+            ]
+            if job.job_id in self.jobs and self.jobs[job.job_id] not in superseded:
+                superseded.append(self.jobs[job.job_id])
+            self.jobs[job.job_id] = job
+        for other in superseded:
+            other.cancel('superseded')
+        job.superseded = bool(superseded)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def running(self, session_id=None):
+        with self.lock:
+            return [job for job in self.jobs.values() if session_id is None or job.session_id == session_id]
+
+    def cancel(self, job_id=None, session_id=None, reason='requested'):
+        """取消指定任务，或会话的全部任务，返回被取消的任务"""
+        if job_id is not None:
+            jobs = [job for job in [self.get(job_id)] if job is not None and (session_id is None or job.session_id == session_id)]
+        else:
+            jobs = self.running(session_id)
+        return [job for job in jobs if job.cancel(reason)]
+
+    def finish(self, job):
+        with self.lock:
+            if self.jobs.get(job.job_id) is job:
+                del self.jobs[job.job_id]
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.llm_cache')
+
+# 每次请求可选的缓存模式
+# prefer: 命中则直接返回，未命中时调用接口并写入缓存
+# bypass: 不读缓存，总是调用接口，但用新结果刷新缓存
+CACHE_MODES = ('prefer', 'bypass')
+
+# 磁盘缓存的总字节数上限，超出后按写入时间从旧到新删除
+MAX_DISK_BYTES = 256 * 1024 * 1024
+
+
+class ResponseCache:
+    """按内容寻址的接口响应缓存：内存 LRU 在前，磁盘目录在后
+
+    键为 (model, messages, temperature, max_tokens) 的 SHA-256，值为可 JSON 序列化的字典。
+    磁盘部分的总大小不超过 max_disk_bytes：首次写入时扫描目录建立 {键: 字节数} 索引（按修改时间排序），
+    之后每次写入后从最早写入的文件开始删除，直到总大小回到上限以内。
+    """
+
+    def __init__(self, max_entries=256, directory=DEFAULT_CACHE_DIR, max_disk_bytes=MAX_DISK_BYTES):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_files = None  # 磁盘缓存索引 {键: 字节数}，按写入先后排列，首次写入时建立
+        self.disk_bytes = 0
+        self.disk_evictions = 0
+        self.disk_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens, n=1):
+        fields = {'model': model, 'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens}
+        if n != 1:
+            # 只在多候选时计入 n，已有的缓存键保持不变
+            fields['n'] = n
+        payload = json.dumps(fields, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        value = self._read_disk(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self._remember(key, value)
+        self._write_disk(key, value)
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, value):
+        if not self.directory:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再替换，避免并发读到半个文件
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+            size = f.tell()
+        os.replace(tmp_path, path)
+        self._track_disk(key, size)
+
+    def _scan_disk(self):
+        """按修改时间从旧到新列出目录中已有的缓存文件"""
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, name[:-len('.json')], stat.st_size))
+        found.sort()
+        return OrderedDict((key, size) for _, key, size in found)
+
+    def _track_disk(self, key, size):
+        with self.disk_lock:
+            if self.disk_files is None:
+                # 扫描结果已包含刚写入的文件
+                self.disk_files = self._scan_disk()
+                self.disk_bytes = sum(self.disk_files.values())
+            else:
+                self.disk_bytes += size - self.disk_files.pop(key, 0)
+                self.disk_files[key] = size
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk_files) > 1:
+                oldest, oldest_size = self.disk_files.popitem(last=False)
+                self.disk_bytes -= oldest_size
+                self.disk_evictions += 1
+                try:
+                    os.remove(self._path(oldest))
+                except OSError:
+                    pass  # 可能已被共用目录的其他进程删除
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'memory_hits': self.hits - self.disk_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_entries': len(self.entries),
+                'disk_bytes': self.disk_bytes,
+                'disk_evictions': self.disk_evictions
+            }
+
+
+def create_cache():
+    """根据环境变量创建缓存：NOVEL_CACHE_SIZE 为内存条目数，NOVEL_CACHE_DIR 为空字符串时不落盘，
+    NOVEL_CACHE_DISK_MB 为磁盘缓存的大小上限（MB）"""
+    return ResponseCache(
+        max_entries=int(os.environ.get('NOVEL_CACHE_SIZE', 256)),
+        directory=os.environ.get('NOVEL_CACHE_DIR', DEFAULT_CACHE_DIR),
+        max_disk_bytes=int(float(os.environ.get('NOVEL_CACHE_DISK_MB', MAX_DISK_BYTES / (1024 * 1024))) * 1024 * 1024)
+    )
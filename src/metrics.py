@@ -0,0 +1,218 @@
+"""运行指标
+
+以 Prometheus 文本格式在 /metrics 输出：上游调用的首 token 时间和总耗时、token 用量、错误类型、
+并发数，以及接口的请求数和耗时。缓存命中、请求合并等由各组件自己计数，
+应用启动时以 Callback 登记，抓取时读取。指标只在当前进程内统计，多 worker 部署时按进程分别采集。
+"""
+import threading
+import time
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labels}")
+        return tuple((name, labels[name]) for name in self.labels)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f'{self.name}{_format_labels(key)} {_format_value(value)}' for key, value in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.values = {}  # 标签 -> [各桶计数, 总和, 次数]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0, 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        with self.lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(key + (("le", _format_value(bound)),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+class Callback(_Metric):
+    """抓取时才计算的指标，fn 返回数值或 [(标签字典, 数值), ...]"""
+
+    def __init__(self, name, help, kind, fn):
+        super().__init__(name, help)
+        self.kind = kind
+        self.fn = fn
+
+    def render(self):
+        values = self.fn()
+        if not isinstance(values, list):
+            values = [({}, values)]
+        return self.header() + [
+            f'{self.name}{_format_labels(tuple(sorted(labels.items())))} {_format_value(value)}' for labels, value in values
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+UPSTREAM_IN_FLIGHT = REGISTRY.register(Gauge(
+    'novel_upstream_in_flight', '正在进行的上游调用数', ('kind',)))
+UPSTREAM_LATENCY = REGISTRY.register(Histogram(
+    'novel_upstream_latency_seconds', '上游调用总耗时（流式调用到最后一个分片为止）', LATENCY_BUCKETS, ('model', 'kind')))
+UPSTREAM_TTFT = REGISTRY.register(Histogram(
+    'novel_upstream_ttft_seconds', '流式调用收到第一个文本分片的耗时', TTFT_BUCKETS, ('model',)))
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    'novel_upstream_errors_total', '上游调用失败次数（含随后重试成功的）', ('kind', 'type')))
+PROMPT_TOKENS = REGISTRY.register(Histogram(
+    'novel_upstream_prompt_tokens', '单次调用的输入 token 数', TOKEN_BUCKETS, ('model',)))
+COMPLETION_TOKENS = REGISTRY.register(Histogram(
+    'novel_upstream_completion_tokens', '单次调用的输出 token 数', TOKEN_BUCKETS, ('model',)))
+TOKENS = REGISTRY.register(Counter(
+    'novel_upstream_tokens_total', '累计 token 用量', ('model', 'type')))
+HTTP_IN_FLIGHT = REGISTRY.register(Gauge(
+    'novel_http_in_flight', '正在处理的接口请求数', ('route',)))
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    'novel_http_requests_total', '接口请求数', ('route', 'method', 'status')))
+HTTP_DURATION = REGISTRY.register(Histogram(
+    'novel_http_request_duration_seconds', '接口耗时（流式响应到连接关闭为止）', LATENCY_BUCKETS, ('route',)))
+
+
+class UpstreamCall:
+    """记录一次上游调用，finish 只生效一次"""
+
+    def __init__(self, model, kind):
+        self.model = model
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.first_token_seen = False
+        self.finished = False
+        UPSTREAM_IN_FLIGHT.inc(kind=kind)
+
+    def first_token(self):
+        if not self.first_token_seen:
+            self.first_token_seen = True
+            UPSTREAM_TTFT.observe(time.perf_counter() - self.started, model=self.model)
+
+    def finish(self, usage=None, error=None):
+        """usage 为接口返回的用量；error 为异常或描述失败原因的字符串"""
+        if self.finished:
+            return
+        self.finished = True
+        UPSTREAM_IN_FLIGHT.dec(kind=self.kind)
+        if error is not None:
+            UPSTREAM_ERRORS.inc(kind=self.kind, type=error if isinstance(error, str) else type(error).__name__)
+            return
+        UPSTREAM_LATENCY.observe(time.perf_counter() - self.started, model=self.model, kind=self.kind)
+        if usage:
+            for metric, field in ((PROMPT_TOKENS, 'prompt_tokens'), (COMPLETION_TOKENS, 'completion_tokens')):
+                value = usage.get(field) or 0
+                metric.observe(value, model=self.model)
+                TOKENS.inc(value, model=self.model, type=field[:-len('_tokens')])
+
+
+class RequestTimer:
+    """记录一次接口请求，finish 在响应结束（流式响应关闭）时调用"""
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.started = time.perf_counter()
+        self.finished = False
+        HTTP_IN_FLIGHT.inc(route=route)
+
+    def finish(self, status):
+        if self.finished:
+            return
+        self.finished = True
+        HTTP_IN_FLIGHT.dec(route=self.route)
+        HTTP_REQUESTS.inc(route=self.route, method=self.method, status=str(status))
+        HTTP_DURATION.observe(time.perf_counter() - self.started, route=self.route)
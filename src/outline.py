@@ -0,0 +1,123 @@
+"""大纲解析
+
+把大纲阶段输出的 "第N章 …… 第M节 ……" 文本解析为章节树：
+    [{'number': 1, 'title': '章名', 'sections': [{'number': 1, 'title': '节标题', 'summary': '概要'}, ...]}, ...]
+"""
+import re
+
+_DIGITS = {'零': 0, '〇': 0, '一': 1, '二': 2, '两': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_NUMBER = r'([0-9]+|[零〇一二两三四五六七八九十百]+)'
+# 允许行首带有 Markdown 标记，如 "### 第1章" 或 "**第1节**"
+_PREFIX = r'^[\s#*>\-]*'
+_CHAPTER = re.compile(_PREFIX + r'第\s*' + _NUMBER + r'\s*章[\s*:：]*(.*)$')
+_SECTION = re.compile(_PREFIX + r'第\s*' + _NUMBER + r'\s*节[\s*]*([^：:]*)[：:]?\s*(.*)$')
+
+
+def parse_number(text):
+    """解析阿拉伯数字或一百以内的中文数字"""
+    if text.isdigit():
+        return int(text)
+    total = 0
+    current = 0
+    for char in text:
+        if char == '百':
+            total += (current or 1) * 100
+            current = 0
+        elif char == '十':
+            total += (current or 1) * 10
+            current = 0
+        else:
+            current = _DIGITS[char]
+    return total + current
+
+
+def _clean(text):
+    return text.strip().strip('*').strip()
+
+
+def parse_outline(text):
+    """解析大纲文本，返回按章节号排序的章节列表；同一章重复出现时以后出现的为准"""
+    chapters = {}
+    chapter = None
+    section = None
+    for line in text.splitlines():
+        match = _CHAPTER.match(line)
+        if match:
+            number = parse_number(match.group(1))
+            chapter = {'number': number, 'title': _clean(match.group(2)), 'sections': []}
+            chapters[number] = chapter
+            section = None
+            continue
+
+        match = _SECTION.match(line)
+        if match and chapter is not None:
+            section = {
+                'number': parse_number(match.group(1)),
+                'title': _clean(match.group(2)),
+                'summary': _clean(match.group(3))
+            }
+            chapter['sections'].append(section)
+            continue
+
+        line = line.strip()
+        if line and section is not None:
+            # 概要跨行时接到当前小节后面
+            section['summary'] = f"{section['summary']}\n{line}" if section['summary'] else line
+    return [chapters[number] for number in sorted(chapters)]
+
+
+def merge_chapters(chapters, new_chapters):
+    """把新解析出的章节合并进已有章节，同号章节被替换"""
+    merged = {chapter['number']: chapter for chapter in chapters}
+    merged.update({chapter['number']: chapter for chapter in new_chapters})
+    return [merged[number] for number in sorted(merged)]
+
+
+def find_section(chapters, chapter_number, section_number):
+    """返回 (chapter, section)，找不到时对应位置为 None"""
+    for chapter in chapters:
+        if chapter['number'] == int(chapter_number):
+            for section in chapter['sections']:
+                if section['number'] == int(section_number):
+                    return chapter, section
+            return chapter, None
+    return None, None
+
+
+def chapter_heading(chapter):
+    return f"第{chapter['number']}章 {chapter['title']}".strip()
+
+
+def outline_slice(chapters, chapter_number, section_number):
+    """只取与当前小节相关的大纲：所在章标题、上一节概要、本节概要和下一节标题"""
+    chapter, section = find_section(chapters, chapter_number, section_number)
+    if section is None:
+        return ''
+
+    lines = [chapter_heading(chapter)]
+    index = chapter['sections'].index(section)
+    if index > 0:
+        previous = chapter['sections'][index - 1]
+        lines.append(f"（上一节）第{previous['number']}节 {previous['title']}：{previous['summary']}")
+    lines.append(f"（本节）第{section['number']}节 {section['title']}：{section['summary']}")
+    if index + 1 < len(chapter['sections']):
+        following = chapter['sections'][index + 1]
+        lines.append(f"（下一节）第{following['number']}节 {following['title']}")
+    return '\n'.join(lines)
+
+
+def outline_text(chapters):
+    """把章节树还原为大纲文本"""
+    lines = []
+    for chapter in chapters:
+        lines.append(chapter_heading(chapter))
+        for section in chapter['sections']:
+            lines.append(f"  第{section['number']}节 {section['title']}：{section['summary']}")
+    return '\n'.join(lines)
+
+
+def iter_outline_sections(chapters):
+    """按顺序产出 (chapter, section)"""
+    for chapter in chapters:
+        for section in chapter['sections']:
+            yield chapter, section
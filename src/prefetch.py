@@ -0,0 +1,210 @@
+"""小节预生成
+
+用户阅读刚生成的第 N 节时，按保存的大纲在后台先生成第 N+1 节，结果只留在内存中。用户随后请求
+第 N+1 节且大纲、背景等输入与预生成时一致，就直接返回（仍在生成时跟随其进度），不再等待上游；
+大纲或背景被修改、重新生成第 N 节时，进行中的预生成被中止，已完成的结果被丢弃。
+
+预生成与正常请求共用同一 API Key 的限流额度，每个会话同时只有一个预生成。
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from outline import iter_outline_sections
+
+# NOVEL_PREFETCH=1 时默认开启，请求中的 "prefetch" 字段可以逐次覆盖
+PREFETCH_ENABLED = os.environ.get('NOVEL_PREFETCH', '0') == '1'
+PREFETCH_WORKERS = int(os.environ.get('NOVEL_PREFETCH_WORKERS', 4))
+# 预生成结果在内存中保留的秒数
+PREFETCH_TTL = int(os.environ.get('NOVEL_PREFETCH_TTL', 1800))
+
+# 异步请求跟随进行中的预生成时的轮询间隔（秒）
+FOLLOW_POLL_INTERVAL = 0.05
+
+# 决定生成内容的请求字段，与预生成时不一致的结果不能使用
+INPUT_FIELDS = ('title', 'genre', 'chapter_title', 'background', 'outline')
+
+executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+
+PREFETCHES = metrics.REGISTRY.register(metrics.Counter(
+    'novel_prefetch_total', '小节预生成的结果（served 命中、discarded 作废、failed 失败）', ('result',)))
+
+
+def is_enabled(data):
+    """请求是否开启预生成"""
+    return bool(data.get('prefetch', PREFETCH_ENABLED))
+
+
+def next_section(chapters, chapter_number, section_number):
+    """返回大纲中排在指定小节之后的 (chapter, section)，已是最后一节时返回 None"""
+    sections = iter_outline_sections(chapters)
+    for chapter, section in sections:
+        if chapter['number'] == int(chapter_number) and section['number'] == int(section_number):
+            return next(sections, None)
+    return None
+
+
+class Speculation:
+    """一次预生成：增量文本逐段记录在 parts 中，供请求方回放并跟随"""
+
+    def __init__(self, chapter_number, section_number, inputs):
+        self.chapter_number = chapter_number
+        self.section_number = section_number
+        self.inputs = inputs
+        self.parts = []
+        self.result = None  # 完成后为 done 事件的内容
+        self.error = None
+        self.cancelled = False
+        self.finished = False
+        self.created = time.monotonic()
+        self.condition = threading.Condition()
+
+    def matches(self, chapter_number, section_number, data):
+        return (
+            (self.chapter_number, self.section_number) == (int(chapter_number), int(section_number))
+            and all(self.inputs.get(field) == data.get(field) for field in INPUT_FIELDS)
+        )
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def follow(self):
+        """回放已生成的部分并跟随后续进度，产出 ('delta', 文本) 和最后的 ('done', {...})"""
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.parts) and not self.finished:
+                    self.condition.wait()
+                parts = self.parts[index:]
+                finished = self.finished
+            for part in parts:
+                yield 'delta', part
+            index += len(parts)
+            if finished and index >= len(self.parts):
+                break
+        if self.error is not None:
+            raise self.error
+        yield 'done', self.result
+
+    async def afollow(self):
+        """follow 的异步版本，预生成在线程中进行，这里轮询进度"""
+        index = 0
+        while True:
+            with self.condition:
+                parts = self.parts[index:]
+                finished = self.finished
+            for part in parts:
+                yield 'delta', part
+            index += len(parts)
+            if finished and index >= len(self.parts):
+                break
+            if not parts:
+                await asyncio.sleep(FOLLOW_POLL_INTERVAL)
+        if self.error is not None:
+            raise self.error
+        yield 'done', self.result
+
+    def wait(self):
+        """等待完成，返回完整正文"""
+        for _ in self.follow():
+            pass
+        return ''.join(self.parts)
+
+    async def await_content(self):
+        """wait 的异步版本"""
+        async for _ in self.afollow():
+            pass
+        return ''.join(self.parts)
+
+
+class Prefetcher:
+    """一个写手（API Key）的预生成，按 session_id 保存"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.speculations = {}  # session_id -> Speculation
+        self.lock = threading.Lock()
+
+    def schedule(self, session_id, chapter_number, section_number):
+        """第 N 节保存后调用：取代会话已有的预生成，开始生成大纲中的下一节"""
+        self.discard(session_id)
+        outline = self.writer.get_outline(session_id)
+        following = next_section(outline['chapters'], chapter_number, section_number) if outline else None
+        if following is None:
+            return None
+        chapter, section = following
+        existing = self.writer.get_chapter_sections(session_id, chapter['number'])
+        if len(existing) >= section['number'] and existing[section['number'] - 1]:
+            return None
+
+        data = self.writer.fill_section_request({
+            'session_id': session_id, 'chapter_number': chapter['number'], 'section_number': section['number']
+        })
+        if not all(data.get(field) for field in INPUT_FIELDS):
+            return None
+        speculation = Speculation(chapter['number'], section['number'], {field: data[field] for field in INPUT_FIELDS})
+        with self.lock:
+            self.speculations[session_id] = speculation
+        executor.submit(self._run, session_id, speculation)
+        return speculation
+
+    def take(self, session_id, chapter_number, section_number, data):
+        """取出与请求一致的预生成（可能仍在进行），不一致时作废并返回 None"""
+        with self.lock:
+            speculation = self.speculations.get(session_id)
+            if speculation is None:
+                return None
+            del self.speculations[session_id]
+            if speculation.error is not None:
+                return None  # 失败时已计数
+            expired = time.monotonic() - speculation.created > PREFETCH_TTL
+            if expired or not speculation.matches(chapter_number, section_number, data):
+                speculation.cancel()
+                PREFETCHES.inc(result='discarded')
+                return None
+        PREFETCHES.inc(result='served')
+        return speculation
+
+    def discard(self, session_id):
+        """大纲、背景改变或重新生成上一节时调用，中止并丢弃会话的预生成"""
+        with self.lock:
+            speculation = self.speculations.pop(session_id, None)
+        if speculation is not None:
+            speculation.cancel()
+            PREFETCHES.inc(result='discarded')
+
+    def _run(self, session_id, speculation):
+        inputs = speculation.inputs
+        memory = self.writer.story_memory(
+            session_id, speculation.chapter_number, speculation.section_number, inputs['outline']
+        )
+        events = self.writer.stream_section(
+            inputs['title'], inputs['genre'], inputs['chapter_title'], speculation.section_number,
+            inputs['background'], inputs['outline'], memory, session_id
+        )
+        try:
+            for kind, payload in events:
+                with speculation.condition:
+                    if speculation.cancelled:
+                        break
+                    if kind == 'delta':
+                        speculation.parts.append(payload)
+                    else:
+                        speculation.result = payload
+                    speculation.condition.notify_all()
+        except Exception as e:
+            speculation.error = e
+            PREFETCHES.inc(result='failed')
+        finally:
+            # 中止时关闭生成器，上游流随之断开
+            events.close()
+            with speculation.condition:
+                if speculation.result is None and speculation.error is None:
+                    speculation.error = RuntimeError("预生成已取消")
+                speculation.finished = True
+                speculation.condition.notify_all()
@@ -0,0 +1,294 @@
+"""提示词模板
+
+所有提示词在启动时编译一次，按名称和版本登记，可以按小说类型覆盖。
+模板先放每次调用都不变的内容（system、书名、类型、背景），再放随小节变化的内容，
+同一会话的请求共享字节完全相同的前缀，便于上游的上下文缓存命中。
+
+覆盖模板放在 NOVEL_PROMPT_DIR 目录下的 JSON 文件中，每个文件是一个模板或模板列表：
+    {"name": "section.task", "genre": "穿越", "version": 2, "user": "..."}
+"""
+import glob
+import json
+import os
+import threading
+from string import Formatter
+
+from tokens import estimate_messages_tokens, estimate_tokens
+
+
+def _compile(text):
+    """把 {name} 占位符模板拆成 [(字面文本, None) 或 (None, 字段名)]"""
+    pieces = []
+    for literal, field, _, _ in Formatter().parse(text):
+        if literal:
+            pieces.append((literal, None))
+        if field is not None:
+            if not field.isidentifier():
+                raise ValueError(f"提示词模板中的占位符无效：{{{field}}}")
+            pieces.append((None, field))
+    return pieces
+
+
+class PromptTemplate:
+    """编译后的提示词模板，render 返回 system + user 两条消息"""
+
+    def __init__(self, name, system, user, version=1, genre=None):
+        self.name = name
+        self.version = version
+        self.genre = genre
+        self.system = _compile(system)
+        self.user = _compile(user)
+        self.fields = {field for _, field in self.system + self.user if field}
+        # 模板自身（不含占位符内容）的 token 数
+        self.static_tokens = estimate_tokens(''.join(literal for literal, field in self.system + self.user if literal))
+        self.renders = 0
+        self.total_tokens = 0
+        self.max_tokens = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _render(pieces, fields):
+        return ''.join(literal if field is None else str(fields[field]) for literal, field in pieces)
+
+    def render(self, **fields):
+        missing = self.fields - fields.keys()
+        if missing:
+            raise ValueError(f"提示词模板 {self.name} 缺少字段：{', '.join(sorted(missing))}")
+        messages = [{"role": "user", "content": self._render(self.user, fields)}]
+        if self.system:
+            messages.insert(0, {"role": "system", "content": self._render(self.system, fields)})
+
+        tokens = estimate_messages_tokens(messages)
+        with self.lock:
+            self.renders += 1
+            self.total_tokens += tokens
+            self.max_tokens = max(self.max_tokens, tokens)
+        return messages
+
+    def stats(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'version': self.version,
+                'genre': self.genre,
+                'static_tokens': self.static_tokens,
+                'renders': self.renders,
+                'avg_tokens': round(self.total_tokens / self.renders) if self.renders else 0,
+                'max_tokens': self.max_tokens
+            }
+
+
+class PromptRegistry:
+    """按 (名称, 类型) 登记模板的各个版本，默认使用最高版本
+
+    查找时先找与小说类型完全一致的覆盖模板，找不到再用通用模板。
+    """
+
+    def __init__(self, templates=()):
+        self.templates = {}  # (name, genre) -> {version: PromptTemplate}
+        for template in templates:
+            self.register(template)
+
+    def register(self, template):
+        base = self.templates.get((template.name, None))
+        if template.genre and base:
+            # 覆盖模板只能使用通用模板已有的字段，调用方不会传入其他字段
+            fields = set().union(*(t.fields for t in base.values()))
+            unknown = template.fields - fields
+            if unknown:
+                raise ValueError(f"提示词模板 {template.name}（{template.genre}）使用了未知字段：{', '.join(sorted(unknown))}")
+        self.templates.setdefault((template.name, template.genre), {})[template.version] = template
+
+    def load_dir(self, directory):
+        """加载目录下所有 JSON 模板文件"""
+        for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            for spec in data if isinstance(data, list) else [data]:
+                self.register(PromptTemplate(
+                    spec['name'], spec.get('system', ''), spec['user'],
+                    version=spec.get('version', 1), genre=spec.get('genre') or None
+                ))
+
+    def get(self, name, genre=None, version=None):
+        versions = self.templates.get((name, genre)) or self.templates.get((name, None))
+        if not versions:
+            raise ValueError(f"未知的提示词模板：{name}")
+        if version is None:
+            return versions[max(versions)]
+        if version not in versions:
+            raise ValueError(f"提示词模板 {name} 没有版本 {version}")
+        return versions[version]
+
+    def render(self, name, **fields):
+        """按 fields 中的 genre 选择模板并渲染为消息列表"""
+        return self.get(name, fields.get('genre')).render(**fields)
+
+    def stats(self):
+        return [
+            template.stats()
+            for key in sorted(self.templates, key=lambda key: (key[0], key[1] or ''))
+            for _, template in sorted(self.templates[key].items())
+        ]
+
+
+_OUTLINE_SYSTEM = "你是一个专业的小说策划，专注于创作详细的章节大纲。"
+
+_OUTLINE_PART = """小说：《{{title}}》
+类型：{{genre}}
+
+请为这部小说创作第{first}章到第{last}章的详细大纲。这是小说的{phase}阶段。
+要求：
+1. 必须生成{first}-{last}章的内容，每章4-5节
+2. 每节提供300-500字的详细内容概要
+{extra}{n}. 按照以下格式输出：
+第{first}章 章节名
+  第1节 节标题：（详细概要）
+  第2节 节标题：（详细概要）
+  ...（确保每章至少4节）
+第{second}章 章节名
+  ...（以此类推直到第{last}章）"""
+
+
+def _outline_part(first, last, phase, extra=''):
+    return _OUTLINE_PART.format(
+        first=first, second=first + 1, last=last, phase=phase,
+        extra=f"3. {extra}\n" if extra else '', n=4 if extra else 3
+    )
+
+
+BUILTIN_TEMPLATES = [
+    PromptTemplate('outline.background', "你是一个专业的小说策划，专注于创作背景设定和人物塑造。", """小说：《{title}》
+类型：{genre}
+
+请为这部小说创作背景设定和人物介绍。
+要求：
+1. 详细的故事背景设定（至少500字）
+2. 主要人物介绍（包括性格特点和人物关系，每个主要人物至少200字）
+3. 列出3个重要的故事转折点，并说明这些转折点分别发生在第几章
+4. 【重要】故事结构按照"序章-发展-高潮-结局"四个阶段展开，每个阶段3-4章
+格式：
+- 故事背景：
+- 主要人物：
+- 重要转折点：
+- 故事结构规划："""),
+
+    PromptTemplate('outline.part1', _OUTLINE_SYSTEM, _outline_part(1, 6, '序章和发展')),
+    PromptTemplate('outline.part2', _OUTLINE_SYSTEM, _outline_part(7, 12, '高潮和高潮延续', '确保情节连贯')),
+    PromptTemplate('outline.part3', _OUTLINE_SYSTEM, _outline_part(13, 15, '结局', '确保完整的故事闭环，所有伏笔和情节都得到合理的解决')),
+
+    PromptTemplate('structure.analyze', "你是一个专业的小说策划，专注于故事结构设计和情节规划。", """类型：{genre}
+
+背景信息：
+{background}
+
+请分析这部小说的故事结构并规划章节分布。
+要求：
+1. 总章节数不超过30章
+2. 按照"引子-铺垫-发展-高潮-结局"五个阶段规划
+3. 明确每个阶段的章节数量
+4. 为每个阶段设定明确的情节目标
+5. 规划主要人物的成长弧线
+6. 设计故事的主要转折点
+7. 安排伏笔和线索的埋设点
+
+请按以下格式输出：
+- 总体结构：
+- 各阶段章节分布：
+- 主要情节线索：
+- 人物成长规划：
+- 重要转折点：
+- 伏笔安排："""),
+
+    # 小节提示词分为两段：section.context 对同一部小说的所有小节都相同，可以登记为上游上下文缓存；
+    # section.task 是本节特有的内容
+    PromptTemplate('section.context', "你是一个专业的小说写手，专注于创作精彩的章节内容。", """小说：《{title}》
+类型：{genre}
+
+背景信息：
+{background}{outline_block}"""),
+
+    PromptTemplate('section.task', '', """{memory_block}章节大纲：
+{outline}
+
+请为这部小说的{chapter_title}生成第{section_number}节的详细内容。
+要求：
+1. 字数在3000-4000字之间
+2. 场景描写要具体细腻，调动多种感官
+3. 人物对话要体现性格特点和情感变化
+4. 注重环境氛围的营造
+5. 细节描写要为情节服务
+6. 保持人物性格的一致性和成长性
+7. 注意伏笔的埋设和呼应
+8. 确保与其他小节的情节连贯
+9. 运用恰当的写作手法
+10. 节奏把控要合理，重要场景要细致
+11. 通过细节体现人物性格
+12. 适当加入象征性的意象
+
+格式要求：
+1. 分段要合理，段落长度适中
+2. 重要对话和场景要单独成段
+3. 适当使用空行区分场景转换"""),
+
+    PromptTemplate('section.continue', '', "请紧接上文最后一句继续创作，不要重复已经写过的内容，不要添加标题或说明，直到本节情节完整收尾。"),
+
+    PromptTemplate('section.summarize', "你是一个专业的小说编辑，擅长提炼情节要点。", """请阅读下面的小说片段，输出：
+概要：（150字以内，只写推动情节的关键事件和悬念）
+人物：
+人物名：当前状态（处境、情绪、与他人关系的变化，30字以内）
+
+小说片段：
+{content}"""),
+
+    PromptTemplate('content.write', """你是一个专业的{genre}小说写手。请根据提供的信息，创作一节精彩的小说内容。
+要求：
+1. 字数在4000-6000字之间，重要情节可以突破这个限制
+2. 情节要符合大纲设定，注重细节描写
+3. 要有细腻的人物刻画和情感描写
+4. 注意与其他章节的连贯性
+5. 根据{genre}小说的特点，融入相应的元素和细节
+6. 分段落呈现，使用优美的中文写作
+7. 重要场景要放慢节奏，增加细节描写
+8. 对话要自然，符合人物身份和性格
+9. 注重环境和氛围的营造
+10. 适当运用各种写作手法，如白描、细描、心理描写等""", """小说名：《{title}》
+类型：{genre}
+故事大纲：{outline}
+
+请根据以上信息创作以下小节的内容：
+章节名：{chapter_title}
+小节名：{section_title}
+
+要求：
+1. 创作长度至少4000字，重要情节可以更长
+2. 场景细节要丰富
+3. 人物对话要生动
+4. 确保与整体故事情节连贯"""),
+
+    PromptTemplate('background.revise', "你是一个专业的小说策划，专注于创作背景设定。", """小说：《{title}》
+类型：{genre}
+
+当前背景：
+{current_content}
+
+修改建议：
+{suggestion}
+
+请根据以上建议修改这部小说的背景设定。
+要求：
+1. 保持原有设定的核心要素
+2. 根据修改建议进行优化和扩充
+3. 确保修改后的内容更加丰富和完整
+4. 保持文风的一致性
+5. 注意细节的连贯性"""),
+]
+
+
+def create_registry():
+    """加载内置模板，NOVEL_PROMPT_DIR 指定的目录中的模板可以覆盖或追加新版本"""
+    registry = PromptRegistry(BUILTIN_TEMPLATES)
+    directory = os.environ.get('NOVEL_PROMPT_DIR')
+    if directory:
+        registry.load_dir(directory)
+    return registry
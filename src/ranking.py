@@ -0,0 +1,91 @@
+"""候选稿的本地排序
+
+"一次生成几版、挑最好的一版"时，上游一次返回 N 个候选，这里不再调用模型，只用几项廉价的
+启发式指标打分：
+
+    length      字数是否达到目标：不足按比例扣分，超过目标两倍后逐渐扣分
+    coverage    参考文本（大纲、修改意见）中的关键词在候选中出现的比例
+    repetition  候选自身重复片段的比例，记分时取 1 - 重复率
+
+中文不做分词，关键词取参考文本中的汉字二元组（去掉含常见虚词的组合），英文和数字按单词计。
+"""
+import re
+
+# 各项指标在总分中的权重
+WEIGHTS = {'length': 0.3, 'coverage': 0.4, 'repetition': 0.3}
+# 检测重复时比较的片段长度（字）
+SHINGLE_CHARS = 8
+# 含这些字的二元组多为虚词搭配，不作为关键词
+STOP_CHARS = frozenset('的了是在和与及或就都也而着把被让给向从对这那之其个不有为以于上下中他她它们我你')
+
+_HAN = re.compile(r'[\u4e00-\u9fff]+')
+_WORD = re.compile(r'[A-Za-z0-9]{2,}')
+_SPACE = re.compile(r'\s+')
+
+
+def keywords(text):
+    """参考文本的关键词集合：汉字二元组和英文、数字单词"""
+    terms = {word.lower() for word in _WORD.findall(text or '')}
+    for run in _HAN.findall(text or ''):
+        for i in range(len(run) - 1):
+            pair = run[i:i + 2]
+            if pair[0] not in STOP_CHARS and pair[1] not in STOP_CHARS:
+                terms.add(pair)
+    return terms
+
+
+def length_score(text, target_chars):
+    if not target_chars:
+        return 1.0
+    length = len(text)
+    if length < target_chars:
+        return length / target_chars
+    if length > 2 * target_chars:
+        return max(0.0, 1 - (length - 2 * target_chars) / (2 * target_chars))
+    return 1.0
+
+
+def coverage(text, terms):
+    """terms 中在 text 里出现的比例，没有关键词时为 1"""
+    if not terms:
+        return 1.0
+    return len(terms & keywords(text)) / len(terms)
+
+
+def repetition_rate(text):
+    """长度为 SHINGLE_CHARS 的片段中重复出现的比例"""
+    compact = _SPACE.sub('', text)
+    total = len(compact) - SHINGLE_CHARS + 1
+    if total <= 1:
+        return 0.0
+    distinct = {compact[i:i + SHINGLE_CHARS] for i in range(total)}
+    return 1 - len(distinct) / total
+
+
+def score(text, terms=frozenset(), target_chars=None):
+    """返回 (总分, 各项得分)"""
+    scores = {
+        'length': length_score(text, target_chars),
+        'coverage': coverage(text, terms),
+        'repetition': 1 - repetition_rate(text),
+    }
+    return sum(WEIGHTS[name] * value for name, value in scores.items()), scores
+
+
+def rank(candidates, reference='', target_chars=None):
+    """按得分从高到低排列候选，返回 [{'index', 'content', 'chars', 'score', 'scores'}]
+    index 为候选在上游返回中的序号，得分相同时保持原顺序
+    """
+    terms = keywords(reference)
+    ranked = []
+    for index, content in enumerate(candidates):
+        total, scores = score(content, terms, target_chars)
+        ranked.append({
+            'index': index,
+            'content': content,
+            'chars': len(content),
+            'score': round(total, 4),
+            'scores': {name: round(value, 4) for name, value in scores.items()}
+        })
+    ranked.sort(key=lambda item: -item['score'])
+    return ranked
@@ -0,0 +1,250 @@
+"""上游限流
+
+Moonshot 按 API Key 限制并发数、每分钟请求数（RPM）和每分钟 token 数（TPM）。
+UpstreamLimiter 在发起请求前按两个令牌桶排队，并按 AIMD 调整并发上限：
+每次成功缓慢增加，遇到 429/5xx 时减半；可重试的错误按带抖动的指数退避重试。
+"""
+import asyncio
+import itertools
+import os
+import random
+import threading
+import time
+
+import openai.error
+
+# 默认值对应 Moonshot 一档用户的配额，可通过环境变量调整
+RPM = int(os.environ.get('NOVEL_UPSTREAM_RPM', 200))
+TPM = int(os.environ.get('NOVEL_UPSTREAM_TPM', 128000))
+MAX_CONCURRENCY = int(os.environ.get('NOVEL_UPSTREAM_CONCURRENCY', 50))
+MAX_RETRIES = int(os.environ.get('NOVEL_UPSTREAM_RETRIES', 4))
+
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+# 两次减半之间的最短间隔，避免同一波 429 把并发上限直接压到 1
+DECREASE_INTERVAL = 2.0
+# 异步调用等待并发名额时的轮询间隔
+ASYNC_POLL_INTERVAL = 0.05
+
+_RETRYABLE = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.TryAgain,
+)
+
+
+def is_quota_exhausted(error):
+    """余额不足同样返回 429，重试没有意义"""
+    detail = getattr(error, 'error', None)
+    return bool(detail) and 'quota' in str(detail.get('type', ''))
+
+
+def is_retryable(error):
+    if isinstance(error, openai.error.RateLimitError):
+        return not is_quota_exhausted(error)
+    if isinstance(error, _RETRYABLE):
+        return True
+    return isinstance(error, openai.error.APIError) and (error.http_status or 0) >= 500
+
+
+def retry_after(error):
+    """读取上游返回的 Retry-After（秒），没有时返回 None"""
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """每分钟补充 per_minute 个令牌的令牌桶
+
+    允许透支：reserve 立即扣除令牌并返回调用方需要等待的秒数，先到先得。
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        with self.lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount):
+        """归还预扣多出的令牌"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdaptiveConcurrency:
+    """AIMD 并发上限：每次成功加 1/limit（约每轮加 1），过载时减半"""
+
+    def __init__(self, maximum, initial=None, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or max(minimum, maximum // 4))
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(ASYNC_POLL_INTERVAL)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def on_success(self):
+        with self.condition:
+            previous = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if int(self.limit) > previous:
+                self.condition.notify()
+
+    def on_overload(self):
+        with self.condition:
+            now = time.monotonic()
+            if now - self.last_decrease >= DECREASE_INTERVAL:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.last_decrease = now
+
+
+class UpstreamLimiter:
+    """单个 API Key 的上游限流器
+
+    cost 为本次请求预估占用的 token 数（提示词 + max_tokens），请求完成后通过 settle 按实际用量归还多扣的部分。
+    上游给出 Retry-After 时，同一个 Key 的所有请求都暂停到该时间之后。
+    """
+
+    def __init__(self, rpm=RPM, tpm=TPM, max_concurrency=MAX_CONCURRENCY, max_retries=MAX_RETRIES):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _admission_delay(self, cost):
+        delay = max(self.requests.reserve(1), self.tokens.reserve(cost))
+        with self.lock:
+            return max(delay, self.paused_until - time.monotonic())
+
+    def _failed(self, error, cost, attempt):
+        """记录一次失败，返回重试前需要等待的秒数；不应重试时返回 None"""
+        self.tokens.refund(cost)
+        if not is_retryable(error):
+            return None
+        self.concurrency.on_overload()
+        if attempt >= self.max_retries:
+            return None
+
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+        wait = retry_after(error)
+        if wait is not None:
+            with self.lock:
+                self.paused_until = max(self.paused_until, time.monotonic() + wait)
+            delay = max(delay, wait)
+        return delay
+
+    def settle(self, cost, usage):
+        """按接口返回的 usage 归还预扣多出的 token"""
+        if usage and usage.get('total_tokens'):
+            self.tokens.refund(max(0, cost - usage['total_tokens']))
+
+    def _open(self, fn, cost):
+        """在限流下执行 fn()，成功时返回结果并继续占用一个并发名额"""
+        for attempt in itertools.count():
+            time.sleep(self._admission_delay(cost))
+            self.concurrency.acquire()
+            try:
+                return fn()
+            except Exception as e:
+                self.concurrency.release()
+                delay = self._failed(e, cost, attempt)
+                if delay is None:
+                    raise
+            except BaseException:
+                # 请求被取消
+                self.concurrency.release()
+                raise
+            time.sleep(delay)
+
+    async def _aopen(self, fn, cost):
+        for attempt in itertools.count():
+            await asyncio.sleep(self._admission_delay(cost))
+            await self.concurrency.aacquire()
+            try:
+                return await fn()
+            except Exception as e:
+                self.concurrency.release()
+                delay = self._failed(e, cost, attempt)
+                if delay is None:
+                    raise
+            except BaseException:
+                # 请求被取消
+                self.concurrency.release()
+                raise
+            await asyncio.sleep(delay)
+
+    def call(self, fn, cost):
+        """限流并按需重试地调用 fn()，返回其结果"""
+        result = self._open(fn, cost)
+        self.concurrency.on_success()
+        self.concurrency.release()
+        return result
+
+    async def acall(self, fn, cost):
+        """call 的异步版本，fn() 返回协程"""
+        result = await self._aopen(fn, cost)
+        self.concurrency.on_success()
+        self.concurrency.release()
+        return result
+
+    def stream(self, fn, cost):
+        """fn() 返回流式响应，逐个产出分片；流读完之前一直占用并发名额
+
+        只在建立连接时重试，已经开始输出后出错直接抛出。
+        """
+        response = self._open(fn, cost)
+        try:
+            yield from response
+            self.concurrency.on_success()
+        finally:
+            self.concurrency.release()
+
+    async def astream(self, fn, cost):
+        response = await self._aopen(fn, cost)
+        try:
+            async for chunk in response:
+                yield chunk
+            self.concurrency.on_success()
+        finally:
+            self.concurrency.release()
@@ -0,0 +1,177 @@
+"""小节正文的增量存储
+
+内存存储中，每个会话的小节正文都追加写入同一个只追加的文本区（TextArena），小节的每个版本只记录
+若干 (片段号, 起点, 终点) 区间。修改以编辑列表提交，新版本复用未改动的区间，只把新写入的文字追加到
+文本区，因此修改的开销与改动量成正比，历史版本之间共享正文。
+
+编辑列表的格式（偏移量为基准版本中的字符位置，区间左闭右开，各编辑互不重叠）：
+    [{"start": 120, "end": 135, "text": "替换后的文字"}, {"start": 800, "end": 800, "text": "插入的文字"}]
+"""
+import os
+import sys
+from datetime import datetime
+
+# 每个小节保留的历史版本数
+MAX_VERSIONS = int(os.environ.get('NOVEL_SECTION_VERSIONS', 20))
+# 一个版本的区间数超过该值时重新拼成一整段，避免多次小修改后读取变慢
+MAX_SPANS = 64
+
+
+class VersionConflict(ValueError):
+    """编辑基于的版本不是小节的当前版本"""
+
+    def __init__(self, current_version):
+        super().__init__(f"小节已被修改，当前版本为 {current_version}，请基于最新版本重新编辑")
+        self.current_version = current_version
+
+
+def normalize_edits(edits, length):
+    """校验编辑列表并按位置排序，返回 [(start, end, text)]"""
+    if not isinstance(edits, list) or not edits:
+        raise ValueError("edits 应为非空列表")
+    try:
+        parsed = sorted((int(edit['start']), int(edit['end']), edit.get('text') or '') for edit in edits)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise ValueError("每个编辑应包含整数 start、end 和字符串 text")
+    previous_end = 0
+    for start, end, text in parsed:
+        if not isinstance(text, str):
+            raise ValueError("编辑的 text 应为字符串")
+        if start < previous_end or end < start or end > length:
+            raise ValueError(f"编辑区间 [{start}, {end}) 越界或与其他编辑重叠（正文长度 {length}）")
+        previous_end = end
+    return parsed
+
+
+def apply_edits(content, edits):
+    """把已校验的编辑应用到字符串上"""
+    parts = []
+    position = 0
+    for start, end, text in edits:
+        parts.append(content[position:start])
+        parts.append(text)
+        position = end
+    parts.append(content[position:])
+    return ''.join(parts)
+
+
+class TextArena:
+    """会话内所有小节共用的只追加文本区，不再被任何版本引用的片段置为 None 释放"""
+
+    __slots__ = ('pieces', 'bytes')
+
+    def __init__(self):
+        self.pieces = []
+        self.bytes = 0
+
+    def append(self, text):
+        self.pieces.append(text)
+        self.bytes += sys.getsizeof(text)
+        return len(self.pieces) - 1
+
+    def release(self, indices):
+        for index in indices:
+            if self.pieces[index] is not None:
+                self.bytes -= sys.getsizeof(self.pieces[index])
+                self.pieces[index] = None
+
+    def read(self, spans):
+        return ''.join(self.pieces[piece][start:end] for piece, start, end in spans)
+
+
+class _Version:
+    __slots__ = ('number', 'title', 'spans', 'length', 'kind', 'created_at')
+
+    def __init__(self, number, title, spans, kind):
+        self.number = number
+        self.title = title
+        self.spans = spans
+        self.length = sum(end - start for _, start, end in spans)
+        self.kind = kind
+        self.created_at = datetime.now()
+
+    def info(self):
+        return {'version': self.number, 'title': self.title, 'length': self.length,
+                'kind': self.kind, 'created_at': self.created_at.isoformat()}
+
+
+def _cut(spans, start, end):
+    """取出逻辑区间 [start, end) 对应的区间列表"""
+    result = []
+    offset = 0
+    for piece, piece_start, piece_end in spans:
+        length = piece_end - piece_start
+        if offset + length > start and offset < end:
+            lo = max(start - offset, 0)
+            hi = min(end - offset, length)
+            result.append((piece, piece_start + lo, piece_start + hi))
+        offset += length
+        if offset >= end:
+            break
+    return result
+
+
+class SectionRecord:
+    """一个小节的版本历史，最新版本在末尾"""
+
+    __slots__ = ('versions',)
+
+    def __init__(self):
+        self.versions = []
+
+    @property
+    def current(self):
+        return self.versions[-1] if self.versions else None
+
+    def version(self, number=None):
+        if number is None:
+            return self.current
+        for version in self.versions:
+            if version.number == number:
+                return version
+        raise ValueError(f"版本 {number} 不存在或已被清理")
+
+    def text(self, arena, number=None):
+        return arena.read(self.version(number).spans)
+
+    def save(self, arena, title, content, kind='save'):
+        """整体写入新正文（生成、重新生成）"""
+        spans = ((arena.append(content), 0, len(content)),) if content else ()
+        return self._add(arena, title, spans, kind)
+
+    def edit(self, arena, edits, base_version=None, title=None):
+        """在当前版本上应用编辑，只追加新写入的文字；base_version 与当前版本不一致时抛出 VersionConflict"""
+        current = self.current
+        if current is None:
+            raise ValueError("小节不存在")
+        if base_version is not None and int(base_version) != current.number:
+            raise VersionConflict(current.number)
+        spans = []
+        added = []
+        position = 0
+        for start, end, text in normalize_edits(edits, current.length):
+            spans.extend(_cut(current.spans, position, start))
+            if text:
+                added.append(arena.append(text))
+                spans.append((added[-1], 0, len(text)))
+            position = end
+        spans.extend(_cut(current.spans, position, current.length))
+        if len(spans) > MAX_SPANS:
+            content = arena.read(spans)
+            arena.release(added)
+            spans = [(arena.append(content), 0, len(content))]
+        return self._add(arena, title or current.title, tuple(spans), 'edit')
+
+    def history(self):
+        return [version.info() for version in self.versions]
+
+    def _add(self, arena, title, spans, kind):
+        number = self.current.number + 1 if self.versions else 1
+        version = _Version(number, title, spans, kind)
+        self.versions.append(version)
+        if len(self.versions) > MAX_VERSIONS:
+            dropped = self.versions[:-MAX_VERSIONS]
+            del self.versions[:-MAX_VERSIONS]
+            kept = {piece for kept_version in self.versions for piece, _, _ in kept_version.spans}
+            arena.release({piece for old in dropped for piece, _, _ in old.spans} - kept)
+        return version
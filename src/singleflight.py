@@ -0,0 +1,230 @@
+"""合并相同的在途请求
+
+用户连点"生成"或前端重试时，同一请求会同时发出多次。SingleFlight 以请求指纹为键，
+后到的重复请求直接挂到正在进行的那一次上：非流式请求共享同一个结果，
+流式请求共享同一条上游 token 流，后加入的订阅者先回放已收到的片段再继续接收。
+
+各接口的 fresh 参数为 True 时不加入进行中的调用，而是另行发起并取代它成为该键的在途调用，已有的等待者
+仍在原来的调用上。"重新生成"取代旧任务时使用：旧请求虽已取消，但可能还没来得及离开在途调用。
+"""
+import asyncio
+import threading
+
+_END = object()
+
+
+class _Flight:
+    """一条正在进行的流，事件缓存在 events 中供所有订阅者读取
+
+    没有专门的读取线程：读到缓存末尾的订阅者负责从上游拉取下一个事件（同一时刻只有一个），
+    因此最先发起请求的客户端断开后，其余订阅者仍能把流读完。
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.events = []
+        self.done = False
+        self.error = None
+        self.pumping = False
+        self.subscribers = 0
+        self.condition = None  # 同步流：threading.Condition
+        self.changed = None  # 异步流：每记录一个事件就触发并替换的 asyncio.Event
+        self.pump_task = None
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同一个键同时只有一次上游调用，同步接口用于线程，a 开头的接口用于事件循环"""
+
+    def __init__(self):
+        self.calls = {}
+        self.flights = {}
+        self.tasks = {}
+        self.aflights = {}
+        self.coalesced = 0  # 被合并掉的重复请求数
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, fresh=False):
+        """执行 fn() 并返回结果；相同 key 的调用正在进行时等待并共享它的结果或异常"""
+        with self.lock:
+            call = None if fresh else self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    if self.calls.get(key) is call:
+                        del self.calls[key]
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def ado(self, key, fn, fresh=False):
+        """do 的异步版本，fn() 返回协程；发起者取消时上游调用继续进行，供其他等待者使用，
+        所有等待者都被取消（客户端断开、任务取消）后才中止上游调用"""
+        entry = None if fresh else self.tasks.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(fn())
+            entry = self.tasks[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, entry))
+        else:
+            self.coalesced += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # 正在中止的调用不再接受新的等待者，之后的相同请求会重新发起
+                self._forget(key, entry)
+                task.cancel()
+
+    def _forget(self, key, entry):
+        if self.tasks.get(key) is entry:
+            del self.tasks[key]
+
+    def stream(self, key, fn, fresh=False):
+        """订阅 fn() 产出的事件流，相同 key 的流正在进行时从头回放并跟随它"""
+        with self.lock:
+            flight = None if fresh else self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = _Flight(fn())
+                flight.condition = threading.Condition()
+            else:
+                self.coalesced += 1
+            flight.subscribers += 1
+
+        index = 0
+        try:
+            while True:
+                with flight.condition:
+                    while index >= len(flight.events) and not flight.done and flight.pumping:
+                        flight.condition.wait()
+                    event = self._next_event(flight, index)
+                if event is None:
+                    self._pump(self.flights, flight, key)
+                elif event is _END:
+                    return
+                else:
+                    index += 1
+                    yield event
+        finally:
+            if self._leave(self.flights, flight, key):
+                # 所有订阅者都已离开，关闭上游流
+                flight.source.close()
+
+    async def astream(self, key, fn, fresh=False):
+        """stream 的异步版本，fn() 返回异步生成器"""
+        flight = None if fresh else self.aflights.get(key)
+        if flight is None:
+            flight = self.aflights[key] = _Flight(fn())
+            flight.changed = asyncio.Event()
+        else:
+            self.coalesced += 1
+        flight.subscribers += 1
+
+        index = 0
+        try:
+            while True:
+                while index >= len(flight.events) and not flight.done and flight.pumping:
+                    await flight.changed.wait()
+                event = self._next_event(flight, index)
+                if event is None:
+                    await self._apump(flight, key)
+                elif event is _END:
+                    return
+                else:
+                    index += 1
+                    yield event
+        finally:
+            if self._leave(self.aflights, flight, key):
+                if flight.pump_task is not None and not flight.pump_task.done():
+                    # 拉取中的订阅者被取消，取消拉取任务即可中止上游流
+                    flight.pump_task.cancel()
+                else:
+                    await flight.source.aclose()
+
+    @staticmethod
+    def _next_event(flight, index):
+        """返回第 index 个事件；流已结束返回 _END（出错时抛出）；需要由调用方拉取时返回 None"""
+        if index < len(flight.events):
+            return flight.events[index]
+        if flight.done:
+            if flight.error is not None:
+                raise flight.error
+            return _END
+        flight.pumping = True
+        return None
+
+    def _pump(self, flights, flight, key):
+        try:
+            event, error = next(flight.source), None
+        except StopIteration:
+            event, error = _END, None
+        except Exception as e:
+            event, error = _END, e
+        with flight.condition:
+            self._record(flights, flight, key, event, error)
+            flight.condition.notify_all()
+
+    async def _apump(self, flight, key):
+        # 拉取放在独立任务中，当前订阅者被取消时其他订阅者仍能拿到这个事件
+        flight.pump_task = asyncio.ensure_future(flight.source.__anext__())
+        flight.pump_task.add_done_callback(lambda task: self._apumped(flight, key, task))
+        try:
+            await asyncio.shield(flight.pump_task)
+        except Exception:
+            pass  # 结果已由 _apumped 记录
+
+    def _apumped(self, flight, key, task):
+        if task.cancelled():
+            event, error = _END, asyncio.CancelledError()
+        elif isinstance(task.exception(), StopAsyncIteration):
+            event, error = _END, None
+        elif task.exception() is not None:
+            event, error = _END, task.exception()
+        else:
+            event, error = task.result(), None
+        self._record(self.aflights, flight, key, event, error)
+        changed, flight.changed = flight.changed, asyncio.Event()
+        changed.set()
+
+    def _record(self, flights, flight, key, event, error):
+        flight.pumping = False
+        if event is not _END:
+            flight.events.append(event)
+            return
+        flight.done = True
+        flight.error = error
+        # 已结束的流不再接受新订阅者，之后的相同请求会重新发起
+        with self.lock:
+            if flights.get(key) is flight:
+                del flights[key]
+
+    def _leave(self, flights, flight, key):
+        """订阅者离开，返回是否需要关闭上游流"""
+        with self.lock:
+            flight.subscribers -= 1
+            abandoned = flight.subscribers == 0 and not flight.done
+            if abandoned and flights.get(key) is flight:
+                del flights[key]
+        return abandoned
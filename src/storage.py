@@ -0,0 +1,787 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sections import MAX_VERSIONS, SectionRecord, TextArena, VersionConflict, apply_edits, normalize_edits
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'novels.db')
+
+# 内存存储的会话闲置时长（秒）和总内存上限（MB）
+SESSION_TTL = int(os.environ.get('NOVEL_SESSION_TTL', 7 * 24 * 3600))
+MEMORY_LIMIT = int(os.environ.get('NOVEL_MEMORY_LIMIT_MB', 512)) * 1024 * 1024
+# 清理过期会话的最短间隔（秒）
+SWEEP_INTERVAL = 60
+# stats 中列出的占用最多的会话数
+STATS_TOP_SESSIONS = 10
+# SQLite 中小节修改以增量保存，每隔多少个版本保存一次全文
+SNAPSHOT_INTERVAL = 10
+
+
+class Storage:
+    """NovelWriter 的状态存储接口
+
+    保存五类数据：生成进度（progress）、故事上下文（story_context）、解析后的大纲（outlines）、小节内容（sections）
+    和由小节内容提取的一致性索引（consistency，格式见 consistency.py）。
+    小节保留最近 MAX_VERSIONS 个版本，修改以编辑列表提交。
+    另外保存 client_id 到 API Key 的登记（clients），多个 worker 共用存储时任一 worker 都能找到调用方的 writer。
+    """
+
+    def get_progress(self, session_id):
+        raise NotImplementedError
+
+    def update_progress(self, session_id, fields):
+        """把 fields 合并进会话进度"""
+        raise NotImplementedError
+
+    def get_story_context(self, session_id):
+        raise NotImplementedError
+
+    def save_story_context(self, session_id, context):
+        raise NotImplementedError
+
+    def update_story_context(self, session_id, updater):
+        """在同一事务内读取并修改故事上下文，会话不存在时返回 None"""
+        raise NotImplementedError
+
+    def get_consistency_index(self, session_id):
+        """返回会话的一致性索引，尚未建立时返回 None"""
+        raise NotImplementedError
+
+    def update_consistency_index(self, session_id, updater):
+        """在同一事务内读取并修改一致性索引，尚未建立时 updater 收到空字典"""
+        raise NotImplementedError
+
+    def save_section(self, session_id, chapter_number, section_number, title, content):
+        """整体写入小节正文，作为新版本保存，返回版本号"""
+        raise NotImplementedError
+
+    def edit_section(self, session_id, chapter_number, section_number, edits, base_version=None, title=None):
+        """在当前版本上应用编辑列表（格式见 sections.py），返回 {'version', 'length'}
+        base_version 不是当前版本时抛出 VersionConflict；小节不存在时抛出 ValueError
+        """
+        raise NotImplementedError
+
+    def get_section(self, session_id, chapter_number, section_number, version=None):
+        """返回 {'title', 'content', 'version'}，version 为空时取当前版本；小节不存在时返回 None"""
+        raise NotImplementedError
+
+    def section_history(self, session_id, chapter_number, section_number):
+        """返回保留的各版本 [{'version', 'title', 'length', 'kind', 'created_at'}]，从旧到新"""
+        raise NotImplementedError
+
+    def get_chapter_sections(self, session_id, chapter_number):
+        """返回按小节顺序排列的列表，缺失的小节以 None 占位"""
+        raise NotImplementedError
+
+    def iter_sections(self, session_id):
+        """按章节、小节顺序产出 (chapter_number, section_number, {'title', 'content'})"""
+        raise NotImplementedError
+
+    def get_outline(self, session_id):
+        """返回解析后的大纲 {'title', 'genre', 'background', 'chapters'}，不存在时返回 None"""
+        raise NotImplementedError
+
+    def save_outline(self, session_id, outline):
+        raise NotImplementedError
+
+    def save_client(self, client_id, api_key, last_used):
+        """登记或刷新 client_id，last_used 为 time.time() 时间戳"""
+        raise NotImplementedError
+
+    def get_client(self, client_id):
+        """返回 (API Key, 最近使用时间)，未登记时返回 None"""
+        raise NotImplementedError
+
+    def expire_clients(self, before):
+        """删除最近使用时间早于 before 的登记"""
+        raise NotImplementedError
+
+    def stats(self):
+        """存储的占用情况"""
+        raise NotImplementedError
+
+
+def _sizeof(value):
+    """估算对象占用的内存字节数（含嵌套的字典、列表）"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_sizeof(key) + _sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_sizeof(item) for item in value)
+    return size
+
+
+def _copy(value):
+    """深拷贝存入或取出的数据，调用方在锁外读写副本，与其他请求互不影响（同 SQLiteStorage 的序列化语义）"""
+    return pickle.loads(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class _Session:
+    """一个会话的全部数据，各部分分别记录占用的字节数"""
+
+    __slots__ = ('progress', 'story_context', 'outline', 'sections', 'arena', 'consistency', 'sizes', 'accessed')
+
+    def __init__(self):
+        self.progress = {}
+        self.story_context = None
+        self.outline = None
+        self.sections = {}  # (章节号, 小节号) -> SectionRecord
+        self.arena = TextArena()  # 所有小节正文所在的文本区
+        self.consistency = None
+        self.sizes = {'progress': 0, 'story_context': 0, 'outline': 0, 'sections': 0, 'consistency': 0}
+        self.accessed = time.monotonic()
+
+    @property
+    def bytes(self):
+        return sum(self.sizes.values())
+
+    def measure(self, part):
+        if part == 'sections':
+            # 正文占绝大部分，版本记录按每个区间约 100 字节计
+            spans = sum(len(version.spans) + 1 for record in self.sections.values() for version in record.versions)
+            self.sizes[part] = self.arena.bytes + spans * 100
+        else:
+            self.sizes[part] = _sizeof(getattr(self, part))
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in ('progress', 'story_context', 'outline', 'sections', 'arena', 'consistency')}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for name, value in state.items():
+            setattr(self, name, value)
+        for part in self.sizes:
+            self.measure(part)
+
+
+class MemoryStorage(Storage):
+    """进程内存储，重启后数据丢失，适合开发和测试
+
+    数据按会话保存，占用的内存有上限：闲置超过 ttl 秒的会话被删除；总字节数超过 max_bytes 时，
+    最久未访问的会话被换出到 spill_dir（再次访问时读回），未设置 spill_dir 时直接丢弃。
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_bytes=MEMORY_LIMIT, spill_dir=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.sessions = OrderedDict()  # session_id -> _Session，按最近访问排序
+        self.clients = {}  # client_id -> (API Key, 最近使用时间)
+        self.total_bytes = 0
+        self.evicted = 0
+        self.spilled = 0
+        self.expired = 0
+        self.last_sweep = time.monotonic()
+        self.lock = threading.RLock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, session_id):
+        name = hashlib.sha256(session_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.spill_dir, name + '.pickle')
+
+    def _session(self, session_id, create=False):
+        """取出会话并标记为最近访问；内存中没有时尝试从换出目录读回"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self._load_spilled(session_id)
+            if session is None:
+                if not create:
+                    return None
+                session = _Session()
+            self.sessions[session_id] = session
+            self.total_bytes += session.bytes
+        self.sessions.move_to_end(session_id)
+        session.accessed = time.monotonic()
+        return session
+
+    def _load_spilled(self, session_id):
+        if not self.spill_dir:
+            return None
+        path = self._spill_path(session_id)
+        try:
+            with open(path, 'rb') as f:
+                session = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        # 读回后以内存中的数据为准
+        os.remove(path)
+        return session
+
+    def _measure(self, session, part):
+        before = session.sizes[part]
+        session.measure(part)
+        self.total_bytes += session.sizes[part] - before
+
+    def _remove(self, session_id):
+        session = self.sessions.pop(session_id)
+        self.total_bytes -= session.bytes
+        return session
+
+    def _spill(self, session_id, session):
+        path = self._spill_path(session_id)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(session, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def _enforce_limits(self):
+        """写入后调用：删除过期会话，超出内存上限时换出最久未访问的会话"""
+        now = time.monotonic()
+        if now - self.last_sweep >= SWEEP_INTERVAL:
+            self.last_sweep = now
+            self._sweep_expired(now)
+        # 至少保留刚写入的会话
+        while self.total_bytes > self.max_bytes and len(self.sessions) > 1:
+            session_id, session = next(iter(self.sessions.items()))
+            self._remove(session_id)
+            if self.spill_dir:
+                self._spill(session_id, session)
+                self.spilled += 1
+            else:
+                self.evicted += 1
+
+    def _sweep_expired(self, now):
+        for session_id, session in list(self.sessions.items()):
+            # 按访问顺序排列，遇到未过期的会话即可停止
+            if now - session.accessed < self.ttl:
+                break
+            self._remove(session_id)
+            self.expired += 1
+        if self.spill_dir:
+            cutoff = time.time() - self.ttl
+            for entry in os.scandir(self.spill_dir):
+                if entry.name.endswith('.pickle') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    self.expired += 1
+
+    def get_progress(self, session_id):
+        with self.lock:
+            session = self._session(session_id)
+            return _copy(session.progress) if session else {}
+
+    def update_progress(self, session_id, fields):
+        with self.lock:
+            session = self._session(session_id, create=True)
+            session.progress.update(_copy(fields))
+            self._measure(session, 'progress')
+            self._enforce_limits()
+
+    def get_story_context(self, session_id):
+        with self.lock:
+            session = self._session(session_id)
+            return _copy(session.story_context) if session else None
+
+    def save_story_context(self, session_id, context):
+        with self.lock:
+            session = self._session(session_id, create=True)
+            session.story_context = _copy(context)
+            self._measure(session, 'story_context')
+            self._enforce_limits()
+
+    def update_story_context(self, session_id, updater):
+        with self.lock:
+            session = self._session(session_id)
+            if session is None or session.story_context is None:
+                return None
+            updater(session.story_context)
+            self._measure(session, 'story_context')
+            self._enforce_limits()
+            return _copy(session.story_context)
+
+    def get_consistency_index(self, session_id):
+        with self.lock:
+            session = self._session(session_id)
+            return session.consistency if session else None
+
+    def update_consistency_index(self, session_id, updater):
+        with self.lock:
+            session = self._session(session_id, create=True)
+            # 在副本上修改后整体替换，生成小节时正在读取的旧索引不受影响
+            index = _copy(session.consistency) if session.consistency else {}
+            updater(index)
+            session.consistency = index
+            self._measure(session, 'consistency')
+            self._enforce_limits()
+            return session.consistency
+
+    def _section_record(self, session_id, chapter_number, section_number):
+        session = self._session(session_id)
+        record = session.sections.get((int(chapter_number), int(section_number))) if session else None
+        if record is None:
+            raise ValueError(f"第{chapter_number}章第{section_number}节不存在")
+        return session, record
+
+    def _measure_sections(self, session, before_bytes, before_spans, after_spans):
+        # 只按文本区和区间数的变化调整，不遍历整个会话
+        delta = session.arena.bytes - before_bytes + (after_spans - before_spans) * 100
+        session.sizes['sections'] += delta
+        self.total_bytes += delta
+
+    def _record_spans(self, record):
+        return sum(len(version.spans) + 1 for version in record.versions)
+
+    def save_section(self, session_id, chapter_number, section_number, title, content):
+        with self.lock:
+            session = self._session(session_id, create=True)
+            record = session.sections.setdefault((int(chapter_number), int(section_number)), SectionRecord())
+            before = session.arena.bytes, self._record_spans(record)
+            version = record.save(session.arena, title, content)
+            self._measure_sections(session, *before, self._record_spans(record))
+            self._enforce_limits()
+            return version.number
+
+    def edit_section(self, session_id, chapter_number, section_number, edits, base_version=None, title=None):
+        with self.lock:
+            session, record = self._section_record(session_id, chapter_number, section_number)
+            before = session.arena.bytes, self._record_spans(record)
+            version = record.edit(session.arena, edits, base_version, title)
+            self._measure_sections(session, *before, self._record_spans(record))
+            self._enforce_limits()
+            return {'version': version.number, 'length': version.length}
+
+    def get_section(self, session_id, chapter_number, section_number, version=None):
+        with self.lock:
+            try:
+                session, record = self._section_record(session_id, chapter_number, section_number)
+            except ValueError:
+                return None
+            current = record.version(version)
+            return {'title': current.title, 'content': record.text(session.arena, version), 'version': current.number}
+
+    def section_history(self, session_id, chapter_number, section_number):
+        with self.lock:
+            _, record = self._section_record(session_id, chapter_number, section_number)
+            return record.history()
+
+    def get_chapter_sections(self, session_id, chapter_number):
+        with self.lock:
+            session = self._session(session_id)
+            if session is None:
+                return []
+            numbers = sorted(section for chapter, section in session.sections if chapter == int(chapter_number))
+            sections = [None] * (numbers[-1] if numbers else 0)
+            for number in numbers:
+                record = session.sections[(int(chapter_number), number)]
+                sections[number - 1] = {'title': record.current.title, 'content': record.text(session.arena)}
+            return sections
+
+    def iter_sections(self, session_id):
+        with self.lock:
+            session = self._session(session_id)
+            keys = sorted(session.sections) if session else []
+        # 逐节读取正文，导出时不需要一次性拼出全书
+        for chapter_number, section_number in keys:
+            with self.lock:
+                record = session.sections.get((chapter_number, section_number))
+                if record is None:
+                    continue
+                section = {'title': record.current.title, 'content': record.text(session.arena)}
+            yield chapter_number, section_number, section
+
+    def get_outline(self, session_id):
+        with self.lock:
+            session = self._session(session_id)
+            return _copy(session.outline) if session else None
+
+    def save_outline(self, session_id, outline):
+        with self.lock:
+            session = self._session(session_id, create=True)
+            session.outline = _copy(outline)
+            self._measure(session, 'outline')
+            self._enforce_limits()
+
+    def save_client(self, client_id, api_key, last_used):
+        with self.lock:
+            self.clients[client_id] = (api_key, last_used)
+
+    def get_client(self, client_id):
+        with self.lock:
+            return self.clients.get(client_id)
+
+    def expire_clients(self, before):
+        with self.lock:
+            for client_id in [cid for cid, (_, last_used) in self.clients.items() if last_used < before]:
+                del self.clients[client_id]
+
+    def session_bytes(self, session_id):
+        """会话在内存中占用的字节数，不在内存中时返回 0"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            return session.bytes if session else 0
+
+    def stats(self):
+        with self.lock:
+            largest = sorted(self.sessions.items(), key=lambda item: item[1].bytes, reverse=True)[:STATS_TOP_SESSIONS]
+            return {
+                'backend': 'memory',
+                'sessions': len(self.sessions),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'spilled': self.spilled,
+                'largest_sessions': [{'session_id': session_id, 'bytes': session.bytes} for session_id, session in largest]
+            }
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=lambda o: o.isoformat() if isinstance(o, datetime) else str(o))
+
+
+class SQLiteStorage(Storage):
+    """基于 SQLite（WAL 模式）的持久化存储
+
+    多个 gunicorn worker 可以共享同一个数据库文件，无需粘性会话。
+    进度和故事上下文以 JSON 保存，读出后时间字段为 ISO 格式字符串，字典键为字符串。
+    sections 表中的正文是小节最近一次全文快照；之后的修改只在 section_versions 中追加编辑记录，
+    读取当前正文时在快照上重放这些编辑，每隔 SNAPSHOT_INTERVAL 个版本重新写一次快照。
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        self.local = threading.local()
+        conn = self._connect()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS progress (
+                session_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS story_context (
+                session_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outlines (
+                session_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS consistency_index (
+                session_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sections (
+                session_id TEXT NOT NULL,
+                chapter_number INTEGER NOT NULL,
+                section_number INTEGER NOT NULL,
+                title TEXT,
+                content TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (session_id, chapter_number, section_number)
+            );
+            CREATE TABLE IF NOT EXISTS section_versions (
+                session_id TEXT NOT NULL,
+                chapter_number INTEGER NOT NULL,
+                section_number INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                title TEXT,
+                content TEXT,
+                edits TEXT,
+                kind TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (session_id, chapter_number, section_number, version)
+            );
+            CREATE TABLE IF NOT EXISTS clients (
+                client_id TEXT PRIMARY KEY,
+                api_key TEXT NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS clients_last_used ON clients (last_used);
+        """)
+
+    def _connect(self):
+        # sqlite3 连接不能跨线程使用，每个线程各持有一个
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _update_json(self, table, session_id, updater, create):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(f"SELECT data FROM {table} WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None and not create:
+                conn.execute("ROLLBACK")
+                return None
+            data = json.loads(row[0]) if row else {}
+            updater(data)
+            conn.execute(
+                f"INSERT OR REPLACE INTO {table} (session_id, data) VALUES (?, ?)",
+                (session_id, _dumps(data))
+            )
+            conn.execute("COMMIT")
+            return data
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_progress(self, session_id):
+        row = self._connect().execute("SELECT data FROM progress WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def update_progress(self, session_id, fields):
+        self._update_json('progress', session_id, lambda data: data.update(json.loads(_dumps(fields))), create=True)
+
+    def get_story_context(self, session_id):
+        row = self._connect().execute("SELECT data FROM story_context WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_story_context(self, session_id, context):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO story_context (session_id, data) VALUES (?, ?)",
+            (session_id, _dumps(context))
+        )
+
+    def update_story_context(self, session_id, updater):
+        return self._update_json('story_context', session_id, updater, create=False)
+
+    def get_consistency_index(self, session_id):
+        row = self._connect().execute("SELECT data FROM consistency_index WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_consistency_index(self, session_id, updater):
+        return self._update_json('consistency_index', session_id, updater, create=True)
+
+    def _write_section(self, conn, key, title, content, edits, kind, length=None):
+        """在事务内写入一个新版本：保存时（edits 为 None）写入全文 content；修改时只记录编辑和修改后的长度
+        length，不读写正文，每隔 SNAPSHOT_INTERVAL 个版本才在当前正文上应用编辑并写成全文快照
+        """
+        now = datetime.now().isoformat()
+        latest, snapshot = conn.execute(
+            "SELECT MAX(version), MAX(CASE WHEN content IS NOT NULL THEN version END) FROM section_versions "
+            "WHERE session_id = ? AND chapter_number = ? AND section_number = ?", key
+        ).fetchone()
+        version = (latest or 0) + 1
+        full = edits is None or snapshot is None or version - snapshot >= SNAPSHOT_INTERVAL
+        if edits is not None and full:
+            content = apply_edits(self._current_content(conn, key), edits)
+        if full:
+            length = len(content)
+            conn.execute(
+                "INSERT OR REPLACE INTO sections "
+                "(session_id, chapter_number, section_number, title, content, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                key + (title, content, now)
+            )
+        else:
+            conn.execute(
+                "UPDATE sections SET title = ?, updated_at = ? WHERE session_id = ? AND chapter_number = ? AND section_number = ?",
+                (title, now) + key
+            )
+        conn.execute(
+            "INSERT INTO section_versions (session_id, chapter_number, section_number, version, title, content, edits, "
+            "kind, length, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            key + (version, title, content if full else None, None if full else json.dumps(edits, ensure_ascii=False),
+                   kind, length, now)
+        )
+        # 只保留最近 MAX_VERSIONS 个版本，以及重建其中最早版本所需的全文快照
+        oldest = version - MAX_VERSIONS + 1
+        base = conn.execute(
+            "SELECT MAX(version) FROM section_versions WHERE session_id = ? AND chapter_number = ? AND section_number = ? "
+            "AND content IS NOT NULL AND version <= ?", key + (oldest,)
+        ).fetchone()[0]
+        if base is not None:
+            conn.execute(
+                "DELETE FROM section_versions WHERE session_id = ? AND chapter_number = ? AND section_number = ? "
+                "AND version < ?", key + (base,)
+            )
+        return version
+
+    def _pending_edits(self, conn, session_id, chapter_number=None, section_number=None):
+        """sections 表中的快照之后各版本的编辑，返回 {(章, 节): [编辑列表的 JSON, ...]}（按版本排序）"""
+        where = ''.join(
+            f" AND v.{column} = ?" for column, value in (('chapter_number', chapter_number), ('section_number', section_number))
+            if value is not None
+        )
+        params = tuple(int(value) for value in (chapter_number, section_number) if value is not None)
+        rows = conn.execute(
+            "SELECT v.chapter_number, v.section_number, v.edits FROM section_versions v "
+            f"WHERE v.session_id = ?{where} AND v.version > (SELECT MAX(w.version) FROM section_versions w "
+            "WHERE w.session_id = v.session_id AND w.chapter_number = v.chapter_number "
+            "AND w.section_number = v.section_number AND w.content IS NOT NULL) "
+            "ORDER BY v.chapter_number, v.section_number, v.version",
+            (session_id,) + params
+        ).fetchall()
+        pending = {}
+        for chapter, section, edits in rows:
+            pending.setdefault((chapter, section), []).append(edits)
+        return pending
+
+    @staticmethod
+    def _replay(content, pending):
+        for edits in pending or ():
+            content = apply_edits(content, json.loads(edits))
+        return content
+
+    def _current_content(self, conn, key):
+        row = conn.execute(
+            "SELECT content FROM sections WHERE session_id = ? AND chapter_number = ? AND section_number = ?", key
+        ).fetchone()
+        return self._replay(row[0] or '', self._pending_edits(conn, *key).get(key[1:]))
+
+    def _transaction(self, fn):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def save_section(self, session_id, chapter_number, section_number, title, content):
+        key = (session_id, int(chapter_number), int(section_number))
+        return self._transaction(lambda conn: self._write_section(conn, key, title, content, None, 'save'))
+
+    def edit_section(self, session_id, chapter_number, section_number, edits, base_version=None, title=None):
+        key = (session_id, int(chapter_number), int(section_number))
+
+        def edit(conn):
+            # 只读取当前版本号和长度，正文不经过这里
+            row = conn.execute(
+                "SELECT title FROM sections WHERE session_id = ? AND chapter_number = ? AND section_number = ?", key
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"第{chapter_number}章第{section_number}节不存在")
+            latest = conn.execute(
+                "SELECT version, length FROM section_versions WHERE session_id = ? AND chapter_number = ? "
+                "AND section_number = ? ORDER BY version DESC LIMIT 1", key
+            ).fetchone()
+            current, length = latest or (0, len(self._current_content(conn, key)))
+            if base_version is not None and int(base_version) != current:
+                raise VersionConflict(current)
+            parsed = normalize_edits(edits, length)
+            length += sum(len(text) - (end - start) for start, end, text in parsed)
+            version = self._write_section(conn, key, title or row[0], None, parsed, 'edit', length)
+            return {'version': version, 'length': length}
+
+        return self._transaction(edit)
+
+    def get_section(self, session_id, chapter_number, section_number, version=None):
+        key = (session_id, int(chapter_number), int(section_number))
+        conn = self._connect()
+        if version is None:
+            row = conn.execute(
+                "SELECT title, content FROM sections WHERE session_id = ? AND chapter_number = ? AND section_number = ?", key
+            ).fetchone()
+            if row is None:
+                return None
+            current = conn.execute(
+                "SELECT MAX(version) FROM section_versions WHERE session_id = ? AND chapter_number = ? AND section_number = ?",
+                key
+            ).fetchone()[0] or 0
+            content = self._replay(row[1], self._pending_edits(conn, *key).get(key[1:]))
+            return {'title': row[0], 'content': content, 'version': current}
+
+        # 从不晚于目标版本的最近一次全文快照开始重放编辑
+        rows = conn.execute(
+            "SELECT version, title, content, edits FROM section_versions "
+            "WHERE session_id = ? AND chapter_number = ? AND section_number = ? AND version <= ? AND version >= "
+            "(SELECT MAX(version) FROM section_versions WHERE session_id = ? AND chapter_number = ? "
+            "AND section_number = ? AND version <= ? AND content IS NOT NULL) ORDER BY version",
+            key + (int(version),) + key + (int(version),)
+        ).fetchall()
+        if not rows or rows[-1][0] != int(version):
+            raise ValueError(f"版本 {version} 不存在或已被清理")
+        content = None
+        for _, title, snapshot, edits in rows:
+            content = snapshot if snapshot is not None else apply_edits(content, json.loads(edits))
+        return {'title': rows[-1][1], 'content': content, 'version': int(version)}
+
+    def section_history(self, session_id, chapter_number, section_number):
+        key = (session_id, int(chapter_number), int(section_number))
+        rows = self._connect().execute(
+            "SELECT version, title, length, kind, created_at FROM section_versions "
+            "WHERE session_id = ? AND chapter_number = ? AND section_number = ? ORDER BY version", key
+        ).fetchall()
+        if not rows and self.get_section(session_id, chapter_number, section_number) is None:
+            raise ValueError(f"第{chapter_number}章第{section_number}节不存在")
+        # 只列出 MAX_VERSIONS 个版本，更早的行仅作为重建用的快照保留
+        return [
+            {'version': version, 'title': title, 'length': length, 'kind': kind, 'created_at': created_at}
+            for version, title, length, kind, created_at in rows[-MAX_VERSIONS:]
+        ]
+
+    def get_chapter_sections(self, session_id, chapter_number):
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT section_number, title, content FROM sections "
+            "WHERE session_id = ? AND chapter_number = ? ORDER BY section_number",
+            (session_id, chapter_number)
+        ).fetchall()
+        pending = self._pending_edits(conn, session_id, chapter_number)
+        sections = []
+        for section_number, title, content in rows:
+            while len(sections) < section_number - 1:
+                sections.append(None)
+            content = self._replay(content, pending.get((int(chapter_number), section_number)))
+            sections.append({'title': title, 'content': content})
+        return sections
+
+    def iter_sections(self, session_id):
+        conn = self._connect()
+        pending = self._pending_edits(conn, session_id)
+        cursor = conn.execute(
+            "SELECT chapter_number, section_number, title, content FROM sections "
+            "WHERE session_id = ? ORDER BY chapter_number, section_number",
+            (session_id,)
+        )
+        for chapter_number, section_number, title, content in cursor:
+            content = self._replay(content, pending.get((chapter_number, section_number)))
+            yield chapter_number, section_number, {'title': title, 'content': content}
+
+    def get_outline(self, session_id):
+        row = self._connect().execute("SELECT data FROM outlines WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_outline(self, session_id, outline):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO outlines (session_id, data) VALUES (?, ?)",
+            (session_id, _dumps(outline))
+        )
+
+    def save_client(self, client_id, api_key, last_used):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO clients (client_id, api_key, last_used) VALUES (?, ?, ?)",
+            (client_id, api_key, last_used)
+        )
+
+    def get_client(self, client_id):
+        row = self._connect().execute("SELECT api_key, last_used FROM clients WHERE client_id = ?", (client_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def expire_clients(self, before):
+        self._connect().execute("DELETE FROM clients WHERE last_used < ?", (before,))
+
+    def stats(self):
+        conn = self._connect()
+        sessions = conn.execute(
+            "SELECT COUNT(*) FROM (SELECT session_id FROM progress UNION SELECT session_id FROM story_context "
+            "UNION SELECT session_id FROM outlines UNION SELECT session_id FROM sections)"
+        ).fetchone()[0]
+        return {
+            'backend': 'sqlite',
+            'sessions': sessions,
+            'bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        }
+
+
+def create_storage():
+    """根据环境变量创建存储：NOVEL_STORAGE=sqlite（默认）或 memory，NOVEL_DB_PATH 指定数据库文件，
+    NOVEL_SPILL_DIR 为内存存储换出冷会话的目录"""
+    kind = os.environ.get('NOVEL_STORAGE', 'sqlite')
+    if kind == 'memory':
+        return MemoryStorage(spill_dir=os.environ.get('NOVEL_SPILL_DIR') or None)
+    if kind == 'sqlite':
+        return SQLiteStorage(os.environ.get('NOVEL_DB_PATH', DEFAULT_DB_PATH))
+    raise ValueError(f"未知的存储类型：{kind}")
@@ -0,0 +1,66 @@
+import re
+
+# Moonshot 模型及其上下文窗口（提示词与输出共享），按从小到大排列
+MODEL_TIERS = [
+    ('moonshot-v1-8k', 8192),
+    ('moonshot-v1-32k', 32768),
+    ('moonshot-v1-128k', 131072),
+]
+
+# 估算存在误差，预留一部分上下文不使用
+SAFETY_MARGIN = 0.05
+# 每条消息的角色、分隔符等固定开销
+MESSAGE_OVERHEAD = 4
+# 输出空间少于该值时认为提示词过长，不值得发起请求
+MIN_OUTPUT_TOKENS = 256
+
+# 中日韩文字及全角标点
+_CJK = re.compile(r'[⺀-鿿豈-﫿　-〿＀-￯]')
+# 约 1.5 个汉字对应一个 token，这里取偏保守的估计
+CJK_TOKENS_PER_CHAR = 0.7
+# 英文、数字等约 4 个字符一个 token
+OTHER_CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    """估算文本的 token 数，区分中日韩文字和其他字符"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    other = len(text) - cjk
+    return int(cjk * CJK_TOKENS_PER_CHAR + other / OTHER_CHARS_PER_TOKEN) + 1
+
+
+def estimate_messages_tokens(messages):
+    return sum(estimate_tokens(message['content']) + MESSAGE_OVERHEAD for message in messages)
+
+
+def tokens_for_chars(chars):
+    """生成约 chars 个汉字所需的输出 token 数（含两成余量）"""
+    return int(chars * CJK_TOKENS_PER_CHAR * 1.2)
+
+
+def _usable(context_window):
+    return int(context_window * (1 - SAFETY_MARGIN))
+
+
+def plan_completion(messages, max_tokens, model=None):
+    """根据提示词长度确定模型和 max_tokens
+
+    未指定 model 时，选择能同时容纳提示词和 max_tokens 的最小模型；
+    最大的模型也放不下时，压缩 max_tokens。指定了 model 时只压缩 max_tokens。
+    返回 (model, max_tokens)，提示词过长时抛出 ValueError。
+    """
+    prompt_tokens = estimate_messages_tokens(messages)
+    windows = dict(MODEL_TIERS)
+
+    if model is None:
+        for name, window in MODEL_TIERS:
+            if prompt_tokens + max_tokens <= _usable(window):
+                return name, max_tokens
+        model = MODEL_TIERS[-1][0]
+
+    available = _usable(windows.get(model, MODEL_TIERS[0][1])) - prompt_tokens
+    if available < min(max_tokens, MIN_OUTPUT_TOKENS):
+        raise ValueError(f"提示词过长（约 {prompt_tokens} tokens），超出 {model} 的上下文窗口")
+    return model, min(max_tokens, available)